@@ -1,5 +1,7 @@
 import sys
 import os, sys
+import shutil
+import tempfile
 from lxml import etree
 
 # Add manually the common folder to the pythonpath
@@ -89,4 +91,124 @@ def test_geometry_topology_data_write_read():
 
     # Make sure that the seed is set to a right value
     g.update_seed()
-    assert g.seed_id == 5, "Seed in the object should be 5, while the current value is {}".format(g.seed_id)
\ No newline at end of file
+    assert g.seed_id == 5, "Seed in the object should be 5, while the current value is {}".format(g.seed_id)
+
+def test_geometry_topology_data_npz_round_trip():
+    """ Convert the sample xml file to npz and back to xml with to_file/from_file (the format is chosen based on
+    the extension). The xml generated from the npz file must be identical to the one generated from the xml file
+    """
+    g = GeometryTopologyData.from_file(xml_file)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        xml1_file = os.path.join(temp_dir, "geometryTopologyData1.xml")
+        npz_file = os.path.join(temp_dir, "geometryTopologyData.npz")
+        xml2_file = os.path.join(temp_dir, "geometryTopologyData2.xml")
+        g.to_file(xml1_file)
+        g.to_file(npz_file)
+        with open(npz_file, 'rb') as f:
+            assert f.read(2) == b"PK", "The file should be a npz (zip) file"
+        g2 = GeometryTopologyData.from_file(npz_file)
+        g2.to_file(xml2_file)
+
+        with open(xml1_file, 'rb') as f:
+            expected_output = f.read()
+        with open(xml2_file, 'rb') as f:
+            xml = f.read()
+        assert xml == expected_output, "XML generated: " + xml
+        assert g2.seed_id == 5, "Seed in the object should be 5, while the current value is {}".format(g2.seed_id)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_geometry_topology_data_npz_none_fields():
+    """ Optional fields that are None (and empty strings, that are not the same) must be preserved in a npz file
+    """
+    g = GeometryTopologyData()
+    g.coordinate_system = g.LPS
+    p1 = Point(2, 5, 1, [2, 3.5, 3], description=None, timestamp=None, user_name=None, machine_name=None)
+    p1.__id__ = 1
+    g.add_point(p1, fill_auto_fields=False)
+    p2 = Point(3, 2, 0, [2.0, 1.5, 3.75], description="", timestamp="2015-10-21 04:00:00",
+               user_name=u"\xf1and\xfa", machine_name=None)
+    p2.__id__ = 2
+    g.add_point(p2, fill_auto_fields=False)
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        npz_file = os.path.join(temp_dir, "points.npz")
+        g.to_file(npz_file)
+        g2 = GeometryTopologyData.from_file(npz_file)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    # None values are not saved in the xml, so the general properties must be None too
+    assert g2.coordinate_system == g.LPS
+    assert g2.lps_to_ijk_transformation_matrix is None
+    assert g2.spacing is None and g2.origin is None and g2.dimensions is None
+    assert len(g2.bounding_boxes) == 0
+    assert len(g2.points) == 2
+    p1, p2 = g2.points
+    assert p1.description is None and p1.timestamp is None and p1.user_name is None and p1.machine_name is None
+    assert p2.description == "" and p2.timestamp == "2015-10-21 04:00:00"
+    assert p2.user_name == u"\xf1and\xfa" and p2.machine_name is None
+    assert g2.to_xml() == g.to_xml()
+
+
+def test_geometry_topology_data_iterparse_xml():
+    """ iterparse_xml must yield the same structures (in the same order) as the ones read by from_xml_file and
+    read the general properties
+    """
+    g = GeometryTopologyData.from_xml_file(xml_file)
+    g2 = GeometryTopologyData()
+    structures = list(GeometryTopologyData.iterparse_xml(xml_file, g2))
+
+    expected_structures = g.points + g.bounding_boxes
+    assert [type(s) for s in structures] == [Point, Point, BoundingBox, BoundingBox]
+    assert [s.to_xml() for s in structures] == [s.to_xml() for s in expected_structures]
+    # The structures are not added to the object, but the general properties are read
+    assert len(g2.points) == 0 and len(g2.bounding_boxes) == 0
+    assert g2.coordinate_system == g.RAS
+    assert g2.lps_to_ijk_transformation_matrix == g.lps_to_ijk_transformation_matrix
+    assert list(g2.spacing) == [0.7, 0.7, 0.5]
+    assert list(g2.origin) == [180.0, 180.0, -700.5]
+    assert list(g2.dimensions) == [512, 512, 600]
+
+    # Without an object, just the structures are read
+    structures = list(GeometryTopologyData.iterparse_xml(xml_file))
+    assert [s.id for s in structures] == [1, 2, 3, 4]
+
+
+def test_geometry_topology_data_export_to_columns():
+    """ Export the points and the bounding boxes of the sample xml file to columns
+    """
+    g = GeometryTopologyData.from_xml_file(xml_file)
+    # Points and bounding boxes cannot be exported at the same time
+    try:
+        g.export_to_columns()
+        assert False, "export_to_columns should fail when there are points and bounding boxes"
+    except NotImplementedError:
+        pass
+
+    points = GeometryTopologyData()
+    for p in g.points:
+        points.add_point(p, fill_auto_fields=False)
+    columns = points.export_to_columns()
+    assert list(columns.keys()) == ['id', 'c1', 'c2', 'c3', 'chest_type_id', 'chest_region_id', 'feature_type_id',
+                                    'description', 'timestamp', 'user_name', 'machine_name']
+    assert columns['id'].tolist() == [1, 2]
+    assert columns['c1'].tolist() == [2, 2] and columns['c2'].tolist() == [3.5, 1.5]
+    assert columns['c3'].tolist() == [3, 3.75]
+    assert columns['chest_region_id'].tolist() == [2, 3]
+    assert columns['chest_type_id'].tolist() == [5, 2]
+    assert columns['feature_type_id'].tolist() == [1, 0]
+    assert columns['description'].tolist() == ["My desc", None]
+    assert columns['user_name'].tolist() == ["mcfly", "mcfly"]
+
+    bounding_boxes = GeometryTopologyData()
+    for bb in g.bounding_boxes:
+        bounding_boxes.add_bounding_box(bb, fill_auto_fields=False)
+    columns = bounding_boxes.export_to_columns()
+    assert columns['id'].tolist() == [3, 4]
+    assert [columns[c].tolist() for c in ('start1', 'start2', 'start3')] == [[2, 2], [3.5, 3.5], [3, 3]]
+    assert [columns[c].tolist() for c in ('size1', 'size2', 'size3')] == [[1, 2], [1, 2], [4, 5]]
+    assert columns['description'].tolist() == [None, "My desc"]
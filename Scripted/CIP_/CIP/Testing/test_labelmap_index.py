@@ -0,0 +1,74 @@
+import numpy as np
+
+from CIP.logic.labelmap_index import *
+
+
+def __check_index__(lm, index):
+    """ Compare all the queries of a LabelmapIndex with the same values computed directly from the labelmap
+    :param lm: numpy 3D labelmap
+    :param index: LabelmapIndex built for lm
+    """
+    labels = np.unique(lm)
+    assert index.labels.tolist() == labels.tolist()
+    for label in labels.tolist():
+        mask = lm == label
+        coords = np.nonzero(mask)
+        assert label in index
+        assert index.count(label) == mask.sum()
+        for axis in xrange(3):
+            slices = np.unique(coords[axis])
+            assert index.slices(label, axis).tolist() == slices.tolist()
+            assert index.slice_range(label, axis) == (slices[0], slices[-1])
+        bbox = tuple(slice(c.min(), c.max() + 1) for c in coords)
+        assert index.bounding_box(label) == bbox
+        assert mask[bbox].sum() == mask.sum()
+        assert np.allclose(index.centroid(label), [c.mean() for c in coords])
+
+    # Labels that are not in the labelmap
+    missing = int(labels.max()) + 1
+    assert missing not in index
+    assert index.count(missing) == 0
+    assert len(index.slices(missing)) == 0
+    assert index.slice_range(missing) is None
+    assert index.bounding_box(missing) is None
+    assert index.centroid(missing) is None
+
+    # All the labels > 0
+    for axis in xrange(3):
+        labelmap_slices = index.get_labelmap_slices(axis)
+        assert sorted(labelmap_slices.keys()) == [l for l in labels.tolist() if l > 0]
+        for label, slices in labelmap_slices.items():
+            assert slices.tolist() == index.slices(label, axis).tolist()
+        other_axes = tuple(a for a in xrange(3) if a != axis)
+        assert index.get_all_labels_slices(axis).tolist() == np.nonzero((lm > 0).any(axis=other_axes))[0].tolist()
+
+
+def test_labelmap_index_queries():
+    """ Index of a random labelmap, processed in several blocks of slices """
+    rng = np.random.RandomState(0)
+    lm = np.zeros((13, 20, 17), dtype=np.uint16)
+    for label in (1, 2, 5, 300, 511):
+        z, y, x = rng.randint(0, 10, 3)
+        lm[z:z + rng.randint(1, 4), y:y + rng.randint(1, 10), x:x + rng.randint(1, 8)] = label
+    # Sparse voxels of another label
+    lm[rng.rand(*lm.shape) < 0.01] = 7
+    # The result must not depend on the number of blocks
+    for block_size in (lm.size, 1000, 1):
+        __check_index__(lm, LabelmapIndex(lm, block_size=block_size))
+
+
+def test_labelmap_index_wide_range():
+    """ Labels with a range of values too big for the lookup table (signed values) """
+    rng = np.random.RandomState(1)
+    lm = rng.choice(np.array([-100000, 0, 3, 70000], dtype=np.int32), size=(6, 7, 8), p=[0.1, 0.6, 0.2, 0.1])
+    __check_index__(lm, LabelmapIndex(lm, block_size=100))
+
+
+def test_labelmap_index_empty_labelmap():
+    """ A labelmap with just background """
+    lm = np.zeros((4, 5, 6), dtype=np.uint8)
+    index = LabelmapIndex(lm)
+    assert index.labels.tolist() == [0]
+    assert index.count(0) == lm.size
+    assert index.get_labelmap_slices() == {}
+    assert len(index.get_all_labels_slices()) == 0
@@ -12,6 +12,7 @@ import subprocess
 
 import file_conventions
 from geometry_topology_data import *
+from labelmap_index import LabelmapIndex
 
 class Util: 
     # Constants
@@ -20,6 +21,9 @@ class Util:
 
     file_conventions_extensions = file_conventions.file_conventions_extensions
 
+    # Cache of LabelmapIndex objects (node id: (image data modified time, index))
+    __labelmap_indexes__ = {}
+
     ###########
     # GENERAL SYSTEM FUNCTIONS
     @staticmethod
@@ -130,6 +134,133 @@ class Util:
 
     ##################
     # COORDINATE SYSTEMS
+    # All the conversions are solved with a single numpy matrix multiplication, so that a whole (N, 3) array of
+    # points can be transformed at once. The functions that work with single points are just wrappers.
+    RAS = "RAS"
+    LPS = "LPS"
+    IJK = "IJK"
+
+    @staticmethod
+    def vtk_matrix_to_numpy(matrix):
+        """ Convert a vtkMatrix4x4 into a 4x4 numpy array
+        :param matrix: vtkMatrix4x4
+        :return: numpy array
+        """
+        return np.array([[matrix.GetElement(i, j) for j in xrange(4)] for i in xrange(4)])
+
+    @staticmethod
+    def get_coordinates_transformation_matrix(volume_node, source_system, target_system):
+        """ Get the 4x4 matrix that transforms homogeneous coordinates between two coordinate systems
+        :param volume_node: vtk mrml scalar node (it can be None if none of the systems is IJK)
+        :param source_system: Util.RAS, Util.LPS or Util.IJK
+        :param target_system: Util.RAS, Util.LPS or Util.IJK
+        :return: 4x4 numpy array
+        """
+        ras_lps = np.diag([-1.0, -1.0, 1.0, 1.0])
+        # Source system to RAS
+        if source_system == Util.RAS:
+            to_ras = np.identity(4)
+        elif source_system == Util.LPS:
+            to_ras = ras_lps
+        elif source_system == Util.IJK:
+            ijk_to_ras = vtk.vtkMatrix4x4()
+            volume_node.GetIJKToRASMatrix(ijk_to_ras)
+            to_ras = Util.vtk_matrix_to_numpy(ijk_to_ras)
+        else:
+            raise Exception("Coordinate system not allowed: " + str(source_system))
+        # RAS to target system
+        if target_system == Util.RAS:
+            from_ras = np.identity(4)
+        elif target_system == Util.LPS:
+            from_ras = ras_lps
+        elif target_system == Util.IJK:
+            ras_to_ijk = vtk.vtkMatrix4x4()
+            volume_node.GetRASToIJKMatrix(ras_to_ijk)
+            from_ras = Util.vtk_matrix_to_numpy(ras_to_ijk)
+        else:
+            raise Exception("Coordinate system not allowed: " + str(target_system))
+        return from_ras.dot(to_ras)
+
+    @staticmethod
+    def transform_coordinates_array(volume_node, coords, source_system, target_system, convert_to_int=False,
+                                    round_to_voxel=False):
+        """ Transform an array of coordinates between two coordinate systems (RAS, LPS or IJK).
+        The transformation matrix is read from the volume just once for all the points
+        :param volume_node: vtk mrml scalar node (it can be None if none of the systems is IJK)
+        :param coords: array-like of shape (N, 3) or a single point (3 coordinates)
+        :param source_system: Util.RAS, Util.LPS or Util.IJK
+        :param target_system: Util.RAS, Util.LPS or Util.IJK
+        :param convert_to_int: return integer coordinates, truncating the values (same as int(x))
+        :param round_to_voxel: return integer coordinates, rounding the values to the nearest voxel
+        :return: numpy array with the same shape as coords (xyz)
+        """
+        coords = np.asarray(coords, dtype=np.float64)
+        matrix = Util.get_coordinates_transformation_matrix(volume_node, source_system, target_system)
+        result = coords.dot(matrix[:3, :3].T) + matrix[:3, 3]
+        if round_to_voxel:
+            return np.round(result).astype(np.int)
+        if convert_to_int:
+            return result.astype(np.int)
+        return result
+
+    @staticmethod
+    def ras_to_ijk_array(volume_node, ras_coords, convert_to_int=False, round_to_voxel=False):
+        """ Transform an array of RAS coords to IJK
+        :param volume_node: vtk mrml scalar node
+        :param ras_coords: array-like of shape (N, 3)
+        :param convert_to_int: return IJK coordinates as integer (truncating the values)
+        :param round_to_voxel: return IJK coordinates as integer (rounding to the nearest voxel)
+        :return: numpy array of shape (N, 3) with IJK coordinates
+        """
+        return Util.transform_coordinates_array(volume_node, ras_coords, Util.RAS, Util.IJK,
+                                                convert_to_int=convert_to_int, round_to_voxel=round_to_voxel)
+
+    @staticmethod
+    def ijk_to_ras_array(volume_node, ijk_coords):
+        """ Transform an array of IJK coords to RAS
+        :param volume_node: vtk mrml scalar node
+        :param ijk_coords: array-like of shape (N, 3)
+        :return: numpy array of shape (N, 3) with RAS coordinates
+        """
+        return Util.transform_coordinates_array(volume_node, ijk_coords, Util.IJK, Util.RAS)
+
+    @staticmethod
+    def lps_to_ijk_array(volume_node, lps_coords, convert_to_int=False, round_to_voxel=False):
+        """ Transform an array of LPS coords to IJK
+        :param volume_node: vtk mrml scalar node
+        :param lps_coords: array-like of shape (N, 3)
+        :param convert_to_int: return IJK coordinates as integer (truncating the values)
+        :param round_to_voxel: return IJK coordinates as integer (rounding to the nearest voxel)
+        :return: numpy array of shape (N, 3) with IJK coordinates
+        """
+        return Util.transform_coordinates_array(volume_node, lps_coords, Util.LPS, Util.IJK,
+                                                convert_to_int=convert_to_int, round_to_voxel=round_to_voxel)
+
+    @staticmethod
+    def ijk_to_lps_array(volume_node, ijk_coords):
+        """ Transform an array of IJK coords to LPS
+        :param volume_node: vtk mrml scalar node
+        :param ijk_coords: array-like of shape (N, 3)
+        :return: numpy array of shape (N, 3) with LPS coordinates
+        """
+        return Util.transform_coordinates_array(volume_node, ijk_coords, Util.IJK, Util.LPS)
+
+    @staticmethod
+    def ras_to_lps_array(coords):
+        """ Convert an array of coordinates from RAS to LPS (or viceversa, it is just flipping the first 2 axes)
+        :param coords: array-like of shape (N, 3)
+        :return: numpy array of shape (N, 3)
+        """
+        return Util.transform_coordinates_array(None, coords, Util.RAS, Util.LPS)
+
+    @staticmethod
+    def lps_to_ras_array(coords):
+        """ Convert an array of coordinates from LPS to RAS
+        :param coords: array-like of shape (N, 3)
+        :return: numpy array of shape (N, 3)
+        """
+        return Util.transform_coordinates_array(None, coords, Util.LPS, Util.RAS)
+
     @staticmethod
     def ras_to_ijk(volume_node, ras_coords, convert_to_int=True):
         """ Transform a list of RAS coords to IJK
@@ -138,39 +269,14 @@ class Util:
         :param convert_to_int: return IJK coordinates as integer
         :return: list of IJK coordinates (xyz)
         """
-        rastoijk=vtk.vtkMatrix4x4()
-        volume_node.GetRASToIJKMatrix(rastoijk)
-        cl = list(ras_coords)
-        cl.append(1)
-        l = list(rastoijk.MultiplyPoint(cl)[:-1])
-        if convert_to_int:
-            return [int(l[0]), int(l[1]), int(l[2])]
-        return l
+        return Util.ras_to_ijk_array(volume_node, ras_coords, convert_to_int=convert_to_int).tolist()
 
     @staticmethod
     def ijk_to_ras(volume_node, ijk_coords):
         """ Transform a list of IJK coords to RAS
         :return: list of RAS coordinates (xyz)
         """
-        ijktoras=vtk.vtkMatrix4x4()
-        volume_node.GetIJKToRASMatrix(ijktoras)
-        cl = list(ijk_coords)
-        cl.append(1)
-        return list(ijktoras.MultiplyPoint(cl)[:-1])
-
-    @staticmethod
-    def __switch_ras_lps__(coords):
-        """ Convert from RAS to LPS or viceversa (it is just flipping the first axis)
-        :return: list of 3 coordinates
-        """
-        lps_to_ras_matrix = vtk.vtkMatrix4x4()
-        lps_to_ras_matrix.SetElement(0, 0, -1)
-        lps_to_ras_matrix.SetElement(1, 1, -1)
-
-        cl = list(coords)
-        cl.append(1)
-
-        return list(lps_to_ras_matrix.MultiplyPoint(cl)[:-1])
+        return Util.ijk_to_ras_array(volume_node, ijk_coords).tolist()
 
     @staticmethod
     def ras_to_lps(coords):
@@ -178,7 +284,7 @@ class Util:
         :param coords:
         :return: list of 3 LPS coordinates
         """
-        return Util.__switch_ras_lps__(coords)
+        return Util.ras_to_lps_array(coords).tolist()
 
     @staticmethod
     def lps_to_ras(coords):
@@ -186,7 +292,7 @@ class Util:
         :param coords:
         :return: list of 3 RAS coordinates
         """
-        return Util.__switch_ras_lps__(coords)
+        return Util.lps_to_ras_array(coords).tolist()
 
     @staticmethod
     def get_lps_to_ijk_transformation_matrix(volume_node):
@@ -288,18 +394,37 @@ class Util:
     #########
     # OTHER FUNCTIONS
     @staticmethod
-    def get_labelmap_slices(npArray):
+    def get_labelmap_index(labelmap_node, force_refresh=False):
+        """ Get a LabelmapIndex (voxel count, bounding box, slices and centroid of every label) for a labelmap node.
+        The index is cached, and it will be rebuilt only when the image data of the node are modified
+        :param labelmap_node: vtkMRMLLabelMapVolumeNode
+        :param force_refresh: rebuild the index even if the image data were not modified
+        :return: LabelmapIndex
+        """
+        image_data = labelmap_node.GetImageData()
+        scalars = image_data.GetPointData().GetScalars()
+        mtime = max(image_data.GetMTime(), scalars.GetMTime())
+        cached = Util.__labelmap_indexes__.get(labelmap_node.GetID())
+        if cached is not None and cached[0] == mtime and not force_refresh:
+            return cached[1]
+        index = LabelmapIndex(Util.vtkImageData_numpy_array(image_data))
+        Util.__labelmap_indexes__[labelmap_node.GetID()] = (mtime, index)
+        return index
+
+    @staticmethod
+    def get_labelmap_slices(np_array):
         """ Get a dictionary with the slices where all the label data are contained in a numpy array
         representing a labelmap.
         The output will be a dictionary of [label_Code: array of slices]
-        :param npArray: numpy array representing the image
+        All the labels are obtained in a single pass (see LabelmapIndex). If more information about the labels is
+        needed (counts, bounding boxes, etc.), use directly a LabelmapIndex object
+        :param np_array: numpy array representing the image
         :return: dictionary of [label_Code: numpy array of slices]
         """
-        # Extract labelmaps
-        return Util.get_labelmap_slices_from_numpy_array(npArray)
-    
+        return LabelmapIndex(np_array).get_labelmap_slices()
+
     @staticmethod
-    def get_labelmap_slices(np_array):
+    def get_labelmap_slices_1(np_array):
         """ Get a dictionary with the slices where all the label data are contained in a numpy array
         representing a labelmap.
         The output will be a dictionary of [label_Code: array of slices]
@@ -388,11 +513,14 @@ class Util:
     @staticmethod
     def centroid(np_array, labelId=1):
         """ Calculate the coordinates of a centroid for a concrete labelId (default=1)
-        :param np_array: numpy array
+        :param np_array: numpy array or LabelmapIndex (the centroid is just a lookup in this case)
         :param labelId: label id (default = 1)
         :return: numpy array with the coordinates (int format)
         """
-        mean = np.mean(np.where(np_array == labelId), axis=1)
+        if isinstance(np_array, LabelmapIndex):
+            mean = np_array.centroid(labelId)
+        else:
+            mean = np.mean(np.where(np_array == labelId), axis=1)
         return np.asarray(np.round(mean, 0), np.int)
 
 
@@ -1,6 +1,8 @@
 from Util import *
 from SlicerUtil import *
 from geometry_topology_data import *
+from labelmap_index import *
+from volume_cache import *
 from EventsTrigger import *
 import file_conventions
 #from StructuresParameters import *
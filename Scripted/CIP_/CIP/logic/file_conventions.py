@@ -1,3 +1,5 @@
+import os
+
 # TODO: complete these conventions
 file_conventions_extensions = {
     # Regular CTs
@@ -15,4 +17,24 @@ file_conventions_extensions = {
     "ParenchymaTrainingFiducialsXml": "_parenchymaTraining.xml",
     "StructuresXml": "_structures.xml",
     "DCNNStructuresXml": "_dcnnStructuresDetection.xml",
-}
\ No newline at end of file
+    # Binary GeometryTopologyData files
+    "ParenchymaTrainingFiducialsNpz": "_parenchymaTraining.npz",
+    "StructuresNpz": "_structures.npz",
+}
+
+# Formats of GeometryTopologyData files, detected by the file extension
+GEOMETRY_TOPOLOGY_DATA_XML = "xml"
+GEOMETRY_TOPOLOGY_DATA_NPZ = "npz"
+geometry_topology_data_formats = {
+    ".xml": GEOMETRY_TOPOLOGY_DATA_XML,
+    ".npz": GEOMETRY_TOPOLOGY_DATA_NPZ,
+}
+
+
+def get_geometry_topology_data_format(file_path):
+    """ Get the format of a GeometryTopologyData file based on its extension
+    :param file_path: file path
+    :return: one of the values in geometry_topology_data_formats (xml is the default for unknown extensions)
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    return geometry_topology_data_formats.get(ext, GEOMETRY_TOPOLOGY_DATA_XML)
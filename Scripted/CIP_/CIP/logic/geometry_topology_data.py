@@ -7,14 +7,26 @@ Created on Apr 6, 2015
 @author: Jorge Onieva
 """
 
-import xml.etree.ElementTree as et
-
+try:
+    # C implementation (much faster for big files)
+    import xml.etree.cElementTree as et
+except ImportError:
+    import xml.etree.ElementTree as et
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import collections
+import io
 import os
 import platform
 import time
 import numpy as np
 import warnings
 
+import file_conventions
+
 class GeometryTopologyData(object):
     # Coordinate System Constants
     UNKNOWN = 0
@@ -22,6 +34,9 @@ class GeometryTopologyData(object):
     RAS = 2
     LPS = 3
 
+    # Version of the structure of the .npz files
+    NPZ_FORMAT_VERSION = 1
+
     def __init__(self):
         self.coordinate_system = self.UNKNOWN
         self.lps_to_ijk_transformation_matrix = None    # Transformation matrix to go from LPS to IJK (in the shape of a 4x4 list)
@@ -130,55 +145,84 @@ class GeometryTopologyData(object):
         Returns:
             XML string representation of the object
         """
+        output = StringIO()
+        self.write_xml(output)
+        return output.getvalue()
+
+    def write_xml(self, file_handle, xml_cache=None):
+        """
+        Write the XML representation of this object to a file handle (or any object with a "write" method).
+        Every structure is written as soon as it is generated, so the whole xml is never stored in memory
+        Args:
+            file_handle: file handle (or file-like object)
+            xml_cache: optional dictionary of structure-xml string. The structures that are already in the
+                dictionary are not serialized again, and the new ones are added to it. The cache is only valid while
+                the structures are not modified, so it should only be used with structures that are not edited
+                (ex: the points that were already saved in a previous file)
+        """
         header = '<?xml version="1.0" encoding="UTF-8"?>\r\n'
 
-        output = header + "<GeometryTopologyData>\r\n"
+        file_handle.write(header + "<GeometryTopologyData>\r\n")
 
-        output += ("{0}<CoordinateSystem>{1}</CoordinateSystem>\r\n".format(self.__print_separator__,
+        file_handle.write("{0}<CoordinateSystem>{1}</CoordinateSystem>\r\n".format(self.__print_separator__,
                                                           self.__coordinate_system_to_str__(self.coordinate_system)))
 
         if self.lps_to_ijk_transformation_matrix is not None:
-            output += self.__write_transformation_matrix__(self.lps_to_ijk_transformation_matrix)
+            file_handle.write(self.__write_transformation_matrix__(self.lps_to_ijk_transformation_matrix))
 
         if self.spacing is not None:
-            output += "{0}<Spacing>\r\n{1}{0}</Spacing>\r\n".format(self.__print_separator__,
+            file_handle.write("{0}<Spacing>\r\n{1}{0}</Spacing>\r\n".format(self.__print_separator__,
                                                                 GeometryTopologyData.to_xml_vector(
                                                                     self.spacing, separator=self.__print_separator__,
                                                                     level=2)
-                                                                )
+                                                                ))
         if self.origin is not None:
-            output += "{0}<Origin>\r\n{1}{0}</Origin>\r\n".format(self.__print_separator__,
+            file_handle.write("{0}<Origin>\r\n{1}{0}</Origin>\r\n".format(self.__print_separator__,
                                                                 GeometryTopologyData.to_xml_vector(
                                                                     self.origin, separator=self.__print_separator__,
                                                                     level=2)
-                                                                )
+                                                                ))
         if self.dimensions is not None:
-            output += "{0}<Dimensions>\r\n{1}{0}</Dimensions>\r\n".format(self.__print_separator__,
+            file_handle.write("{0}<Dimensions>\r\n{1}{0}</Dimensions>\r\n".format(self.__print_separator__,
                                                                 GeometryTopologyData.to_xml_vector(
                                                                     self.dimensions, separator=self.__print_separator__,
                                                                     level=2)
-                                                                )
+                                                                ))
 
-        # Concatenate points (sort first)
+        # Points (sort first)
         self.points.sort(key=lambda p: p.__id__)
-        points = "".join(map(lambda i: i.to_xml(), self.points))
-        # Concatenate bounding boxes
-        bounding_boxes = "".join(map(lambda i: i.to_xml(), self.bounding_boxes))
+        for point in self.points:
+            file_handle.write(self.__structure_to_xml__(point, xml_cache))
+        # Bounding boxes
+        for bounding_box in self.bounding_boxes:
+            file_handle.write(self.__structure_to_xml__(bounding_box, xml_cache))
 
-        # Final result
-        s = output + points + bounding_boxes + "</GeometryTopologyData>\r\n"
-        return s
+        file_handle.write("</GeometryTopologyData>\r\n")
 
-    def to_xml_file(self, xml_file_path):
+    @staticmethod
+    def __structure_to_xml__(structure, xml_cache=None):
+        """ XML representation of a Point/BoundingBox, reusing the cached one if available (see write_xml)
+        :param structure: Point or BoundingBox
+        :param xml_cache: dictionary of structure-xml string (or None)
+        :return: xml string
+        """
+        if xml_cache is None:
+            return structure.to_xml()
+        xml = xml_cache.get(structure)
+        if xml is None:
+            xml = structure.to_xml()
+            xml_cache[structure] = xml
+        return xml
+
+    def to_xml_file(self, xml_file_path, xml_cache=None):
         """
         Save this object to an xml file
         Args:
             xml_file_path: file path
-            pretty_print: write the xml in a nice format (requires lxml)
+            xml_cache: optional dictionary of structure-xml string (see write_xml)
         """
-        s = self.to_xml()
         with open(xml_file_path, "w+b") as f:
-            f.write(s)
+            self.write_xml(f, xml_cache=xml_cache)
 
     @staticmethod
     def from_xml_file(xml_file_path):
@@ -187,8 +231,7 @@ class GeometryTopologyData(object):
         @return: GeometryTopologyData object
         """
         with open(xml_file_path, 'r+b') as f:
-            xml = f.read()
-            return GeometryTopologyData.from_xml(xml)
+            return GeometryTopologyData.from_xml_stream(f)
 
     @staticmethod
     def from_xml(xml):
@@ -198,57 +241,211 @@ class GeometryTopologyData(object):
         :param xml: xml string
         :return: new GeometryTopologyData object
         """
-        root = et.fromstring(xml)
+        if not isinstance(xml, bytes):
+            xml = xml.encode("utf-8")
+        return GeometryTopologyData.from_xml_stream(io.BytesIO(xml))
+
+    @staticmethod
+    def from_xml_stream(source):
+        """ Build a GeometryTopologyData object reading incrementally a xml file (see iterparse_xml)
+        :param source: file path or file handle
+        :return: new GeometryTopologyData object
+        """
+        geometry_topology = GeometryTopologyData()
+        for structure in GeometryTopologyData.iterparse_xml(source, geometry_topology):
+            if isinstance(structure, Point):
+                geometry_topology.add_point(structure, fill_auto_fields=False)
+            else:
+                geometry_topology.add_bounding_box(structure, fill_auto_fields=False)
+
+        # Set the new seed so that every point (or bounding box) added with "add_point" has a bigger id
+        geometry_topology.update_seed()
+
+        return geometry_topology
+
+    @staticmethod
+    def iterparse_xml(source, geometry_topology=None):
+        """ Read incrementally a xml file, yielding the Points and BoundingBoxes as soon as they are parsed.
+        The xml elements are discarded after being read, so the memory used does not depend on the size of the file.
+        Example:
+            for structure in GeometryTopologyData.iterparse_xml(xml_file_path):
+                if isinstance(structure, Point): ...
+        :param source: file path or file handle
+        :param geometry_topology: optional GeometryTopologyData object where the general properties (coordinate
+            system, spacing, origin, etc.) will be stored. Note that the structures are NOT added to this object
+        :return: generator of Point/BoundingBox objects
+        """
+        # Only the "end" events of the direct children of the root are processed (the inner elements are read by
+        # them). The names of these elements are never used for the inner elements
+        for event, node in et.iterparse(source, events=("end",)):
+            if node.tag == "Point":
+                yield Point.from_xml_node(node)
+            elif node.tag == "BoundingBox":
+                yield BoundingBox.from_xml_node(node)
+            elif geometry_topology is None:
+                continue
+            elif node.tag == "CoordinateSystem":
+                geometry_topology.coordinate_system = geometry_topology.__coordinate_system_from_str__(node.text)
+            elif node.tag == "LPStoIJKTransformationMatrix":
+                geometry_topology.lps_to_ijk_transformation_matrix = \
+                    geometry_topology.__read_transformation_matrix__(node)
+            elif node.tag == "Spacing":
+                geometry_topology.spacing = GeometryTopologyData.__read_vector__(node)
+            elif node.tag == "Origin":
+                geometry_topology.origin = GeometryTopologyData.__read_vector__(node)
+            elif node.tag == "Dimensions":
+                geometry_topology.dimensions = GeometryTopologyData.__read_vector__(node)
+            else:
+                continue
+            # Free the memory of the processed element (just an empty element is kept in the root)
+            node.clear()
+
+    def to_file(self, file_path, xml_cache=None):
+        """ Save this object to a file. The format is chosen based on the file extension (see
+        file_conventions.get_geometry_topology_data_format)
+        :param file_path: file path (.xml or .npz)
+        :param xml_cache: optional dictionary of structure-xml string, used only for xml files (see write_xml)
+        """
+        file_format = file_conventions.get_geometry_topology_data_format(file_path)
+        if file_format == file_conventions.GEOMETRY_TOPOLOGY_DATA_NPZ:
+            self.to_npz_file(file_path)
+        else:
+            self.to_xml_file(file_path, xml_cache=xml_cache)
+
+    @staticmethod
+    def from_file(file_path):
+        """ Get a GeometryTopologyObject from a file. The format is chosen based on the file extension (see
+        file_conventions.get_geometry_topology_data_format)
+        :param file_path: file path (.xml or .npz)
+        :return: GeometryTopologyData object
+        """
+        file_format = file_conventions.get_geometry_topology_data_format(file_path)
+        if file_format == file_conventions.GEOMETRY_TOPOLOGY_DATA_NPZ:
+            return GeometryTopologyData.from_npz_file(file_path)
+        return GeometryTopologyData.from_xml_file(file_path)
+
+    def to_npz_file(self, npz_file_path):
+        """ Save this object to a compressed numpy file (.npz), where every field of the points and the bounding
+        boxes is stored as a typed column (see export_to_columns).
+        The files are much smaller and faster to read than the xml files
+        :param npz_file_path: file path
+        """
+        arrays = dict()
+        arrays["format_version"] = np.array(self.NPZ_FORMAT_VERSION)
+        arrays["coordinate_system"] = np.array(self.coordinate_system)
+        if self.lps_to_ijk_transformation_matrix is not None:
+            arrays["lps_to_ijk_transformation_matrix"] = self.lps_to_ijk_transformation_matrix_array
+        if self.spacing is not None:
+            arrays["spacing"] = np.array(self.spacing, dtype=np.float)
+        if self.origin is not None:
+            arrays["origin"] = np.array(self.origin, dtype=np.float)
+        if self.dimensions is not None:
+            arrays["dimensions"] = np.array(self.dimensions, dtype=np.float)
+
+        self.points.sort(key=lambda p: p.__id__)
+        for prefix, structures, is_bounding_box in (("points_", self.points, False),
+                                                    ("bounding_boxes_", self.bounding_boxes, True)):
+            columns = GeometryTopologyData.__structures_to_columns__(structures, is_bounding_box)
+            for name, column in columns.items():
+                if column.dtype == object:
+                    # Strings are stored in utf-8 (None values are saved in a separate mask)
+                    arrays[prefix + "has_" + name] = np.array([value is not None for value in column], dtype=bool)
+                    column = np.array([GeometryTopologyData.__encode_string__(value) for value in column],
+                                      dtype=bytes)
+                arrays[prefix + name] = column
+
+        # Use a file handle so that numpy does not change the extension of the file
+        with open(npz_file_path, "w+b") as f:
+            np.savez_compressed(f, **arrays)
+
+    @staticmethod
+    def read_npz_columns(npz_file_path):
+        """ Read a .npz file without building the Point/BoundingBox objects
+        :param npz_file_path: file path
+        :return: tuple with:
+            - GeometryTopologyData object with the general properties (coordinate system, spacing, etc.) and no structures
+            - OrderedDict of column_name-numpy array with the points (see export_to_columns)
+            - OrderedDict of column_name-numpy array with the bounding boxes (see export_to_columns)
+        """
         geometry_topology = GeometryTopologyData()
+        data = np.load(npz_file_path)
+        try:
+            geometry_topology.coordinate_system = int(data["coordinate_system"])
+            if "lps_to_ijk_transformation_matrix" in data.files:
+                geometry_topology.lps_to_ijk_transformation_matrix = data["lps_to_ijk_transformation_matrix"].tolist()
+            if "spacing" in data.files:
+                geometry_topology.spacing = data["spacing"]
+            if "origin" in data.files:
+                geometry_topology.origin = data["origin"]
+            if "dimensions" in data.files:
+                geometry_topology.dimensions = data["dimensions"]
+
+            result = [geometry_topology]
+            for prefix, is_bounding_box in (("points_", False), ("bounding_boxes_", True)):
+                # Keep the same columns (and order) than export_to_columns
+                columns = GeometryTopologyData.__structures_to_columns__([], is_bounding_box)
+                for name in columns:
+                    column = data[prefix + name]
+                    if columns[name].dtype == object:
+                        mask = data[prefix + "has_" + name]
+                        decoded = np.empty(len(column), dtype=object)
+                        decoded[mask] = [value.decode("utf-8") for value in column[mask]]
+                        column = decoded
+                    columns[name] = column
+                result.append(columns)
+        finally:
+            data.close()
+        return tuple(result)
 
-        # NumDimensions. DEPRECATED
-        # node = root.find("NumDimensions")
-        # if node is not None:
-        #     geometry_topology.__num_dimensions__ = int(node.text)
-
-        # Coordinate System
-        node = root.find("CoordinateSystem")
-        if node is not None:
-            geometry_topology.coordinate_system = geometry_topology.__coordinate_system_from_str__(node.text)
-
-        geometry_topology.lps_to_ijk_transformation_matrix = geometry_topology.__read_transformation_matrix__(root)
-
-        node = root.find("Spacing")
-        if node is not None:
-            val = []
-            for node_val in node.findall("value"):
-                val.append(float(node_val.text))
-            geometry_topology.spacing = np.array(val)
-
-        node = root.find("Origin")
-        if node is not None:
-            val = []
-            for node_val in node.findall("value"):
-                val.append(float(node_val.text))
-            geometry_topology.origin = np.array(val)
-
-        node = root.find("Dimensions")
-        if node is not None:
-            val = []
-            for node_val in node.findall("value"):
-                val.append(float(node_val.text))
-            geometry_topology.dimensions = np.array(val)
-
-        # Points
-        for xml_point_node in root.findall("Point"):
-            point = Point.from_xml_node(xml_point_node)
+    @staticmethod
+    def from_npz_file(npz_file_path):
+        """ Get a GeometryTopologyObject from a .npz file (see to_npz_file)
+        :param npz_file_path: file path
+        :return: GeometryTopologyData object
+        """
+        geometry_topology, point_columns, bounding_box_columns = GeometryTopologyData.read_npz_columns(npz_file_path)
+
+        coordinates = np.column_stack((point_columns["c1"], point_columns["c2"], point_columns["c3"])).tolist()
+        for i in range(len(point_columns["id"])):
+            point = Point(int(point_columns["chest_region_id"][i]), int(point_columns["chest_type_id"][i]),
+                          int(point_columns["feature_type_id"][i]), coordinates[i],
+                          description=point_columns["description"][i], timestamp=point_columns["timestamp"][i],
+                          user_name=point_columns["user_name"][i], machine_name=point_columns["machine_name"][i])
+            point.__id__ = int(point_columns["id"][i])
             geometry_topology.add_point(point, fill_auto_fields=False)
 
-        # BoundingBoxes
-        for xml_bb_node in root.findall("BoundingBox"):
-            bb = BoundingBox.from_xml_node(xml_bb_node)
-            geometry_topology.add_bounding_box(BoundingBox.from_xml_node(xml_bb_node), fill_auto_fields=False)
+        starts = np.column_stack((bounding_box_columns["start1"], bounding_box_columns["start2"],
+                                  bounding_box_columns["start3"])).tolist()
+        sizes = np.column_stack((bounding_box_columns["size1"], bounding_box_columns["size2"],
+                                 bounding_box_columns["size3"])).tolist()
+        for i in range(len(bounding_box_columns["id"])):
+            bb = BoundingBox(int(bounding_box_columns["chest_region_id"][i]),
+                             int(bounding_box_columns["chest_type_id"][i]),
+                             int(bounding_box_columns["feature_type_id"][i]), starts[i], sizes[i],
+                             description=bounding_box_columns["description"][i],
+                             timestamp=bounding_box_columns["timestamp"][i],
+                             user_name=bounding_box_columns["user_name"][i],
+                             machine_name=bounding_box_columns["machine_name"][i])
+            bb.__id__ = int(bounding_box_columns["id"][i])
+            geometry_topology.add_bounding_box(bb, fill_auto_fields=False)
 
         # Set the new seed so that every point (or bounding box) added with "add_point" has a bigger id
         geometry_topology.update_seed()
 
         return geometry_topology
 
+    @staticmethod
+    def __encode_string__(value):
+        """ Encode a string in utf-8 (empty string for None values)
+        :param value: string or None
+        :return: utf-8 bytes
+        """
+        if value is None:
+            return b""
+        if isinstance(value, bytes):
+            return value
+        return value.encode("utf-8")
+
     def get_hashtable(self):
         """
         Return a "hashtable" that will be a dictionary of hash:structure for every point or
@@ -286,6 +483,85 @@ class GeometryTopologyData(object):
         return "UNKNOWN"
 
 
+    def export_to_columns(self):
+        """
+        Export the points or the bounding boxes of this instance to columns (one numpy array for every field).
+        The arrays are preallocated and filled in a single pass over the structures.
+        :return: OrderedDict of column_name-numpy array, with 'id' as the first column. The coordinates are stored
+        in columns c1, c2, c3 (points) or start1, start2, start3, size1, size2, size3 (bounding boxes)
+        """
+        if len(self.points) > 0 and len(self.bounding_boxes) > 0:
+            raise NotImplementedError("This function can be used only for points or bounding boxes. This object contains both")
+
+        if len(self.bounding_boxes) > 0:
+            return GeometryTopologyData.__structures_to_columns__(self.bounding_boxes, True)
+        return GeometryTopologyData.__structures_to_columns__(self.points, False)
+
+    @staticmethod
+    def __structures_to_columns__(structures, is_bounding_box):
+        """ Build the columns of a list of structures (see export_to_columns)
+        :param structures: list of Point or BoundingBox objects
+        :param is_bounding_box: the structures are BoundingBox objects
+        :return: OrderedDict of column_name-numpy array
+        """
+        n = len(structures)
+
+        ids = np.empty(n, dtype=np.int)
+        coords = np.empty((n, 6 if is_bounding_box else 3), dtype=np.float)
+        chest_types = np.empty(n, dtype=np.int)
+        chest_regions = np.empty(n, dtype=np.int)
+        feature_types = np.empty(n, dtype=np.int)
+        descriptions = np.empty(n, dtype=object)
+        timestamps = np.empty(n, dtype=object)
+        user_names = np.empty(n, dtype=object)
+        machine_names = np.empty(n, dtype=object)
+        for i in range(n):
+            s = structures[i]
+            ids[i] = s.id
+            if is_bounding_box:
+                coords[i, :3] = s.start
+                coords[i, 3:] = s.size
+            else:
+                coords[i] = s.coordinate
+            chest_types[i] = s.chest_type
+            chest_regions[i] = s.chest_region
+            feature_types[i] = s.feature_type
+            descriptions[i] = s.description
+            timestamps[i] = s.timestamp
+            user_names[i] = s.user_name
+            machine_names[i] = s.machine_name
+
+        if is_bounding_box:
+            coord_columns = ['start1', 'start2', 'start3', 'size1', 'size2', 'size3']
+        else:
+            coord_columns = ['c1', 'c2', 'c3']
+        columns = collections.OrderedDict()
+        columns['id'] = ids
+        for i in range(len(coord_columns)):
+            columns[coord_columns[i]] = coords[:, i]
+        columns['chest_type_id'] = chest_types
+        columns['chest_region_id'] = chest_regions
+        columns['feature_type_id'] = feature_types
+        columns['description'] = descriptions
+        columns['timestamp'] = timestamps
+        columns['user_name'] = user_names
+        columns['machine_name'] = machine_names
+        return columns
+
+    def export_to_structured_array(self):
+        """
+        Export the points or the bounding boxes of this instance to a numpy structured array (one record per
+        structure). The common properties (coordinate system, spacing, etc.) are not included.
+        Contrary to export_to_dataframe, it does not need any module that is not available in 3D Slicer
+        :return: numpy structured array (see export_to_columns for the fields)
+        """
+        columns = self.export_to_columns()
+        dtype = [(name, column.dtype) for name, column in columns.items()]
+        array = np.empty(len(columns['id']), dtype=dtype)
+        for name, column in columns.items():
+            array[name] = column
+        return array
+
     def export_to_dataframe(self):
         """
         Export this instance info to a Pandas dataframe.
@@ -294,49 +570,31 @@ class GeometryTopologyData(object):
         """
         import pandas as pd
         from cip_python.common import ChestConventions
-        if len(self.points) > 0 and len(self.bounding_boxes) > 0:
-            raise NotImplementedError("This function can be used only for points or bounding boxes. This object contains both")
 
-        columns = ['chest_type_id', 'chest_type_name',
-                   'chest_region_id', 'chest_region_name',
-                   'feature_type_id', 'feature_type_name',
-                   'description', 'timestamp', 'user_name', 'machine_name',
-                   'coordinate_system', 'lps_to_ijk_transformation_matrix',
-                   'spacing', 'origin', 'dimensions'
-                   ]
-
-        if len(self.points) > 0:
-            # Export points
-            columns = ['c1', 'c2', 'c3'] + columns
-            df = pd.DataFrame(columns=columns)
-
-            for s in self.points:
-                df.loc[s.id] = [s.coordinate[0], s.coordinate[1], s.coordinate[2],
-                                s.chest_type, ChestConventions.GetChestTypeName(s.chest_type),
-                                s.chest_region, ChestConventions.GetChestRegionName(s.chest_region),
-                                s.feature_type, ChestConventions.GetImageFeatureName(s.feature_type),
-                                s.description, s.timestamp, s.user_name, s.machine_name,
-                                # Common properties
-                                self.coordinate_system_str(), self.lps_to_ijk_transformation_matrix_array,
-                                self.spacing, self.origin, self.dimensions]
-
-        elif len(self.points) > 0:
-            # Export bounding boxes
-            columns = ['start1', 'start2', 'start3', 'size1', 'size2', 'size3'] + columns
-            df = pd.DataFrame(columns=columns)
-
-            for s in self.bounding_boxes:
-                df.loc[s.id] = [s.start[0], s.start[1], s.start[2],
-                                s.size[0], s.size[1], s.size[2],
-                                s.chest_type, ChestConventions.GetChestTypeName(s.chest_type),
-                                s.chest_region, ChestConventions.GetChestRegionName(s.chest_region),
-                                s.feature_type, ChestConventions.GetImageFeatureName(s.feature_type),
-                                s.description, s.timestamp, s.user_name, s.machine_name,
-                                # Common properties
-                                self.coordinate_system_str(), self.lps_to_ijk_transformation_matrix_array,
-                                self.spacing, self.origin, self.dimensions]
-
-        df.index.name = 'id'
+        columns = self.export_to_columns()
+        ids = columns.pop('id')
+        n = len(ids)
+
+        name_functions = {'chest_type_id': ChestConventions.GetChestTypeName,
+                          'chest_region_id': ChestConventions.GetChestRegionName,
+                          'feature_type_id': ChestConventions.GetImageFeatureName}
+        data = collections.OrderedDict()
+        for name, column in columns.items():
+            data[name] = column
+            if name in name_functions:
+                # Get the names just once for every different value
+                values = column.tolist()
+                names = dict((value, name_functions[name](value)) for value in set(values))
+                data[name.replace('_id', '_name')] = np.array([names[value] for value in values], dtype=object)
+
+        # Common properties
+        data['coordinate_system'] = [self.coordinate_system_str()] * n
+        data['lps_to_ijk_transformation_matrix'] = [self.lps_to_ijk_transformation_matrix_array] * n
+        data['spacing'] = [self.spacing] * n
+        data['origin'] = [self.origin] * n
+        data['dimensions'] = [self.dimensions] * n
+
+        df = pd.DataFrame(data, index=pd.Index(ids, name='id'), columns=list(data.keys()))
         return df
 
     @classmethod
@@ -376,15 +634,19 @@ class GeometryTopologyData(object):
         elif value_int == GeometryTopologyData.LPS: return "LPS"
         return "UNKNOWN"
 
-    def __read_transformation_matrix__(self, root_xml):
-        """ Read a 16 elems vector in the xml and return a 4x4 list (or None if node not found)
-        :param root_xml: xml root node
-        :return: 4x4 list or None
+    @classmethod
+    def __read_vector__(cls, node):
+        """ Read the "value" elements of a xml node
+        :param node: xml node (Spacing, Origin...)
+        :return: numpy array of float values
+        """
+        return np.array([float(node_val.text) for node_val in node.findall("value")])
+
+    def __read_transformation_matrix__(self, node):
+        """ Read a 16 elems vector in the xml and return a 4x4 list
+        :param node: LPStoIJKTransformationMatrix xml node
+        :return: 4x4 list
         """
-        # Try to find the node first
-        node = root_xml.find("LPStoIJKTransformationMatrix")
-        if node is None:
-            return None
         m = []
         temp = []
         for coord in node.findall("value"):
@@ -0,0 +1,169 @@
+""" Index of the labels contained in a labelmap.
+
+The whole labelmap is read just once (numpy.unique with inverse + bincount per axis) to get, for every label value,
+the number of voxels in each slice of the three axes. Everything else (voxel count, bounding box, populated slices,
+centroid) is derived from these histograms, so after the construction every query is a lookup that does not need
+to visit the labelmap again.
+
+Example of use:
+index = LabelmapIndex(labelmap_array)
+for label in index.labels:
+    print "Label {0}: {1} voxels in slices {2}".format(label, index.count(label), index.slices(label))
+"""
+import numpy as np
+
+
+class LabelmapIndex(object):
+    def __init__(self, np_array, block_size=4000000):
+        """ Build the index for a 3D labelmap
+        :param np_array: numpy 3D array representing the labelmap (ZYX, as it comes from VTK)
+        :param block_size: approximate number of voxels processed at once (it bounds the memory used for the
+            temporary arrays)
+        """
+        if np_array.ndim != 3:
+            raise Exception("Only 3D labelmaps are allowed")
+        self.shape = np_array.shape
+
+        # Label value-list of 3 histograms (number of voxels of the label in every slice of every axis)
+        histograms = {}
+        slices_per_block = max(1, block_size // max(1, self.shape[1] * self.shape[2]))
+        for first in xrange(0, self.shape[0], slices_per_block):
+            block = np_array[first:first + slices_per_block]
+            values, inverse = self.__unique__(block)
+            num_values = len(values)
+            # Every (label, Z slice, Y slice) triplet gets its own bin. The Z and Y histograms are projections of it
+            positions = (np.arange(block.shape[0] * block.shape[1]) * num_values).reshape(block.shape[0],
+                                                                                          block.shape[1], 1)
+            h = np.bincount((inverse + positions).ravel(), minlength=num_values * block.shape[0] * block.shape[1])
+            h = h.reshape(block.shape[0], block.shape[1], num_values)
+            block_histograms = [h.sum(axis=1).T, h.sum(axis=0).T]
+            # Every (label, X slice) pair gets its own bin
+            positions = np.arange(block.shape[2]) * num_values
+            h = np.bincount((inverse + positions).ravel(), minlength=num_values * block.shape[2])
+            block_histograms.append(h.reshape(block.shape[2], num_values).T)
+            for i in xrange(num_values):
+                value = values[i].item()
+                if value not in histograms:
+                    histograms[value] = [np.zeros(self.shape[axis], np.int64) for axis in xrange(3)]
+                label_histograms = histograms[value]
+                label_histograms[0][first:first + block.shape[0]] += block_histograms[0][i]
+                label_histograms[1] += block_histograms[1][i]
+                label_histograms[2] += block_histograms[2][i]
+
+        self.labels = np.array(sorted(histograms.keys()), dtype=np_array.dtype)
+        # Row of every label in the histograms/counts arrays
+        self.__positions__ = dict((value, i) for i, value in enumerate(sorted(histograms.keys())))
+        # One (num_labels x num_slices) matrix for every axis
+        self.histograms = []
+        for axis in xrange(3):
+            if len(self.labels) > 0:
+                self.histograms.append(np.vstack([histograms[value][axis] for value in sorted(histograms.keys())]))
+            else:
+                self.histograms.append(np.zeros((0, self.shape[axis]), np.int64))
+
+        self.counts = self.histograms[0].sum(axis=1)
+        # First/last populated slice and centroid of every label in every axis
+        self.__first__ = []
+        self.__last__ = []
+        self.__centroids__ = []
+        for axis in xrange(3):
+            populated = self.histograms[axis] > 0
+            self.__first__.append(populated.argmax(axis=1))
+            self.__last__.append(self.shape[axis] - 1 - populated[:, ::-1].argmax(axis=1))
+            coords_sum = self.histograms[axis].dot(np.arange(self.shape[axis], dtype=np.int64))
+            self.__centroids__.append(coords_sum / np.maximum(self.counts, 1).astype(np.float64))
+
+    def __unique__(self, block, max_range=65536):
+        """ Equivalent to numpy.unique(block, return_inverse=True), but the inverse keeps the shape of the block.
+        Integer labelmaps are solved with a lookup table instead of sorting all the voxels
+        :param block: numpy 3D array
+        :param max_range: maximum range of values that will be solved with a lookup table
+        :return: tuple (sorted unique values, inverse)
+        """
+        if np.issubdtype(block.dtype, np.integer) and block.size > 0:
+            min_value = int(block.min())
+            max_value = int(block.max())
+            if max_value - min_value < max_range:
+                shifted = block.astype(np.intp)
+                shifted -= min_value
+                present = np.bincount(shifted.ravel(), minlength=max_value - min_value + 1) > 0
+                lookup = np.cumsum(present) - 1
+                values = (np.nonzero(present)[0] + min_value).astype(block.dtype)
+                return values, lookup[shifted]
+        values, inverse = np.unique(block.ravel(), return_inverse=True)
+        return values, inverse.reshape(block.shape)
+
+    def __contains__(self, label):
+        return label in self.__positions__
+
+    def __position__(self, label):
+        """ Row of a label in the histograms. Raise a KeyError if the label is not in the labelmap
+        :param label: label value
+        :return: int
+        """
+        return self.__positions__[label]
+
+    def count(self, label):
+        """ Number of voxels of a label
+        :param label: label value
+        :return: number of voxels (0 if the label is not in the labelmap)
+        """
+        if label not in self.__positions__:
+            return 0
+        return int(self.counts[self.__position__(label)])
+
+    def slices(self, label, axis=0):
+        """ Slices of an axis that contain the label
+        :param label: label value
+        :param axis: numpy axis (0=Z, 1=Y, 2=X)
+        :return: sorted numpy array of slice indexes (empty if the label is not in the labelmap)
+        """
+        if label not in self.__positions__:
+            return np.zeros(0, np.int64)
+        return np.nonzero(self.histograms[axis][self.__position__(label)])[0]
+
+    def slice_range(self, label, axis=0):
+        """ First and last slices of an axis that contain the label
+        :param label: label value
+        :param axis: numpy axis (0=Z, 1=Y, 2=X)
+        :return: tuple (first, last), both included. None if the label is not in the labelmap
+        """
+        if label not in self.__positions__:
+            return None
+        i = self.__position__(label)
+        return int(self.__first__[axis][i]), int(self.__last__[axis][i])
+
+    def bounding_box(self, label):
+        """ Bounding box of a label, that can be used directly to crop the labelmap (labelmap[bbox])
+        :param label: label value
+        :return: tuple of 3 slice objects (ZYX). None if the label is not in the labelmap
+        """
+        if label not in self.__positions__:
+            return None
+        i = self.__position__(label)
+        return tuple(slice(int(self.__first__[axis][i]), int(self.__last__[axis][i]) + 1) for axis in xrange(3))
+
+    def centroid(self, label):
+        """ Mean coordinates of the voxels of a label
+        :param label: label value
+        :return: numpy array with the coordinates (ZYX, float format). None if the label is not in the labelmap
+        """
+        if label not in self.__positions__:
+            return None
+        i = self.__position__(label)
+        return np.array([self.__centroids__[axis][i] for axis in xrange(3)])
+
+    def get_labelmap_slices(self, axis=0):
+        """ Get a dictionary with the slices where all the labels (greater than 0) are contained.
+        :param axis: numpy axis (0=Z, 1=Y, 2=X)
+        :return: dictionary of [label_Code: numpy array of slices]
+        """
+        return dict((label, self.slices(label, axis)) for label in self.__positions__ if label > 0)
+
+    def get_all_labels_slices(self, axis=0):
+        """ Slices of an axis that contain any label greater than 0
+        :param axis: numpy axis (0=Z, 1=Y, 2=X)
+        :return: sorted numpy array of slice indexes
+        """
+        rows = [self.__positions__[label] for label in self.__positions__ if label > 0]
+        return np.nonzero(self.histograms[axis][rows].sum(axis=0))[0]
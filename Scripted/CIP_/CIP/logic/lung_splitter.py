@@ -41,6 +41,190 @@ class LungSplitter:
         self.ls = sitk.LabelShapeStatisticsImageFilter()
 
     def execute(self, lm):
+        """ Split the whole lung region of a labelmap in left/right lungs (and thirds if split_thirds).
+        This is equivalent to execute_slice_by_slice, but the 2D connected components of all the slices are
+        labeled at once and the per-slice decisions are taken with numpy operations over the components.
+        The labeling needs scipy. If it is not available, execute_slice_by_slice is used instead
+        :param lm: SimpleITK labelmap
+        :return: SimpleITK labelmap with the same region/type values and the whole lung split
+        """
+        try:
+            import scipy.ndimage
+        except ImportError:
+            return self.execute_slice_by_slice(lm)
+
+        # Get Region/Type Information
+        lm_np = sitk.GetArrayFromImage(lm)
+        lm_region_np = lm_np & 255
+        lm_type_np = lm_np >> 8
+
+        # Work just on whole lung or Upper,Middle,Lower Thrids
+        wl_mask = (lm_region_np == self.WholeLung) | (lm_region_np == self.UpperThird) | \
+                  (lm_region_np == self.MiddleThrid) | (lm_region_np == self.LowerThird)
+
+        if not wl_mask.any():
+            # Nothing to do a filter should return the input lm
+            return lm
+
+        # Output holder copy
+        olm_np = lm_region_np.copy()
+        olm_np[wl_mask] = self.WholeLung
+
+        # Just the bounding box of the labelmap needs to be visited (the size threshold is relative to the
+        # whole slice anyway)
+        fg_np = olm_np != 0
+        bbox = self.__bounding_box__(fg_np)
+        fg_np = fg_np[bbox]
+        out_np = olm_np[bbox]
+
+        # Weight of every numpy axis (z, y, x) in the physical left-right coordinate
+        direction = np.array(lm.GetDirection()).reshape(3, 3)
+        spacing = np.array(lm.GetSpacing())
+        lr_weights = (direction[0] * spacing)[::-1]
+        shape = olm_np.shape
+
+        # Axial run
+        self.twoobject_label_planes(fg_np, out_np, 0, shape[1] * shape[2], lr_weights)
+        # Coronal run
+        self.twoobject_label_planes(fg_np, out_np, 1, shape[0] * shape[2], lr_weights)
+        # Do majority voting split along sagittal
+        self.allobjects_majority_voting_label_planes(fg_np, out_np, 2)
+
+        # Splitting in Thirds
+        if self.split_thirds is True:
+            self.split_thirds_planes(olm_np)
+
+        # Transfer type labels to output LM
+        olm_np[np.logical_not(wl_mask)] = lm_region_np[np.logical_not(wl_mask)]
+        olm_np = olm_np + (lm_type_np << 8)
+
+        olm = sitk.GetImageFromArray(olm_np)
+        olm.CopyInformation(lm)
+        return olm
+
+    def __bounding_box__(self, mask_np):
+        """ Bounding box of the non zero voxels of a 3D mask
+        :param mask_np: numpy 3D boolean array
+        :return: tuple of slices
+        """
+        bbox = []
+        for axis in xrange(3):
+            other_axes = tuple(a for a in xrange(3) if a != axis)
+            idx = np.nonzero(mask_np.any(axis=other_axes))[0]
+            bbox.append(slice(idx[0], idx[-1] + 1))
+        return tuple(bbox)
+
+    def __label_planes__(self, fg_np, axis, block_size=4000000):
+        """ Label the 2D connected components of all the planes perpendicular to an axis (the same components
+        that ConnectedComponentImageFilter finds in every slice, with face connectivity).
+        The planes are processed in blocks to bound the memory used by the labels
+        :param fg_np: numpy 3D boolean array
+        :param axis: cutting axis (numpy order)
+        :param block_size: approximate number of voxels of every block
+        :return: generator of (planes_slice, labels, n_objects), where labels is the labeled block with the
+            cutting axis moved to the first position (and the in-plane axes in their original order)
+        """
+        from scipy import ndimage
+        order = (axis,) + tuple(a for a in xrange(3) if a != axis)
+        fg_t = fg_np.transpose(order)
+        # Connectivity just inside the plane
+        structure = np.zeros((3, 3, 3), dtype=bool)
+        structure[1] = ndimage.generate_binary_structure(2, 1)
+        planes_per_block = max(1, block_size // max(1, fg_t.shape[1] * fg_t.shape[2]))
+        for first in xrange(0, fg_t.shape[0], planes_per_block):
+            planes = slice(first, min(first + planes_per_block, fg_t.shape[0]))
+            labels, n_objects = ndimage.label(fg_t[planes], structure)
+            yield planes, labels, n_objects
+
+    def twoobject_label_planes(self, fg_np, out_np, axis, cut_size, lr_weights):
+        """ Vectorized version of twoobject_label_cut for all the planes perpendicular to an axis.
+        In every plane, if the 2 biggest components are bigger than size_th, they are labeled as left/right
+        lungs depending on the position of their centroids
+        :param fg_np: numpy 3D boolean array with the voxels that must be considered
+        :param out_np: numpy 3D output labelmap (modified in place)
+        :param axis: cutting axis (numpy order)
+        :param cut_size: number of voxels of a whole slice
+        :param lr_weights: weight of every numpy axis in the physical left-right coordinate
+        """
+        order = (axis,) + tuple(a for a in xrange(3) if a != axis)
+        out_t = out_np.transpose(order)
+        for planes, labels, n_objects in self.__label_planes__(fg_np, axis):
+            if n_objects < 2:
+                continue
+            # Sizes and centroids of all the components
+            coords = np.nonzero(labels)
+            objects_labels = labels[coords]
+            sizes = np.bincount(objects_labels, minlength=n_objects + 1)
+            coords_sums = [np.bincount(objects_labels, c, n_objects + 1) for c in coords]
+            divisor = np.maximum(sizes, 1)
+            plane = np.round(coords_sums[0] / divisor).astype(np.int64)
+            # Left-right coordinate of the centroids (just the in-plane axes, the cutting axis is constant)
+            lr = (lr_weights[order[1]] * coords_sums[1] + lr_weights[order[2]] * coords_sums[2]) / divisor
+
+            # Biggest 2 components in every plane (relabel order: size, and object number for ties)
+            objects = np.arange(1, n_objects + 1)
+            objects = objects[np.lexsort((objects, -sizes[objects], plane[objects]))]
+            first_idx = np.nonzero(np.concatenate(([True], plane[objects[1:]] != plane[objects[:-1]])))[0]
+            first_idx = first_idx[first_idx + 1 < len(objects)]
+            first_idx = first_idx[plane[objects[first_idx]] == plane[objects[first_idx + 1]]]
+            obj1 = objects[first_idx]
+            obj2 = objects[first_idx + 1]
+
+            # Get Components that pass threshold
+            valid = (1.0 * sizes[obj1] / cut_size > self.size_th) & (1.0 * sizes[obj2] / cut_size > self.size_th)
+            obj1 = obj1[valid]
+            obj2 = obj2[valid]
+            one_is_left = lr[obj1] > lr[obj2]
+            if self.coordinate_system != 'lps':
+                one_is_left = np.logical_not(one_is_left)
+
+            table = np.zeros(n_objects + 1, dtype=out_np.dtype)
+            table[obj1] = np.where(one_is_left, self.LeftLabel, self.RightLabel)
+            table[obj2] = np.where(one_is_left, self.RightLabel, self.LeftLabel)
+            new_labels = table[labels]
+            np.copyto(out_t[planes], new_labels, where=new_labels != 0)
+
+    def allobjects_majority_voting_label_planes(self, fg_np, out_np, axis):
+        """ Vectorized version of allobjects_majority_voting_label_cut for all the planes perpendicular to an axis.
+        Every component of every plane is labeled as the lung (left/right) that has more voxels in it
+        :param fg_np: numpy 3D boolean array with the voxels that must be considered
+        :param out_np: numpy 3D output labelmap (modified in place)
+        :param axis: cutting axis (numpy order)
+        """
+        order = (axis,) + tuple(a for a in xrange(3) if a != axis)
+        out_t = out_np.transpose(order)
+        for planes, labels, n_objects in self.__label_planes__(fg_np, axis):
+            if n_objects == 0:
+                continue
+            out_block = out_t[planes]
+            left_sum = np.bincount(labels[out_block == self.LeftLabel], minlength=n_objects + 1)
+            right_sum = np.bincount(labels[out_block == self.RightLabel], minlength=n_objects + 1)
+            table = np.where(left_sum > right_sum, self.LeftLabel, self.RightLabel).astype(out_np.dtype)
+            table[0] = 0
+            np.copyto(out_block, table[labels], where=labels != 0)
+
+    def split_thirds_planes(self, olm_np):
+        """ Split the left and right lungs in upper/middle/lower thirds, using the cumulative number of voxels
+        of every lung along the axial slices
+        :param olm_np: numpy 3D output labelmap (modified in place)
+        """
+        right_mask = olm_np == self.RightLabel
+        left_mask = olm_np == self.LeftLabel
+        for mask, lower, middle, upper in (
+                (right_mask, self.RightLowerThrid, self.RightMiddleThrid, self.RightUpperThird),
+                (left_mask, self.LeftLowerThrid, self.LeftMiddleThird, self.LeftUpperThird)):
+            slice_vol = mask.sum(axis=(1, 2))
+            vol = slice_vol.sum()
+            # Volume of the lung in the previous slices
+            target_vol = np.cumsum(slice_vol) - slice_vol
+            slice_labels = np.where(target_vol <= vol // 3, lower,
+                                    np.where(target_vol <= 2 * vol // 3, middle, upper)).astype(olm_np.dtype)
+            olm_np[mask] = slice_labels[np.nonzero(mask)[0]]
+
+    def execute_slice_by_slice(self, lm):
+        """ Original implementation of execute, that runs the connected components filters slice by slice.
+        It is much slower than execute, but it's kept as a reference
+        """
         # Get Region/Type Information
         lm_np = sitk.GetArrayFromImage(lm)
         lm_region_np = lm_np & 255
@@ -0,0 +1,133 @@
+""" Local disk cache of the volumes generated by expensive operations (filtered CTs, labelmaps, etc.).
+
+Every entry is identified by a hash of the input image (voxels and geometry) and the operation with all its
+parameters, so a result is reused only when exactly the same operation is applied to exactly the same volume.
+The entries are stored as nrrd files in a directory with a maximum size. When the size is exceeded, the least
+recently used entries are removed (the modification time of a file is updated every time that it is read).
+
+Example of use:
+cache = VolumeCache("/tmp/cache", max_size=2 * 1024 ** 3)
+key = cache.get_key(image, "Median", {"radius": [1, 1, 1]})
+result = cache.get(key)
+if result is None:
+    result = sitk.Median(image, [1, 1, 1])
+    cache.put(key, result)
+"""
+import os
+import hashlib
+import logging
+import SimpleITK as sitk
+
+
+class VolumeCache(object):
+    # Extension of the files in the cache
+    EXTENSION = ".nrrd"
+
+    def __init__(self, directory, max_size=2 * 1024 ** 3):
+        """
+        :param directory: directory where the volumes will be stored (created if it does not exist)
+        :param max_size: maximum size of the cache in bytes (None for no limit)
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def get_key(image, operation, parameters=None):
+        """ Unique key for the result of an operation over a SimpleITK image
+        :param image: SimpleITK image (input of the operation)
+        :param operation: name of the operation (ex: "Median")
+        :param parameters: dictionary with all the parameters that modify the result of the operation
+        :return: hexadecimal string
+        """
+        h = hashlib.sha1()
+        h.update(repr((operation, sorted(parameters.items()) if parameters else None)).encode("utf-8"))
+        h.update(repr((image.GetPixelIDValue(), image.GetNumberOfComponentsPerPixel(), image.GetSize(),
+                       image.GetSpacing(), image.GetOrigin(), image.GetDirection())).encode("utf-8"))
+        h.update(sitk.GetArrayFromImage(image).data)
+        return h.hexdigest()
+
+    def __path__(self, key):
+        return os.path.join(self.directory, key + self.EXTENSION)
+
+    def __contains__(self, key):
+        return os.path.isfile(self.__path__(key))
+
+    def get(self, key):
+        """ Read a volume from the cache
+        :param key: key of the entry (see get_key)
+        :return: SimpleITK image or None if the key is not in the cache
+        """
+        path = self.__path__(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            image = sitk.ReadImage(path)
+        except RuntimeError as ex:
+            logging.warning("Volume cache entry {} could not be read and it will be removed: {}".format(path, ex))
+            self.remove(key)
+            return None
+        # Mark the entry as recently used
+        os.utime(path, None)
+        return image
+
+    def put(self, key, image, use_compression=False):
+        """ Store a volume in the cache and remove the least recently used entries if the cache is full
+        :param key: key of the entry (see get_key)
+        :param image: SimpleITK image
+        :param use_compression: compress the file (recommended for labelmaps)
+        """
+        path = self.__path__(key)
+        # Write to a temporary file first, so that an interrupted write never leaves a corrupt entry
+        temp_path = "{}.{}.tmp{}".format(path, os.getpid(), self.EXTENSION)
+        sitk.WriteImage(image, temp_path, use_compression)
+        if os.path.isfile(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+        self.evict()
+
+    def remove(self, key):
+        """ Remove an entry from the cache (if it exists)
+        :param key: key of the entry
+        """
+        path = self.__path__(key)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def entries(self):
+        """ All the files in the cache
+        :return: list of (path, size, modification time) tuples, sorted from the least to the most recently used
+        """
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(self.EXTENSION) and ".tmp" not in file_name:
+                path = os.path.join(self.directory, file_name)
+                stat = os.stat(path)
+                entries.append((path, stat.st_size, stat.st_mtime))
+        entries.sort(key=lambda entry: entry[2])
+        return entries
+
+    def size(self):
+        """ Total size of the cache in bytes """
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self):
+        """ Remove the least recently used entries until the size of the cache is not bigger than max_size """
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total_size = sum(entry[1] for entry in entries)
+        for path, size, _ in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError as ex:
+                logging.warning("Volume cache entry {} could not be removed: {}".format(path, ex))
+
+    def clear(self):
+        """ Remove all the entries of the cache """
+        for path, _, _ in self.entries():
+            os.remove(path)
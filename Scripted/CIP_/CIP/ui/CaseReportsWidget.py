@@ -1,4 +1,5 @@
 import os, time, pprint, logging
+import sqlite3
 from collections import OrderedDict
 
 import qt, ctk, slicer
@@ -132,10 +133,21 @@ class CaseReportsWidget(EventsTrigger):
         :param kwargs:
         :return: 0 = OK; 1 = Warning
         """
+        return self.insertRows([kwargs])
+
+    def insertRows(self, rows):
+        """ Save several records at once (all of them are stored in a single transaction).
+        Ex: self.reportsWidget.insertRows([
+                {"caseId": caseName, "regionType": "WholeLung"},
+                {"caseId": caseName, "regionType": "RightLung"}])
+        :param rows: list of dictionaries of column-value
+        :return: 0 = OK; 1 = Warning
+        """
         s = self.additionalComentsTextEdit.toPlainText()
         s = s.replace("\r\n", "  ").replace("\n", "  ")
-        kwargs[self.logic.ADDITIONAL_COMMENTS_COLUMN_KEY] = s
-        return self.logic.insertRow(**kwargs)
+        for row in rows:
+            row[self.logic.ADDITIONAL_COMMENTS_COLUMN_KEY] = s
+        return self.logic.insertRows(rows)
 
     def enableSaveButton(self, enabled):
         """ Enable/Disable the "Save" button
@@ -380,50 +392,51 @@ class CaseReportsLogic(object):
         :param kwargs: dictionary of values
         :return: 0 = OK; 1=Warning (when there are columns not expected)
         """
+        return self.insertRows([kwargs])
+
+    def insertRows(self, rows):
+        """ Save several rows of information in the current db file that stores the data.
+        The new rows are appended to the db in a single transaction, so that the rows that were already stored
+        are not written again.
+        Each entry can contain ColumnKey-Value or ColumnDescription-Value
+        :param rows: list of dictionaries of values
+        :return: 0 = OK; 1=Warning (when there are columns not expected)
+        """
         result = 0
         # Check that we have all the "columns"
-        for key in kwargs:
-            if not self.hasColumn(key):
-                logging.warning("WARNING: Column {} is not included in the list of columns and therefore it will NOT be saved".
-                      format(key))
-                result = 1
+        for kwargs in rows:
+            for key in kwargs:
+                if not self.hasColumn(key):
+                    logging.warning("WARNING: Column {} is not included in the list of columns and therefore it will NOT be saved".
+                          format(key))
+                    result = 1
 
-        rowIndex = self.tableNode.AddEmptyRow()
         table = self.tableNode.GetTable()
-
-        # Temporarily rename the columns so that the db saves the normalized names columns
+        # Column index for each one of the column keys (the table columns follow the order of the columns dictionary)
         keys = self.columnsDict.keys()
-        for i in range(table.GetNumberOfColumns()):
-            # # Sanity check
-            # assert table.GetColumn(i).GetName() == self.columnsDict[keys[i]], "Column mismatch (table=={}; Dict=={})".format(
-            #     table.GetColumn(i).GetName(), self.columnsDict[keys[i]])
-            # Change the name
-            table.GetColumn(i).SetName(keys[i])
-        table.Modified()
+        columnIndexes = dict((keys[i], i) for i in range(min(len(keys), table.GetNumberOfColumns())))
+        timestamp = time.strftime("%Y/%m/%d %H:%M:%S")
 
+        firstRowIndex = self.tableNode.GetNumberOfRows()
         try:
-            for key, value in kwargs.iteritems():
-                if value is not None:
-                    for i in range(0, len(self.columnsDict)):
-                        colName = table.GetColumnName(i)
-                        if colName == self.TIMESTAMP_COLUMN_KEY:
-                            self.tableNode.SetCellText(rowIndex, i, time.strftime("%Y/%m/%d %H:%M:%S"))
-                        elif colName == self.getColumnKey(key):
-                            value = str(value)  # The table node only allows text
-                            self.tableNode.SetCellText(rowIndex, i, value)
-                            break
+            for kwargs in rows:
+                rowIndex = self.tableNode.AddEmptyRow()
+                if self.TIMESTAMP_COLUMN_KEY in columnIndexes:
+                    self.tableNode.SetCellText(rowIndex, columnIndexes[self.TIMESTAMP_COLUMN_KEY], timestamp)
+                for key, value in kwargs.iteritems():
+                    colKey = self.getColumnKey(key)
+                    if value is not None and colKey in columnIndexes and colKey != self.TIMESTAMP_COLUMN_KEY:
+                        value = str(value)  # The table node only allows text
+                        self.tableNode.SetCellText(rowIndex, columnIndexes[colKey], value)
         except Exception as ex:
-            # Remove the row
-            self.tableNode.RemoveRow(rowIndex)
+            # Remove the rows
+            while self.tableNode.GetNumberOfRows() > firstRowIndex:
+                self.tableNode.RemoveRow(firstRowIndex)
             raise ex
 
         # Persist the info
-        self.tableStorageNode.WriteData(self.tableNode)
-        # Return to the original column names
-        for i in range(table.GetNumberOfColumns()):
-            # Change the name
-            table.GetColumn(i).SetName(self.columnsDict[keys[i]])
-        table.Modified()
+        if not self._appendRowsToDb_(firstRowIndex):
+            self._writeAllRowsToDb_()
         # Notify GUI
         self.tableNode.Modified()
         if result == 1:
@@ -431,6 +444,62 @@ class CaseReportsLogic(object):
             logging.warning("Current list of columns descriptions: {}".format(self._columnDescriptions_))
         return result
 
+    def _setColumnNames_(self, useKeys):
+        """ Rename the columns of the table node.
+        The table node displays the column descriptions, but the db stores the normalized names (column keys)
+        :param useKeys: True to use the column keys, False to use the column descriptions
+        """
+        table = self.tableNode.GetTable()
+        keys = self.columnsDict.keys()
+        for i in range(table.GetNumberOfColumns()):
+            table.GetColumn(i).SetName(keys[i] if useKeys else self.columnsDict[keys[i]])
+        table.Modified()
+
+    def _writeAllRowsToDb_(self):
+        """ Write the whole table node in the db (the db table is created again)
+        """
+        # Temporarily rename the columns so that the db saves the normalized names columns
+        self._setColumnNames_(True)
+        try:
+            self.tableStorageNode.WriteData(self.tableNode)
+        finally:
+            # Return to the original column names
+            self._setColumnNames_(False)
+
+    def _appendRowsToDb_(self, firstRowIndex):
+        """ Insert in the db the rows of the table node starting in firstRowIndex, in a single transaction.
+        This is only possible when the db table already exists with the same columns and it contains exactly the
+        rows that are previous to firstRowIndex (otherwise the whole table must be written again)
+        :param firstRowIndex: index of the first row that has not been stored yet
+        :return: True if the rows were inserted, False otherwise
+        """
+        if not os.path.isfile(self._dbFilePath_):
+            return False
+        keys = self.columnsDict.keys()[:self.tableNode.GetNumberOfColumns()]
+        numRows = self.tableNode.GetNumberOfRows()
+        connection = sqlite3.connect(self._dbFilePath_)
+        try:
+            cursor = connection.cursor()
+            cursor.execute('PRAGMA table_info("{}")'.format(self._dbTableName_))
+            dbColumns = [row[1] for row in cursor.fetchall()]
+            if dbColumns != keys:
+                return False
+            cursor.execute('SELECT COUNT(*) FROM "{}"'.format(self._dbTableName_))
+            if cursor.fetchone()[0] != firstRowIndex:
+                return False
+            values = [[self.tableNode.GetCellText(row, col) for col in range(len(keys))]
+                      for row in range(firstRowIndex, numRows)]
+            with connection:
+                connection.executemany('INSERT INTO "{}" ({}) VALUES ({})'.format(
+                    self._dbTableName_, ", ".join('"{}"'.format(key) for key in keys), ", ".join("?" * len(keys))),
+                    values)
+            return True
+        except sqlite3.Error as ex:
+            logging.warning("The rows could not be appended to the db ({}). The whole table will be written".format(ex))
+            return False
+        finally:
+            connection.close()
+
     def exportCSV(self, filePath):
         """ Export the information stored in the current csv file that is storing the data to a better
         formatted csv file in a location chosen by the user
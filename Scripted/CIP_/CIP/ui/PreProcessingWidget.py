@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
-import csv, os, time, pprint
-from __main__ import qt, ctk, slicer
+import csv, os, time, pprint, logging
+from collections import OrderedDict
+from __main__ import vtk, qt, ctk, slicer
+import SimpleITK as sitk
+import sitkUtils
 
 from CIP.logic.SlicerUtil import SlicerUtil
+from CIP.logic.volume_cache import VolumeCache
 
 class PreProcessingWidget():
     
@@ -294,11 +298,98 @@ class PreProcessingWidget():
 #############################
 ##
 class PreProcessingLogic(object):
+    # Available backends to run the filters
+    # CLI: run the CLI modules (the volumes are written to temporary files and processed in a new process)
+    BACKEND_CLI = "CLI"
+    # SITK: run the equivalent SimpleITK filters in the Slicer process (the volumes are read/written in memory)
+    BACKEND_SITK = "SimpleITK"
 
-    def __init__(self, moduleName):
+    def __init__(self, moduleName, backend=BACKEND_SITK, useCache=True):
+        """
+        :param moduleName: name of the module that uses the logic
+        :param backend: BACKEND_SITK or BACKEND_CLI
+        :param useCache: reuse the filtered CTs and labelmaps that were already generated for the same volume
+            (see createCache)
+        """
         self.__moduleName__ = moduleName
-           
+        self.backend = backend
+        # Wall time (seconds) of every stage of the last operation
+        self.stageTimes = OrderedDict()
+        self.cache = self.createCache() if useCache else None
+
+    @staticmethod
+    def createCache():
+        """ Create the disk cache for the filtered CTs and the labelmaps.
+        The directory and the maximum size (MB) are read from the Slicer settings (CIP/VolumesCacheDirectory and
+        CIP/VolumesCacheMaxSizeMB), that are initialized with the default values the first time
+        :return: VolumeCache object
+        """
+        directory = SlicerUtil.settingGetOrSetDefault("CIP", "VolumesCacheDirectory",
+                                                      os.path.join(SlicerUtil.getSettingsDataFolder(), "VolumesCache"))
+        maxSizeMB = int(SlicerUtil.settingGetOrSetDefault("CIP", "VolumesCacheMaxSizeMB", 4096))
+        return VolumeCache(directory, max_size=maxSizeMB * 1024 ** 2)
+
+    def __runStage__(self, stageName, function, *args, **kwargs):
+        """ Run a stage of an operation and store its wall time in stageTimes
+        :param stageName: name of the stage
+        :param function: function to invoke
+        :return: result of the function
+        """
+        t = time.time()
+        result = function(*args, **kwargs)
+        self.stageTimes[stageName] = time.time() - t
+        logging.info("{0}: {1} ({2}) took {3:.2f}s".format(self.__moduleName__, stageName, self.backend,
+                                                          self.stageTimes[stageName]))
+        return result
+
+    def __readImage__(self, node):
+        """ Get a SimpleITK image from a volume node in the scene (in memory, no files are used)
+        :param node: volume node
+        :return: SimpleITK image
+        """
+        return sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(node.GetName()))
+
+    def __writeImage__(self, image, node):
+        """ Copy a SimpleITK image to a volume node in the scene (in memory, no files are used)
+        :param image: SimpleITK image
+        :param node: volume node
+        """
+        sitk.WriteImage(image, sitkUtils.GetSlicerITKReadWriteAddress(node.GetName()))
+
     def filterCT(self,input_ct,method,s_rad=[3,3,3],c_rad=[5,5,5],noisePower=3.0,h=0.8,ps=2.0,n_rad=[1,1,1],sigma=1.0):
+        """ Filter a CT (the result is stored in the same node).
+        The NLM filter is always run with the CLI (there is no equivalent filter in SimpleITK).
+        If the same filter was already applied to the same volume, the result is read from the cache
+        :param input_ct: CT volume node
+        :param method: NLM, Median or Gaussian
+        """
+        self.stageTimes = OrderedDict()
+        # Parameters that modify the result of every filter (cache key)
+        if method=='NLM':
+            filterParameters = {"noisePower": noisePower, "s_rad": list(s_rad), "c_rad": list(c_rad), "h": h,
+                                "ps": ps}
+        elif method=='Median':
+            filterParameters = {"n_rad": list(n_rad)}
+        elif method=='Gaussian':
+            filterParameters = {"sigma": sigma}
+        else:
+            return
+        # The SimpleITK and CLI filters may not give exactly the same result (NLM always runs with the CLI)
+        filterParameters["backend"] = self.BACKEND_CLI if method == 'NLM' else self.backend
+
+        image = None
+        filtered = None
+        cacheKey = None
+        if self.cache is not None or (self.backend == self.BACKEND_SITK and method != 'NLM'):
+            image = self.__runStage__("Read CT", self.__readImage__, input_ct)
+        if self.cache is not None:
+            cacheKey = self.__runStage__("Hash CT", self.cache.get_key, image, "filterCT_" + method,
+                                         filterParameters)
+            cached = self.__runStage__("Read cache", self.cache.get, cacheKey)
+            if cached is not None:
+                self.__runStage__("Write CT", self.__writeImage__, cached, input_ct)
+                return
+
         if method=='NLM': # NLM Filter
             generatenlmfilteredimage = slicer.modules.generatenlmfilteredimage
             parameters = {
@@ -310,33 +401,63 @@ class PreProcessingLogic(object):
                       "iH": h,
                       "iPs": ps,
                       }
-            slicer.cli.run(generatenlmfilteredimage,None,parameters,wait_for_completion=True)
+            self.__runStage__("NLM filter", slicer.cli.run, generatenlmfilteredimage, None, parameters,
+                              wait_for_completion=True)
 
         elif method=='Median': # Median Filter
-            medianimagefilter = slicer.modules.medianimagefilter
-            parameters = {
-                        "inputVolume": input_ct.GetID(),
-                        "outputVolume": input_ct.GetID(),
-                        "neighborhood": n_rad, 
-                        }
-            slicer.cli.run(medianimagefilter,None,parameters,wait_for_completion=True)
+            if self.backend == self.BACKEND_SITK:
+                filtered = self.__runStage__("Median filter", sitk.Median, image, [int(r) for r in n_rad])
+                self.__runStage__("Write CT", self.__writeImage__, filtered, input_ct)
+            else:
+                medianimagefilter = slicer.modules.medianimagefilter
+                parameters = {
+                            "inputVolume": input_ct.GetID(),
+                            "outputVolume": input_ct.GetID(),
+                            "neighborhood": n_rad,
+                            }
+                self.__runStage__("Median filter", slicer.cli.run, medianimagefilter, None, parameters,
+                                  wait_for_completion=True)
         elif method=='Gaussian':
-            gaussianblurimagefilter = slicer.modules.gaussianblurimagefilter       
-            parameters = {
-                      "inputVolume": input_ct.GetID(),
-                      "outputVolume": input_ct.GetID(),
-                      "sigma": sigma,
-                      }
-            slicer.cli.run(gaussianblurimagefilter,None,parameters,wait_for_completion=True)
+            if self.backend == self.BACKEND_SITK:
+                # Same filter as the CLI. The output keeps the pixel type of the input
+                filtered = self.__runStage__("Gaussian filter", sitk.SmoothingRecursiveGaussian, image, sigma)
+                filtered = sitk.Cast(filtered, image.GetPixelID())
+                self.__runStage__("Write CT", self.__writeImage__, filtered, input_ct)
+            else:
+                gaussianblurimagefilter = slicer.modules.gaussianblurimagefilter
+                parameters = {
+                          "inputVolume": input_ct.GetID(),
+                          "outputVolume": input_ct.GetID(),
+                          "sigma": sigma,
+                          }
+                self.__runStage__("Gaussian filter", slicer.cli.run, gaussianblurimagefilter, None, parameters,
+                                  wait_for_completion=True)
+
+        if cacheKey is not None:
+            if filtered is None:
+                # The CLI wrote the result in the node
+                filtered = self.__readImage__(input_ct)
+            self.__runStage__("Write cache", self.cache.put, cacheKey, filtered)
 
     def generatePartialLungLabelMap(self, input_ct, label_map, speed):
         """Create partial lung label map from input ct image
         :params input_ct: ct image, speed: fast or slow creation, labelNode: node for 
         created labelmap
         """
+        self.stageTimes = OrderedDict()
+        cacheKey = None
+        if self.cache is not None:
+            image = self.__runStage__("Read CT", self.__readImage__, input_ct)
+            cacheKey = self.__runStage__("Hash CT", self.cache.get_key, image, "partialLungLabelMap",
+                                         {"speed": speed, "backend": self.backend})
+            cached = self.__runStage__("Read cache", self.cache.get, cacheKey)
+            if cached is not None:
+                self.__runStage__("Write labelmap", self.__writeImage__, cached, label_map)
+                return
+
         inputNode = input_ct
         if speed=='Fast':          
-            inputNode = self.downsampleCT(input_ct)
+            inputNode = self.__runStage__("Downsample CT", self.downsampleCT, input_ct)
                       
         generatepartiallunglabelmap = slicer.modules.generatepartiallunglabelmap
 #        labelNode = slicer.mrmlScene.AddNode(slicer.vtkMRMLLabelMapVolumeNode())
@@ -345,11 +466,16 @@ class PreProcessingLogic(object):
               "ctFileName": inputNode.GetID(),
               "outputLungMaskFileName": label_map.GetID(),	  
               }
-        slicer.cli.run(generatepartiallunglabelmap,None,parameters,wait_for_completion=True)
+        self.__runStage__("Partial lung labelmap", slicer.cli.run, generatepartiallunglabelmap, None, parameters,
+                          wait_for_completion=True)
     
         if speed=='Fast':
-            label_map = self.upsampleLabel(label_map)
+            label_map = self.__runStage__("Upsample labelmap", self.upsampleLabel, label_map, referenceNode=input_ct)
             slicer.mrmlScene.RemoveNode(inputNode)
+
+        if cacheKey is not None:
+            self.__runStage__("Write cache", self.cache.put, cacheKey, self.__readImage__(label_map),
+                              use_compression=True)
         
     def downsampleCT(self, input_image):
         """Downsample input image by factor 2
@@ -362,9 +488,16 @@ class PreProcessingLogic(object):
         newSpacing.append(oldSpacing[1]*2)
         newSpacing.append(oldSpacing[2])
     
-        resamplescalarvolume = slicer.modules.resamplescalarvolume
         upsampledNode = slicer.mrmlScene.AddNode(slicer.vtkMRMLScalarVolumeNode())
-    
+
+        if self.backend == self.BACKEND_SITK:
+            # A name is needed to access the node in memory
+            upsampledNode.SetName(slicer.mrmlScene.GenerateUniqueName(input_image.GetName() + "_downsampled"))
+            image = self.__readImage__(input_image)
+            self.__writeImage__(self.__resample__(image, newSpacing, sitk.sitkLinear), upsampledNode)
+            return upsampledNode
+
+        resamplescalarvolume = slicer.modules.resamplescalarvolume
         parameters = {
               "outputPixelSpacing": newSpacing,
               "InputVolume": input_image.GetID(),
@@ -373,9 +506,11 @@ class PreProcessingLogic(object):
         slicer.cli.run(resamplescalarvolume,None,parameters,wait_for_completion=True)    
         return upsampledNode
         
-    def upsampleLabel(self, labelMap):
+    def upsampleLabel(self, labelMap, referenceNode=None):
         """Upsample input image by factor 2
         :params input_image: image to downsample
+        :param referenceNode: volume whose geometry will be used for the result (SimpleITK backend only). When
+        it is specified, the labelmap is resampled exactly to the grid of this volume (ex: the original CT)
         """
         
         oldSpacing = labelMap.GetSpacing()
@@ -384,7 +519,19 @@ class PreProcessingLogic(object):
         newSpacing.append(oldSpacing[0]/2)
         newSpacing.append(oldSpacing[1]/2)
         newSpacing.append(oldSpacing[2])
-    
+
+        if self.backend == self.BACKEND_SITK:
+            image = self.__readImage__(labelMap)
+            if referenceNode is not None:
+                # Only the geometry of the reference volume is needed (its voxels are not copied)
+                size, origin, spacing, direction = self.__getGrid__(referenceNode)
+                upsampled = sitk.Resample(image, size, sitk.Transform(), sitk.sitkNearestNeighbor, origin, spacing,
+                                          direction, 0, image.GetPixelID())
+            else:
+                upsampled = self.__resample__(image, newSpacing, sitk.sitkNearestNeighbor)
+            self.__writeImage__(upsampled, labelMap)
+            return labelMap
+
         resamplescalarvolume = slicer.modules.resamplescalarvolume
     
         parameters = {
@@ -394,5 +541,32 @@ class PreProcessingLogic(object):
               "interpolationType":'nearestNeighbor',
               }
         slicer.cli.run(resamplescalarvolume,None,parameters,wait_for_completion=True)
-    
-        return labelMap
\ No newline at end of file
+        return labelMap
+
+    def __getGrid__(self, node):
+        """ Geometry of a volume node in the SimpleITK (LPS) coordinate system, read from the node properties
+        :param node: volume node
+        :return: tuple (size, origin, spacing, direction) that can be passed to sitk.Resample
+        """
+        ijkToRAS = vtk.vtkMatrix4x4()
+        node.GetIJKToRASDirectionMatrix(ijkToRAS)
+        # RAS to LPS: the sign of the first two coordinates is changed
+        signs = (-1, -1, 1)
+        direction = [signs[i] * ijkToRAS.GetElement(i, j) for i in range(3) for j in range(3)]
+        origin = [signs[i] * node.GetOrigin()[i] for i in range(3)]
+        size = [int(d) for d in node.GetImageData().GetDimensions()]
+        return size, origin, list(node.GetSpacing()), direction
+
+    def __resample__(self, image, newSpacing, interpolator):
+        """ Resample a SimpleITK image to a new spacing, keeping the origin, direction and physical extent
+        (equivalent to the ResampleScalarVolume CLI)
+        :param image: SimpleITK image
+        :param newSpacing: output spacing
+        :param interpolator: SimpleITK interpolator (ex: sitk.sitkLinear)
+        :return: resampled SimpleITK image (same pixel type)
+        """
+        oldSize = image.GetSize()
+        oldSpacing = image.GetSpacing()
+        newSize = [max(1, int(round(oldSize[i] * oldSpacing[i] / newSpacing[i]))) for i in range(3)]
+        return sitk.Resample(image, newSize, sitk.Transform(), interpolator, image.GetOrigin(), newSpacing,
+                             image.GetDirection(), 0, image.GetPixelID())
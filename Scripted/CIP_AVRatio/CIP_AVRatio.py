@@ -883,6 +883,7 @@ class CIP_AVRatioWidget(ScriptedLoadableModuleWidget):
 
             avRatioLong = avRatioShort = avRationMean = 0
 
+            rows = []
             # AIRWAY
             for rr in range(self.rulers_ID+1):
                 longAirwayRuler, shortAirwayRuler = self.logic.getRulerNodesForStructure(self.logic.AIRWAY, rr)
@@ -938,7 +939,7 @@ class CIP_AVRatioWidget(ScriptedLoadableModuleWidget):
                 if airwayShortMm != 0 and vesselShortMm != 0:
                     avRatioShort = round(airwayShortMm / vesselShortMm, 2)
 
-                self.reportsWidget.insertRow(
+                rows.append(dict(
                     caseId=caseName,
                     airwayLongDiameterMm=str(airwayLongMm),
                     vesselLongDiameterMm=str(vesselLongMm),
@@ -973,7 +974,8 @@ class CIP_AVRatioWidget(ScriptedLoadableModuleWidget):
                     v2_short_r=round(v2_short[0], 2) if v2_short is not None else '',
                     v2_short_a=round(v2_short[1], 2) if v2_short is not None else '',
                     v2_short_s=round(v2_short[2], 2) if v2_short is not None else ''
-                )
+                ))
+            self.reportsWidget.insertRows(rows)
             qt.QMessageBox.information(slicer.util.mainWindow(), 'Data saved', 'The data were saved successfully')
             # self.removeRulers()
             self.activeRuler = None
@@ -1002,34 +1004,37 @@ class CIP_AVRatioWidget(ScriptedLoadableModuleWidget):
             reportsWidgetLogic = self.reportsWidget.logic
             tableNode = reportsWidgetLogic.tableNode
 
+            # Rows of this case
+            rows = [rr for rr in range(tableNode.GetNumberOfRows()) if tableNode.GetCellText(rr, 0) == caseName]
+            rasLocations = np.zeros((len(rows), 3))
+            for i in range(len(rows)):
+                rasLocationAL = [float(tableNode.GetCellText(rows[i], 10)), float(tableNode.GetCellText(rows[i], 11)),
+                                 float(tableNode.GetCellText(rows[i], 12))]
+                rasLocationAS = [float(tableNode.GetCellText(rows[i], 13)), float(tableNode.GetCellText(rows[i], 14)),
+                                 float(tableNode.GetCellText(rows[i], 15))]
+                rasLocations[i] = (np.asarray(rasLocationAL) + np.asarray(rasLocationAS)) / 2.0
+            # Convert all the locations to IJK at once
+            ijkLocations = Util.ras_to_ijk_array(scalarVolumeNode, rasLocations, convert_to_int=True)
+
             pdfRows = """"""
-            for rr in range(tableNode.GetNumberOfRows()):
-                if tableNode.GetCellText(rr, 0) == caseName:
-                    dateCol = tableNode.GetNumberOfColumns() - 2
-                    date = tableNode.GetCellText(rr, dateCol).split(' ')[0]
-                    rasLocationAL = [float(tableNode.GetCellText(rr, 10)), float(tableNode.GetCellText(rr, 11)),
-                                     float(tableNode.GetCellText(rr, 12))]
-                    rasLocationAS = [float(tableNode.GetCellText(rr, 13)), float(tableNode.GetCellText(rr, 14)),
-                                     float(tableNode.GetCellText(rr, 15))]
-
-                    rasLocation = (np.asarray(rasLocationAL) + np.asarray(rasLocationAS)) / 2.0
-                    rasLocation = rasLocation.tolist()
-
-                    ijkCoords = self.RAStoIJK(scalarVolumeNode, rasLocation)
-                    ijkLocation = str([int(ijkCoords[0]), int(ijkCoords[1]), int(ijkCoords[2])])
-
-                    meanAirwayDiameter = float(tableNode.GetCellText(rr, 7))
-                    meanVesselDiameter = float(tableNode.GetCellText(rr, 8))
-                    meanRatio = float(tableNode.GetCellText(rr, 9))
-                    # ratio = airwayDiameter / vesselDiameter
-
-                    pdfRows += """<tr>
-                      <td align="center">{} </td>
-                      <td align="center">{} </td>
-                      <td align="center">{:.2f} </td>
-                      <td align="center">{:.2f} </td>
-                      <td align="center">{:.2f} </td>
-                    </tr>""".format(date, ijkLocation, meanAirwayDiameter, meanVesselDiameter, meanRatio)
+            for i in range(len(rows)):
+                rr = rows[i]
+                dateCol = tableNode.GetNumberOfColumns() - 2
+                date = tableNode.GetCellText(rr, dateCol).split(' ')[0]
+                ijkLocation = str(ijkLocations[i].tolist())
+
+                meanAirwayDiameter = float(tableNode.GetCellText(rr, 7))
+                meanVesselDiameter = float(tableNode.GetCellText(rr, 8))
+                meanRatio = float(tableNode.GetCellText(rr, 9))
+                # ratio = airwayDiameter / vesselDiameter
+
+                pdfRows += """<tr>
+                  <td align="center">{} </td>
+                  <td align="center">{} </td>
+                  <td align="center">{:.2f} </td>
+                  <td align="center">{:.2f} </td>
+                  <td align="center">{:.2f} </td>
+                </tr>""".format(date, ijkLocation, meanAirwayDiameter, meanVesselDiameter, meanRatio)
 
             values["@@TABLE_ROWS@@"] = pdfRows
 
@@ -1050,15 +1055,6 @@ class CIP_AVRatioWidget(ScriptedLoadableModuleWidget):
     def reportPrinted(self, reportPath):
         Util.openFile(reportPath)
 
-    def RAStoIJK(self, volumeNode, rasCoords):
-        """ Transform a list of RAS coords in IJK for a volume
-        :return: list of IJK coordinates
-        """
-        rastoijk = vtk.vtkMatrix4x4()
-        volumeNode.GetRASToIJKMatrix(rastoijk)
-        rasCoords.append(1.0)
-        return list(rastoijk.MultiplyPoint(rasCoords))
-
     def getSliceWidget(self):
         activeWindow = self.getActiveWindow()
         lm = slicer.app.layoutManager()
@@ -1346,21 +1342,15 @@ class CIP_AVRatioLogic(ScriptedLoadableModuleLogic):
 
     def RAStoIJK(self, volumeNode, rasCoords):
         """ Transform a list of RAS coords in IJK for a volume
-        :return: list of IJK coordinates
+        :return: list of IJK coordinates (homogeneous)
         """
-        rastoijk=vtk.vtkMatrix4x4()
-        volumeNode.GetRASToIJKMatrix(rastoijk)
-        rasCoords.append(1)
-        return list(rastoijk.MultiplyPoint(rasCoords))
+        return Util.ras_to_ijk(volumeNode, rasCoords, convert_to_int=False) + [1]
 
     def IJKtoRAS(self, volumeNode, ijkCoords):
         """ Transform a list of IJK coords in RAS for a volume
-        :return: list of RAS coordinates
+        :return: list of RAS coordinates (homogeneous)
         """
-        ijktoras=vtk.vtkMatrix4x4()
-        volumeNode.GetIJKToRASMatrix(ijktoras)
-        ijkCoords.append(1)
-        return list(ijktoras.MultiplyPoint(ijkCoords))
+        return Util.ijk_to_ras(volumeNode, ijkCoords) + [1]
 
 
 class CIP_AVRatioTest(ScriptedLoadableModuleTest):
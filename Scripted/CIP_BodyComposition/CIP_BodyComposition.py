@@ -687,17 +687,10 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
 
     def __sliceChecking__(self, labelMapNode, forceRefresh=False):
         """Calculate the slices that contain the different label maps for a certain labelmap node Id.
-        If forceRefresh == false, it will try to return the value from cache"""
+        The labelmap is indexed again only when it has been modified since the last time.
+        If forceRefresh == True, the index will be rebuilt anyway"""
         volumeID = labelMapNode.GetID()
-
-        if self.labelMapSlices.has_key(volumeID) and not forceRefresh:
-            # The values were already calculated for this volume
-            # if SlicerUtil.IsDevelopment: print("Slices for volume {0} already calculated".format(volumeID))
-            return
-
-        # Calculate the values
-        # if SlicerUtil.IsDevelopment: print("Calculating slices for Volume " + volumeID)
-        self.labelMapSlices[volumeID] = self.logic.getLabelmapSlices(labelMapNode)
+        self.labelMapSlices[volumeID] = self.logic.getLabelmapSlices(labelMapNode, forceRefresh)
 
     def getCurrentGrayscaleNode(self):
         """Get the grayscale node that is currently active in the widget"""
@@ -726,8 +719,8 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
         self.progressBar.labelText = "Starting analysis of BodyComposition structures."
         self.progressBar.show()
 
-        # Refresh the calculation of the slices
-        self.__sliceChecking__(self.getCurrentLabelMapNode(), forceRefresh=True)
+        # Refresh the calculation of the slices (only if the labelmap was modified)
+        self.__sliceChecking__(self.getCurrentLabelMapNode())
         self.statisticsTableModel = qt.QStandardItemModel()
         self.tableView.setModel(self.statisticsTableModel)
         self.tableView.verticalHeader().visible = False
@@ -962,7 +955,7 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
                     qt.QMessageBox.warning(slicer.util.mainWindow(), 'Warning',
                                        'There are no any values in the labelmap. Please press "Refresh labelmap info" button.')
                     return
-            slices = np.unique(np.concatenate([x for x in allLabels.values()]))
+            slices = Util.get_labelmap_index(labelmap).get_all_labels_slices()
 
         # Get the tolerance as an error factor when converting RAS-IJK. The value will depend on
         # the transformation matrix for this node
@@ -1193,11 +1186,13 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
         slicer.app.settings().setValue(settingName, settingDefaultValue)
         return settingDefaultValue
 
-    def getLabelmapSlices(self, labelmapNode):
+    def getLabelmapSlices(self, labelmapNode, forceRefresh=False):
         """For each label map, get the slices where it appears. Store the result in labelmapSlices object
-        (it will be used later for statistics)"""
-        numpyArray = slicer.util.array(labelmapNode.GetID())
-        self.labelmapSlices = Util.get_labelmap_slices(numpyArray)
+        (it will be used later for statistics).
+        The labelmap index is cached, so the labelmap is only read again when it has been modified (or if
+        forceRefresh == True)"""
+        self.labelmapIndex = Util.get_labelmap_index(labelmapNode, forceRefresh)
+        self.labelmapSlices = self.labelmapIndex.get_labelmap_slices()
         return self.labelmapSlices
 
     def calculateStatistics(self, grayscaleNode, labelNode, labelmapSlices=None, callbackStepFunction=None):
@@ -1214,6 +1209,7 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
 
         if labelmapSlices:
             self.labelmapSlices = labelmapSlices
+            self.labelmapIndex = Util.get_labelmap_index(labelNode)
         else:
             self.getLabelmapSlices(labelNode)
 
@@ -1231,13 +1227,14 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
             if callbackStepFunction:
                 callbackStepFunction("Calculating {0}...".format(label))
 
-                # Use just the slices that contain data
-            if self.labelmapSlices.has_key(labelCode):
-                trimmedIntensityArray = intensityArray[self.labelmapSlices[labelCode], :, :]
-                trimmedLabelmapArray = labelMapArray[self.labelmapSlices[labelCode], :, :]
+                # Use just the bounding box of the label (it is obtained from the index, without reading the labelmap)
+            if labelCode in self.labelmapIndex:
+                boundingBox = self.labelmapIndex.bounding_box(labelCode)
+                trimmedIntensityArray = intensityArray[boundingBox]
+                trimmedLabelmapArray = labelMapArray[boundingBox]
                 stat = self.performAnalysisForItem(labelCode, trimmedIntensityArray, trimmedLabelmapArray, spacing[0],
                                                    spacing[1])
-                stat.NumSlices = len(self.labelmapSlices[labelCode])
+                stat.NumSlices = len(self.labelmapIndex.slices(labelCode))
             else:
                 # The label is not present in the label map. Return empty stats object
                 stat = StatsWrapper()
@@ -2,6 +2,7 @@ import os, sys, string
 from collections import OrderedDict
 import unittest
 import vtk, qt, ctk, slicer
+from vtk.util import numpy_support
 import numpy as np
 import SimpleITK as sitk
 import sitkUtils
@@ -121,6 +122,15 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
         self.labelScores = []
         self.selectedLabels = {}
         self.modelNodes = []
+        # Cropped volume and lesions of the last update. The lesions are updated incrementally when the thresholds
+        # change, so the scores can be updated while the threshold slider is dragged
+        self.scoringSession = CalciumScoringSession()
+        # All the lesions are extracted in a single marching cubes pass and displayed in a single model, colored by
+        # the LesionLabel point array (row of the lesion in the table + 1). Set to False to create one model
+        # per lesion
+        self.useSingleLesionsModel = True
+        self.lesionsModelNode = None
+        self.lesionsColorNode = None
         self.voxelVolume = 1.
         self.sx = 1.
         self.sy = 1.
@@ -130,6 +140,11 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
         self.xy = []
 
         self.summary_reports=["Agatston Score","Mass Score","Volume"]
+        # Agatston score of the lesions in every coronary territory (only if a territories labelmap is selected)
+        self.summary_reports.extend(["Agatston Score " + t for t in CalciumScoringSession.TERRITORIES])
+        self.territoriesNode = None
+        self.territoriesKey = None
+        self.territoriesArray = None
 
         self.labelScores = dict()
         self.totalScores=dict()
@@ -184,6 +199,24 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
         self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onVolumeChanged)
         self.volumeNode = self.inputSelector.currentNode()
         
+        #
+        # coronary territories selector
+        #
+        self.territoriesSelector = slicer.qMRMLNodeComboBox()
+        self.territoriesSelector.nodeTypes = ( ("vtkMRMLLabelMapVolumeNode"), "" )
+        self.territoriesSelector.addEnabled = False
+        self.territoriesSelector.removeEnabled = False
+        self.territoriesSelector.noneEnabled = True
+        self.territoriesSelector.showHidden = False
+        self.territoriesSelector.showChildNodeTypes = False
+        self.territoriesSelector.setMRMLScene( slicer.mrmlScene )
+        self.territoriesSelector.setCurrentNode(None)
+        self.territoriesSelector.setToolTip( "Optional labelmap with the coronary territories ({0}), in the same space "
+                                             "as the target volume".format(", ".join(
+            "{0}={1}".format(i + 1, t) for i, t in enumerate(CalciumScoringSession.TERRITORIES))))
+        parametersFormLayout.addRow("Coronary Territories: ", self.territoriesSelector)
+        self.territoriesSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onTerritoriesChanged)
+
         #
         # calcification type
         #
@@ -294,6 +327,9 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
         slicer.mrmlScene.AddNode(self.croppedNode)
         self.labelsNode=slicer.vtkMRMLLabelMapVolumeNode()
         slicer.mrmlScene.AddNode(self.labelsNode)
+        self.croppedTerritoriesNode=slicer.vtkMRMLLabelMapVolumeNode()
+        self.croppedTerritoriesNode.SetHideFromEditors(1)
+        slicer.mrmlScene.AddNode(self.croppedTerritoriesNode)
         
         if self.inputSelector.currentNode():
             self.onVolumeChanged(self.inputSelector.currentNode())
@@ -343,8 +379,6 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
 
     def updateModels(self):
         for n in range(0, len(self.selectedLabelList)):
-            model = self.modelNodes[n]
-            dnode = model.GetDisplayNode()
             rgb = [1,0,0]
             if self.selectedLabelList[n] == 1:
                 rgb = self.selectedRGB
@@ -352,7 +386,12 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
                 ct=slicer.mrmlScene.GetNodeByID('vtkMRMLColorTableNodeLabels')
                 ct.GetLookupTable().GetColor(n+1,rgb)
 
-            dnode.SetColor(rgb)
+            if self.lesionsModelNode is not None:
+                # Every lesion has its own entry in the color table of the model
+                self.lesionsColorNode.SetColor(n+1, rgb[0], rgb[1], rgb[2], 1.0)
+            else:
+                dnode = self.modelNodes[n].GetDisplayNode()
+                dnode.SetColor(rgb)
 
 
     def setInteractor(self):
@@ -413,21 +452,25 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
             self.roiNode.SetDisplayVisibility(0)
         #self.createModels()
 
+    def onTerritoriesChanged(self, value):
+        self.territoriesNode = self.territoriesSelector.currentNode()
+        self.updateLesions()
+
     def onMinSizeChanged(self, value):
         self.MinimumLesionSize = value
-        #self.createModels()
+        self.updateLesions()
 
     def onMaxSizeChanged(self, value):
         self.MaximumLesionSize = value
-        #self.createModels()
+        self.updateLesions()
 
     def onThresholdMinChanged(self, value):
         self.ThresholdMin = value
-        #self.createModels()
+        self.updateLesions()
 
     def onThresholdMaxChanged(self, value):
         self.ThresholdMax = value
-        #self.createModels()
+        self.updateLesions()
 
     def onROIChangedEvent(self, observee, event):
         pass
@@ -436,6 +479,13 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
     def onUpdate(self):
         self.createModels()
 
+    def updateLesions(self):
+        """ Update the lesions and the scores for the current parameters, if they have already been computed once
+        (ex: while a slider is dragged)
+        """
+        if self.scoringSession.thresholds is not None and self.calcificationType == 0:
+            self.createModels()
+
     def deleteModels(self):
         for m in self.modelNodes:
             m.SetAndObservePolyData(None)
@@ -443,6 +493,13 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
             slicer.mrmlScene.RemoveNode(m)
         self.modelNodes = []
         self.selectedLabels = {}
+        if self.lesionsModelNode is not None:
+            self.lesionsModelNode.SetAndObservePolyData(None)
+            slicer.mrmlScene.RemoveNode(self.lesionsModelNode.GetDisplayNode())
+            slicer.mrmlScene.RemoveNode(self.lesionsModelNode)
+            slicer.mrmlScene.RemoveNode(self.lesionsColorNode)
+            self.lesionsModelNode = None
+            self.lesionsColorNode = None
 
     def PickProp(self, object, event):  
         print "PICK"
@@ -454,6 +511,12 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
     def processEvent(self,observee,event):
         print "PICK EVENT", event
         self.xy = self.iren.GetEventPosition()
+        if self.lesionsModelNode is not None:
+            # Single model. The lesion is read from the label array of the picked cell
+            label = self.getLesionLabelAtPosition(self.xy)
+            if label is not None:
+                print "picked label = ", label
+            return
         self.propPicker.PickProp(self.xy[0], self.xy[1], self.renderer)
         pickedActor = self.propPicker.GetActor()
         if pickedActor:
@@ -461,6 +524,22 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
             label = self.selectedLabels[poly]
             print "picked label = ", label
 
+    def getLesionLabelAtPosition(self, xy):
+        """ Lesion of the single lesions model that is displayed in a position of the 3D view
+        :param xy: display position
+        :return: label of the lesion (the same as in the labels volume) or None if there is no lesion there
+        """
+        picker = vtk.vtkCellPicker()
+        picker.SetTolerance(0.0005)
+        if not picker.Pick(xy[0], xy[1], 0, self.renderer) or picker.GetCellId() < 0:
+            return None
+        dataSet = picker.GetDataSet()
+        lesionLabels = dataSet.GetPointData().GetArray("LesionLabel") if dataSet else None
+        if lesionLabels is None:
+            return None
+        row = int(lesionLabels.GetValue(dataSet.GetCell(picker.GetCellId()).GetPointId(0))) - 1
+        return self.selectedLabels.get(row)
+
     def onSaveReport(self):
         """ Save the current values in a persistent csv file
         """
@@ -483,18 +562,6 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
         qt.QMessageBox.information(slicer.util.mainWindow(), 'Data saved', 'The data were saved successfully')
 
 
-    def computeDensityScore(self, d):
-        score = 0
-        if d > 129 and d < 200:
-            score = 1
-        elif d < 300:
-            score = 2
-        elif d < 400:
-            score = 3
-        else:
-            score = 4
-        return score
-
     def createModels(self):
         self.deleteModels()
         for sr in self.summary_reports:
@@ -503,49 +570,62 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
         if self.calcificationType == 0 and self.volumeNode and self.roiNode:
             #print 'in Heart Create Models'
 
-            slicer.vtkSlicerCropVolumeLogic().CropVoxelBased(self.roiNode, self.volumeNode, self.croppedNode)
-            croppedImage    = sitk.ReadImage( sitkUtils.GetSlicerITKReadWriteAddress(self.croppedNode.GetName()))
-            thresholdImage  = sitk.BinaryThreshold(croppedImage,self.ThresholdMin, self.ThresholdMax, 1, 0)
-            connectedCompImage  =sitk.ConnectedComponent(thresholdImage, True)
-            relabelImage  =sitk.RelabelComponent(connectedCompImage)
-            labelStatFilter =sitk.LabelStatisticsImageFilter()
-            labelStatFilter.Execute(croppedImage, relabelImage)
-            if relabelImage.GetPixelID() != sitk.sitkInt16:
-                relabelImage = sitk.Cast( relabelImage, sitk.sitkInt16 )
+            # The ROI is cropped again only if the ROI or the volume changed
+            roiKey = (tuple(self.roiNode.GetXYZ()), tuple(self.roiNode.GetRadiusXYZ()), self.volumeNode.GetID(),
+                      self.volumeNode.GetMTime(), self.volumeNode.GetImageData().GetMTime())
+            if not self.scoringSession.isImage(roiKey):
+                slicer.vtkSlicerCropVolumeLogic().CropVoxelBased(self.roiNode, self.volumeNode, self.croppedNode)
+                croppedImage = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(self.croppedNode.GetName()))
+                self.scoringSession.setImage(croppedImage, roiKey)
+            # Just the lesions affected by the threshold change are computed again
+            self.scoringSession.update(self.ThresholdMin, self.ThresholdMax)
+            labelsArray = self.scoringSession.getLabelsArray(np.int16)
+            relabelImage = sitk.GetImageFromArray(labelsArray)
+            relabelImage.CopyInformation(self.scoringSession.image)
             sitk.WriteImage( relabelImage, sitkUtils.GetSlicerITKReadWriteAddress(self.labelsNode.GetName()))
 
-            nLabels = labelStatFilter.GetNumberOfLabels()
-            #print "Number of labels = ", nLabels
             self.totalScore = 0
             count = 0
             #Computation of the score follows this paper:
             #C. H McCollough, Radiology, 243(2), 2007
-            
-            for n in range(0,nLabels):
-                max = labelStatFilter.GetMaximum(n)
-                mean = labelStatFilter.GetMean(n)
-                size = labelStatFilter.GetCount(n)
+            #Agatston score is \sum_slices area_slice * density_score(max_slice), computed for all the lesions
+            #(and territories) at once
+            lesions = self.scoringSession.getLesions()
+            agatstonScores = CalciumScoringSession.computeAgatstonScores(labelsArray, self.scoringSession.array,
+                                self.sx*self.sy, len(lesions), self.getCroppedTerritories(roiKey),
+                                len(CalciumScoringSession.TERRITORIES))
+
+            for n, size, max, mean in lesions:
                 volume = size*self.voxelVolume
                 if volume > self.MaximumLesionSize:
                     continue
 
                 if volume < self.MinimumLesionSize:
-                    nLabels = n+1
                     break
-                
-                density_score = self.computeDensityScore(max)
 
-                #Agatston score is \sum_i area_i * density_score_i
-                #For now we assume that all the plaques have the same density score
-                score = size*(self.sx*self.sy)*density_score
+                score = agatstonScores[n].sum()
                 
                 mass_score = mean*volume
 
                 #print "label = ", n, "  max = ", max, " score = ", score, " voxels = ", size
                 self.labelScores["Agatston Score"].append(score)
+                for i, territory in enumerate(CalciumScoringSession.TERRITORIES):
+                    self.labelScores["Agatston Score " + territory].append(agatstonScores[n, i + 1])
                 self.labelScores["Mass Score"].append(mass_score)
                 self.labelScores["Volume"].append(volume)
                 self.selectedLabelList.append(0)
+
+                ct=slicer.mrmlScene.GetNodeByID('vtkMRMLColorTableNodeLabels')
+                rgb = [0,0,0]
+                ct.GetLookupTable().GetColor(count+1,rgb)
+                self.addLabel(count, rgb, [score,mass_score,volume,mean,max])
+
+                if self.useSingleLesionsModel:
+                    # The surfaces are extracted at once when all the lesions are known
+                    self.selectedLabels[count] = n
+                    count = count+1
+                    continue
+
                 self.marchingCubes.SetInputData(self.labelsNode.GetImageData())
                 self.marchingCubes.SetValue(0, n)
                 self.marchingCubes.Update()
@@ -567,27 +647,368 @@ class CIP_CalciumScoringWidget(ScriptedLoadableModuleWidget):
                 modelNode.AddAndObserveDisplayNodeID(dnode.GetID())
                 modelNode.SetAndObservePolyData(poly)
 
-                ct=slicer.mrmlScene.GetNodeByID('vtkMRMLColorTableNodeLabels')
-                rgb = [0,0,0]
-                ct.GetLookupTable().GetColor(count+1,rgb)
                 dnode.SetColor(rgb)
                 #Enable Slice intersection
                 dnode.SetSliceDisplayMode(0)
                 dnode.SetSliceIntersectionVisibility(1)
 
-                self.addLabel(count, rgb, [score,mass_score,volume,mean,max])
                 count = count+1
 
                 self.modelNodes.append(modelNode)
                 self.selectedLabels[poly] = n
                 #a = slicer.util.array(tn.GetID())
                 #sa = sitk.GetImageFromArray(a)
+            if self.useSingleLesionsModel and count > 0:
+                self.createLesionsModel([self.selectedLabels[row] for row in range(count)])
             for sr in self.summary_reports:
                 self.scoreField[sr].setText(self.totalScores[sr])
         else:
             print "not implemented"
 
 
+    def getCroppedTerritories(self, roiKey):
+        """ Territories labelmap cropped with the current ROI. It is cropped again only if the ROI or the
+        labelmap changed
+        :param roiKey: key of the current ROI and volume
+        :return: numpy array (ZYX) with the same shape as the cropped volume or None if there is no territories
+            labelmap
+        """
+        if self.territoriesNode is None:
+            return None
+        key = roiKey + (self.territoriesNode.GetID(), self.territoriesNode.GetMTime(),
+                        self.territoriesNode.GetImageData().GetMTime())
+        if key != self.territoriesKey:
+            self.territoriesKey = key
+            slicer.vtkSlicerCropVolumeLogic().CropVoxelBased(self.roiNode, self.territoriesNode,
+                                                               self.croppedTerritoriesNode)
+            self.territoriesArray = sitk.GetArrayFromImage(sitk.ReadImage(
+                sitkUtils.GetSlicerITKReadWriteAddress(self.croppedTerritoriesNode.GetName())))
+            if self.territoriesArray.shape != self.scoringSession.array.shape:
+                self.territoriesArray = None
+                qt.QMessageBox.warning(slicer.util.mainWindow(), "Coronary territories",
+                                       "The territories labelmap does not have the same geometry as the volume")
+        return self.territoriesArray
+
+    def createLesionsModel(self, labels):
+        """ Extract the surfaces of all the lesions in a single discrete marching cubes pass and display them in a
+        single model node. Every point of the model has a LesionLabel value (row of the lesion in the table + 1)
+        that is used to color the lesions (lesionsColorNode) and to know the lesion that the user picks.
+        The lesions come from a fully connected components filter, so two different lesions never share a
+        marching cubes cell and every point of the surface belongs to a single lesion
+        :param labels: labels of the lesions in the labels volume, in the same order as the rows of the table
+        """
+        labelsImage = self.labelsNode.GetImageData()
+        dims = labelsImage.GetDimensions()
+        labelsArray = numpy_support.vtk_to_numpy(labelsImage.GetPointData().GetScalars()).reshape(dims[2], dims[1],
+                                                                                                 dims[0])
+        # Label --> row + 1 (0 for the background and the lesions that are not in the table)
+        rows = np.zeros(max(int(labelsArray.max()), max(labels)) + 1, np.int32)
+        rows[labels] = np.arange(1, len(labels) + 1)
+        lesionsArray = rows[labelsArray]
+
+        # Single pass over the mask of all the lesions
+        maskImage = vtk.vtkImageData()
+        maskImage.SetDimensions(dims)
+        maskImage.GetPointData().SetScalars(numpy_support.numpy_to_vtk((lesionsArray > 0).astype(np.uint8).ravel(),
+                                                                       deep=1))
+        self.marchingCubes.SetInputData(maskImage)
+        self.marchingCubes.SetNumberOfContours(1)
+        self.marchingCubes.SetValue(0, 1)
+        self.marchingCubes.Update()
+        surface = self.marchingCubes.GetOutput()
+
+        # Every point is in the middle of an edge between a voxel of a lesion and a background voxel (or on a voxel
+        # of the lesion), so the lesion is the maximum of the rows of the two voxels of the edge (IJK coordinates)
+        lesionLabels = np.zeros(surface.GetNumberOfPoints(), np.int32)
+        if surface.GetNumberOfPoints() > 0:
+            points = numpy_support.vtk_to_numpy(surface.GetPoints().GetData())
+            maxIndex = np.array(dims) - 1
+            low = np.clip(np.floor(points).astype(np.int64), 0, maxIndex)
+            high = np.clip(np.ceil(points).astype(np.int64), 0, maxIndex)
+            lesionLabels = np.maximum(lesionsArray[low[:, 2], low[:, 1], low[:, 0]],
+                                      lesionsArray[high[:, 2], high[:, 1], high[:, 0]])
+
+        self.transformPolyData.SetInputData(surface)
+        mat = vtk.vtkMatrix4x4()
+        self.labelsNode.GetIJKToRASMatrix(mat)
+        trans = vtk.vtkTransform()
+        trans.SetMatrix(mat)
+        self.transformPolyData.SetTransform(trans)
+        self.transformPolyData.Update()
+        poly = vtk.vtkPolyData()
+        poly.DeepCopy(self.transformPolyData.GetOutput())
+        lesionLabelsArray = numpy_support.numpy_to_vtk(lesionLabels, deep=1, array_type=vtk.VTK_INT)
+        lesionLabelsArray.SetName("LesionLabel")
+        poly.GetPointData().AddArray(lesionLabelsArray)
+        poly.GetPointData().SetActiveScalars("LesionLabel")
+
+        # One color for every lesion (same colors as the table)
+        ct = slicer.mrmlScene.GetNodeByID('vtkMRMLColorTableNodeLabels')
+        self.lesionsColorNode = slicer.vtkMRMLColorTableNode()
+        self.lesionsColorNode.SetTypeToUser()
+        self.lesionsColorNode.SetName(slicer.mrmlScene.GenerateUniqueName("CalciumLesionsColors"))
+        self.lesionsColorNode.SetHideFromEditors(1)
+        self.lesionsColorNode.SetNumberOfColors(len(labels) + 1)
+        self.lesionsColorNode.SetColor(0, "Background", 0, 0, 0, 0)
+        rgb = [0,0,0]
+        for row in range(len(labels)):
+            ct.GetLookupTable().GetColor(row+1,rgb)
+            self.lesionsColorNode.SetColor(row+1, "Lesion {0}".format(row+1), rgb[0], rgb[1], rgb[2], 1.0)
+        slicer.mrmlScene.AddNode(self.lesionsColorNode)
+
+        self.lesionsModelNode = slicer.vtkMRMLModelNode()
+        self.lesionsModelNode.SetName(slicer.mrmlScene.GenerateUniqueName("CalciumLesions"))
+        slicer.mrmlScene.AddNode(self.lesionsModelNode)
+        dnode = slicer.vtkMRMLModelDisplayNode()
+        slicer.mrmlScene.AddNode(dnode)
+        self.lesionsModelNode.AddAndObserveDisplayNodeID(dnode.GetID())
+        self.lesionsModelNode.SetAndObservePolyData(poly)
+        dnode.SetActiveScalarName("LesionLabel")
+        dnode.SetAndObserveColorNodeID(self.lesionsColorNode.GetID())
+        dnode.SetAutoScalarRange(0)
+        dnode.SetScalarRange(0, len(labels))
+        dnode.SetScalarVisibility(1)
+        #Enable Slice intersection
+        dnode.SetSliceDisplayMode(0)
+        dnode.SetSliceIntersectionVisibility(1)
+
+#
+# CalciumScoringSession
+#
+
+class CalciumScoringSession(object):
+    """ Connected components (lesions) of a thresholded volume that are updated incrementally when the thresholds
+    change.
+    The thresholded sets are nested: when a threshold moves, only the voxels between the old and the new thresholds
+    change, so only the lesions that contain (or touch) those voxels can change. The rest of the lesions and their
+    statistics are kept, and the connected components are computed again just for the region of the changed
+    lesions. The result is the same as running BinaryThreshold + ConnectedComponent (fully connected) +
+    RelabelComponent + LabelStatistics over the whole volume.
+
+    Example of use:
+    session = CalciumScoringSession()
+    session.setImage(croppedImage)
+    for thresholdMin in (130, 140, 150):
+        session.update(thresholdMin, 1000)
+        for label, count, maximum, mean in session.getLesions(): ...
+    """
+    # Minimum HU of the density weights 1, 2, 3 and 4 of the Agatston score (weight 0 below the first one)
+    DENSITY_THRESHOLDS = (130, 200, 300, 400)
+    # Coronary territories (the label of every territory in a territories labelmap is its position + 1)
+    TERRITORIES = ("LM", "LAD", "LCX", "RCA")
+
+    def __init__(self):
+        self.key = None
+        self.image = None
+        self.array = None
+        self.__reset__()
+
+    def __reset__(self):
+        self.thresholds = None
+        self.mask = None
+        # Internal lesion id of every voxel (0=background)
+        self.lesionIds = None
+        # Lesion id-[count, maximum, sum, first voxel (raster index), bounding box (tuple of slices)]
+        self.lesions = {}
+        self.nextId = 1
+        self.__sortedIds__ = None
+
+    def setImage(self, image, key=None):
+        """ Set the image that will be thresholded. All the lesions are discarded
+        :param image: SimpleITK image (ex: the cropped CT)
+        :param key: any object that identifies the image (see isImage)
+        """
+        self.key = key
+        self.image = image
+        self.array = sitk.GetArrayFromImage(image)
+        self.__reset__()
+
+    def isImage(self, key):
+        """ True if the current image was set with this key (so it does not need to be set again)
+        :param key: key of the image
+        """
+        return self.image is not None and self.key == key
+
+    def update(self, thresholdMin, thresholdMax):
+        """ Update the lesions for new thresholds (both included)
+        :param thresholdMin: minimum threshold
+        :param thresholdMax: maximum threshold
+        """
+        if self.thresholds == (thresholdMin, thresholdMax):
+            return
+        newMask = (self.array >= thresholdMin) & (self.array <= thresholdMax)
+        if self.mask is None:
+            # First time: all the volume must be processed
+            self.lesionIds = np.zeros(self.array.shape, np.int32)
+            self.__relabelRegion__(newMask, tuple(slice(0, s) for s in self.array.shape), set())
+        else:
+            changed = newMask != self.mask
+            changedBox = self.__boundingBox__(changed, margin=1)
+            if changedBox is not None:
+                # Lesions that contain a changed voxel or that are next to a new voxel
+                dilated = self.__dilate__(changed[changedBox])
+                affected = set(np.unique(self.lesionIds[changedBox][dilated]).tolist())
+                affected.discard(0)
+                # Region that contains the changed voxels and all the affected lesions
+                region = list(changedBox)
+                for lesionId in affected:
+                    box = self.lesions[lesionId][4]
+                    region = [slice(min(region[i].start, box[i].start), max(region[i].stop, box[i].stop))
+                              for i in xrange(3)]
+                self.__relabelRegion__(newMask, tuple(region), affected)
+        self.mask = newMask
+        self.thresholds = (thresholdMin, thresholdMax)
+        self.__sortedIds__ = None
+
+    def __relabelRegion__(self, newMask, region, affected):
+        """ Remove the affected lesions and label again the voxels of the region that are not in other lesions.
+        Different lesions are never adjacent, so the components of the voxels that are not in the unaffected
+        lesions are exactly the new lesions
+        :param newMask: thresholded volume (boolean numpy array)
+        :param region: tuple of slices
+        :param affected: set of ids of the lesions that must be computed again
+        """
+        lesionIds = self.lesionIds[region]
+        if len(affected) > 0:
+            isAffected = np.zeros(self.nextId, np.bool_)
+            isAffected[list(affected)] = True
+            affectedVoxels = isAffected[lesionIds]
+            lesionIds[affectedVoxels] = 0
+            for lesionId in affected:
+                del self.lesions[lesionId]
+        freeVoxels = newMask[region] & (lesionIds == 0)
+        if not freeVoxels.any():
+            return
+        components = sitk.ConnectedComponent(sitk.GetImageFromArray(freeVoxels.astype(np.uint8)), True)
+        componentsArray = sitk.GetArrayFromImage(components)
+        # Statistics of the new components from their voxels only (sorted by component and then in raster order)
+        positions = np.nonzero(componentsArray)
+        componentIds = componentsArray[positions]
+        order = np.argsort(componentIds, kind="mergesort")
+        componentIds = componentIds[order]
+        positions = [(p[order] + region[i].start) for i, p in enumerate(positions)]
+        values = self.array[tuple(positions)]
+        starts = np.nonzero(np.concatenate(([True], componentIds[1:] != componentIds[:-1])))[0]
+        counts = np.diff(np.append(starts, len(componentIds)))
+        maximums = np.maximum.reduceat(values, starts)
+        sums = np.add.reduceat(values.astype(np.float64), starts)
+        firstVoxels = np.ravel_multi_index([p[starts] for p in positions], self.array.shape)
+        boxStarts = [np.minimum.reduceat(p, starts) for p in positions]
+        boxStops = [np.maximum.reduceat(p, starts) + 1 for p in positions]
+        numComponents = len(starts)
+        lesionIds[componentsArray > 0] = componentsArray[componentsArray > 0] + (self.nextId - 1)
+        for i in xrange(numComponents):
+            box = tuple(slice(int(boxStarts[axis][i]), int(boxStops[axis][i])) for axis in xrange(3))
+            self.lesions[self.nextId + i] = [int(counts[i]), maximums[i].item(), sums[i].item(),
+                                             int(firstVoxels[i]), box]
+        self.nextId += numComponents
+
+    def __boundingBox__(self, mask, margin=0):
+        """ Bounding box of the True voxels of a mask
+        :param mask: boolean numpy array
+        :param margin: number of voxels added in every direction (clipped to the volume)
+        :return: tuple of slices or None if the mask is empty
+        """
+        box = []
+        for axis in xrange(mask.ndim):
+            otherAxes = tuple(a for a in xrange(mask.ndim) if a != axis)
+            indexes = np.nonzero(mask.any(axis=otherAxes))[0]
+            if len(indexes) == 0:
+                return None
+            box.append(slice(max(indexes[0] - margin, 0), min(indexes[-1] + margin + 1, mask.shape[axis])))
+        return tuple(box)
+
+    def __dilate__(self, mask):
+        """ Dilation of a boolean array with a 3x3x3 box
+        :param mask: boolean numpy array
+        :return: boolean numpy array
+        """
+        dilated = mask.copy()
+        for axis in xrange(3):
+            result = dilated.copy()
+            lower = [slice(None)] * 3
+            upper = [slice(None)] * 3
+            lower[axis] = slice(0, -1)
+            upper[axis] = slice(1, None)
+            result[tuple(lower)] |= dilated[tuple(upper)]
+            result[tuple(upper)] |= dilated[tuple(lower)]
+            dilated = result
+        return dilated
+
+    def __getSortedIds__(self):
+        """ Ids of the lesions sorted like RelabelComponent does (size descending and position of the first voxel)
+        """
+        if self.__sortedIds__ is None:
+            self.__sortedIds__ = sorted(self.lesions.keys(),
+                                        key=lambda lesionId: (-self.lesions[lesionId][0], self.lesions[lesionId][3]))
+        return self.__sortedIds__
+
+    def getLesions(self):
+        """ Statistics of all the lesions, sorted by size (the label of every lesion is its position in this list
+        + 1, like in getLabelsArray)
+        :return: list of (label, count, maximum, mean) tuples
+        """
+        result = []
+        for i, lesionId in enumerate(self.__getSortedIds__()):
+            count, maximum, total, _, _ = self.lesions[lesionId]
+            result.append((i + 1, count, maximum, total / float(count)))
+        return result
+
+    def getLabelsArray(self, dtype=np.int16):
+        """ Labelmap of the lesions (the same as the one that RelabelComponent generates)
+        :param dtype: numpy type of the result
+        :return: numpy array (ZYX)
+        """
+        lookupTable = np.zeros(self.nextId, dtype)
+        sortedIds = self.__getSortedIds__()
+        lookupTable[sortedIds] = np.arange(1, len(sortedIds) + 1)
+        return lookupTable[self.lesionIds]
+
+    @staticmethod
+    def computeAgatstonScores(labelsArray, ctArray, pixelArea, numLabels=None, territoriesArray=None,
+                              numTerritories=0):
+        """ Agatston score of all the lesions, computed slice by slice: every axial slice of a lesion contributes
+        with its area multiplied by the density weight of its peak HU in that slice (see DENSITY_THRESHOLDS).
+        The area and the peak of all the (lesion, territory, slice) groups are computed at once.
+        :param labelsArray: numpy array (ZYX) with the lesion label of every voxel (0=background)
+        :param ctArray: numpy array (ZYX) with the HU values
+        :param pixelArea: area of a voxel in an axial slice (mm^2)
+        :param numLabels: number of lesions (by default, the maximum label)
+        :param territoriesArray: optional numpy array (ZYX) with the coronary territory of every voxel (see
+            TERRITORIES). Voxels with other values are not in any territory
+        :param numTerritories: number of territories
+        :return: numpy array (numLabels+1 x numTerritories+1) with the score of every lesion (row=label) in every
+            territory (column 0 = voxels outside of the territories). The total score of a lesion is the sum of
+            its row
+        """
+        positions = np.nonzero(labelsArray)
+        labels = labelsArray[positions].astype(np.int64)
+        if numLabels is None:
+            numLabels = int(labels.max()) if len(labels) > 0 else 0
+        scores = np.zeros((numLabels + 1, numTerritories + 1))
+        if len(labels) == 0:
+            return scores
+        if territoriesArray is not None:
+            territories = territoriesArray[positions].astype(np.int64)
+            territories[(territories < 0) | (territories > numTerritories)] = 0
+        else:
+            territories = np.zeros(len(labels), np.int64)
+        numSlices = labelsArray.shape[0]
+        # (lesion, territory, slice) group of every voxel
+        groups = (labels * (numTerritories + 1) + territories) * numSlices + positions[0]
+        numGroups = (numLabels + 1) * (numTerritories + 1) * numSlices
+        areas = np.bincount(groups, minlength=numGroups)
+        # Peak value of every group
+        order = np.argsort(groups, kind="mergesort")
+        sortedGroups = groups[order]
+        starts = np.nonzero(np.concatenate(([True], sortedGroups[1:] != sortedGroups[:-1])))[0]
+        peaks = np.zeros(numGroups)
+        peaks[sortedGroups[starts]] = np.maximum.reduceat(ctArray[positions][order], starts)
+        weights = np.digitize(peaks, CalciumScoringSession.DENSITY_THRESHOLDS)
+        scores += (areas * weights).reshape(numLabels + 1, numTerritories + 1, numSlices).sum(axis=2) * pixelArea
+        return scores
+
+
 #
 # CIP_CalciumScoringLogic
 #
@@ -645,3 +1066,49 @@ class CIP_CalciumScoringTest(unittest.TestCase):
         """ Do whatever is needed to reset the state - typically a scene clear will be enough.
         """
         slicer.mrmlScene.Clear(0)
+
+    def runTest(self):
+        """Run as few or as many tests as needed here.
+        """
+        self.setUp()
+        self.test_CalciumScoringSession()
+
+    def test_CalciumScoringSession(self):
+        """ The lesions of an incremental session must be the same as the ones of the whole pipeline
+        (BinaryThreshold + ConnectedComponent + RelabelComponent + LabelStatistics) for random threshold updates.
+        Only SimpleITK and numpy are used
+        """
+        rng = np.random.RandomState(0)
+        # Noise below the thresholds with some bright blobs of different sizes and densities
+        array = rng.randint(-100, 120, (30, 60, 60)).astype(np.int16)
+        for _ in xrange(80):
+            radius = rng.randint(1, 4)
+            box = tuple(slice(max(center - radius, 0), center + radius)
+                        for center in (rng.randint(0, size) for size in array.shape))
+            array[box] += rng.randint(50, 600, array[box].shape).astype(np.int16)
+        image = sitk.GetImageFromArray(array)
+
+        session = CalciumScoringSession()
+        session.setImage(image, "test")
+        self.assertTrue(session.isImage("test"))
+        self.assertFalse(session.isImage("other"))
+
+        thresholds = [(130, 1000), (100, 1000), (250, 1000), (130, 300)]
+        thresholds += [tuple(sorted(rng.randint(0, 700, 2).tolist())) for _ in xrange(20)]
+        for thresholdMin, thresholdMax in thresholds:
+            session.update(thresholdMin, thresholdMax)
+
+            thresholded = sitk.BinaryThreshold(image, thresholdMin, thresholdMax, 1, 0)
+            labels = sitk.RelabelComponent(sitk.ConnectedComponent(thresholded, True))
+            labelsArray = sitk.GetArrayFromImage(labels)
+            stats = sitk.LabelStatisticsImageFilter()
+            stats.Execute(image, labels)
+
+            self.assertTrue(np.array_equal(session.getLabelsArray(), labelsArray.astype(np.int16)),
+                            "Different labels for thresholds {0}".format((thresholdMin, thresholdMax)))
+            lesions = session.getLesions()
+            self.assertEqual(len(lesions), int(labelsArray.max()))
+            for label, count, maximum, mean in lesions:
+                self.assertEqual(count, stats.GetCount(label))
+                self.assertEqual(maximum, stats.GetMaximum(label))
+                self.assertAlmostEqual(mean, stats.GetMean(label))
@@ -1,4 +1,5 @@
 import os
+import logging
 import unittest
 import vtk, qt, ctk, slicer
 
@@ -274,6 +275,20 @@ class CIP_InteractiveLobeSegmentationWidget(ScriptedLoadableModuleWidget):
         self.layout.addWidget(self.applyButton, 0, 4)
         # self.layout.setAlignment(2)
 
+        #
+        # Segmentation progress (the segmentation runs in the background)
+        #
+        self.progressBar = qt.QProgressBar()
+        self.progressBar.setRange(0, 100)
+        self.progressBar.hide()
+        self.layout.addWidget(self.progressBar)
+
+        self.cancelButton = qt.QPushButton("Cancel")
+        self.cancelButton.toolTip = "Cancel the lobe segmentation that is running."
+        self.cancelButton.setFixedSize(150, 30)
+        self.cancelButton.hide()
+        self.layout.addWidget(self.cancelButton, 0, 4)
+
         #
         # Show Fiducials
         #
@@ -287,6 +302,7 @@ class CIP_InteractiveLobeSegmentationWidget(ScriptedLoadableModuleWidget):
 
         # connections
         self.applyButton.connect('clicked(bool)', self.onApplyButton)
+        self.cancelButton.connect('clicked(bool)', self.onCancelButton)
         self.CTSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onCTSelect)
         self.labelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
         self.outputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
@@ -300,7 +316,7 @@ class CIP_InteractiveLobeSegmentationWidget(ScriptedLoadableModuleWidget):
         self.layout.addStretch(1)
 
     def cleanup(self):
-        pass
+        self.logic.cancel()
 
     def onCTSelect(self, CTNode):
         if CTNode:
@@ -416,29 +432,49 @@ class CIP_InteractiveLobeSegmentationWidget(ScriptedLoadableModuleWidget):
            
         self.visualizationWidget.updateScene()
         
-        self.applyButton.text = "Segmenting Lobes..."
-        self.applyButton.repaint()
-        slicer.app.processEvents()
-
-        logic = CIP_InteractiveLobeSegmentationLogic()
-        
-        self.visualizationWidget.pendingUpdate = True
+        # pendingUpdate is not set while the segmentation runs in the background, so that the fiducials that are
+        # added in the meantime are still updated
         outputNode = self.outputSelector.currentNode()
         if not outputNode:
             outputNode = slicer.vtkMRMLLabelMapVolumeNode()
             slicer.mrmlScene.AddNode(outputNode)
-            
-        fissureVolume = None
+
+        # The segmentation runs in the background. If there is a previous segmentation running, it will be
+        # cancelled, because its result is not valid anymore
+        self.applyButton.text = "Segmenting Lobes..."
+        self.progressBar.setValue(0)
+        self.progressBar.show()
+        self.cancelButton.show()
+        self.applyButton.enabled = True
         try:
-            fissureVolume = logic.run(self.labelSelector.currentNode(), outputNode)
+            self.logic.runAsync(self.labelSelector.currentNode(), outputNode,
+                                finishedCallback=lambda fissureVolume: self.onSegmentationFinished(CTNode,
+                                                                                                   fissureVolume),
+                                progressCallback=self.onSegmentationProgress)
         except Exception, e:
             import traceback
             traceback.print_exc()
             qt.QMessageBox.warning(slicer.util.mainWindow(),
                                    "Running", 'Exception!\n\n' + str(e) + "\n\nSee Python Console for Stack Trace")
-        
-        # if fissureVolume is not None:
-        self.outputSelector.setCurrentNode(fissureVolume)
+            self.onSegmentationFinished(CTNode, None)
+
+    def onSegmentationProgress(self, progress, status):
+        """ The segmentation that is running in the background reported some progress
+        :param progress: progress (0-100)
+        :param status: status of the CLI
+        """
+        self.progressBar.setValue(progress)
+        self.progressBar.setFormat("{0} (%p%)".format(status))
+
+    def onSegmentationFinished(self, CTNode, fissureVolume):
+        """ The last segmentation requested finished (or it was cancelled)
+        :param CTNode: CT volume node
+        :param fissureVolume: output labelmap (None if the segmentation failed or it was cancelled)
+        """
+        self.progressBar.hide()
+        self.cancelButton.hide()
+        if fissureVolume:
+            self.outputSelector.setCurrentNode(fissureVolume)
         SlicerUtil.changeLabelmapOpacity(0.5)
 
         self.onFourUpButton()
@@ -454,9 +490,13 @@ class CIP_InteractiveLobeSegmentationWidget(ScriptedLoadableModuleWidget):
         for color in ['Red', 'Yellow', 'Green']:
             slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(
                 CTNode.GetID())
-            slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetLabelVolumeID(
-                self.outputSelector.currentNode().GetID())
-        
+            if self.outputSelector.currentNode():
+                slicer.app.layoutManager().sliceWidget(color).sliceLogic().GetSliceCompositeNode().SetLabelVolumeID(
+                    self.outputSelector.currentNode().GetID())
+
+    def onCancelButton(self):
+        self.logic.cancel()
+
     def filterInputCT(self, input_node):
         # self.applyButton.enabled = False
         self.applyButton.text = "Filtering..."
@@ -896,6 +936,89 @@ class ILSVisualizationWidget(ILSpqWidget):
         self.updatingFiducials = False
 
 
+class CLIJobQueue(object):
+    """ Run CLI modules in the background, one job at a time.
+    When a new job is submitted while another one is running, the running job is cancelled (its result would be
+    stale anyway) and the new one is started as soon as the CLI finishes the cancellation. If several jobs are
+    submitted in the meantime, only the last one is run. The parameters of a job are read just before it starts, so
+    the job always uses the latest state of the scene (ex: the fiducials that the user is still moving)
+    """
+    def __init__(self):
+        # Job that is running: (cliNode, observerTag, finishedCallback, progressCallback)
+        self.currentJob = None
+        # Job that will be run when the current one finishes: (cliModule, parametersFunction, finishedCallback,
+        # progressCallback)
+        self.pendingJob = None
+
+    def submit(self, cliModule, parametersFunction, finishedCallback=None, progressCallback=None):
+        """ Run a CLI module in the background, cancelling the job that is running (if any)
+        :param cliModule: CLI module (ex: slicer.modules.segmentlunglobes)
+        :param parametersFunction: function that returns the dictionary of parameters of the CLI (or None if the
+            job cannot be run). It is invoked when the job starts
+        :param finishedCallback: function(success) invoked when the job finishes. success is False when the
+            job fails, it is cancelled or it is superseded by a newer job
+        :param progressCallback: function(progress, status) invoked every time the CLI reports some progress
+        """
+        if self.pendingJob is not None and self.pendingJob[2] is not None:
+            # The previous pending job was never started
+            self.pendingJob[2](False)
+        self.pendingJob = (cliModule, parametersFunction, finishedCallback, progressCallback)
+        if self.currentJob is None:
+            self.__startPendingJob__()
+        else:
+            self.currentJob[0].Cancel()
+
+    def cancel(self):
+        """ Cancel the job that is running and the pending job (if any) """
+        pendingJob = self.pendingJob
+        self.pendingJob = None
+        if pendingJob is not None and pendingJob[2] is not None:
+            pendingJob[2](False)
+        if self.currentJob is not None:
+            self.currentJob[0].Cancel()
+
+    def isRunning(self):
+        """ True if there is a job running or waiting to be run """
+        return self.currentJob is not None or self.pendingJob is not None
+
+    def __startPendingJob__(self):
+        cliModule, parametersFunction, finishedCallback, progressCallback = self.pendingJob
+        self.pendingJob = None
+        parameters = parametersFunction()
+        if not parameters:
+            if finishedCallback is not None:
+                finishedCallback(False)
+            return
+        cliNode = slicer.cli.run(cliModule, None, parameters, wait_for_completion=False)
+        tag = cliNode.AddObserver('ModifiedEvent', self.__onCLINodeModified__)
+        self.currentJob = (cliNode, tag, finishedCallback, progressCallback)
+
+    def __onCLINodeModified__(self, cliNode, event):
+        if self.currentJob is None or cliNode != self.currentJob[0]:
+            return
+        _, tag, finishedCallback, progressCallback = self.currentJob
+        if cliNode.IsBusy():
+            if progressCallback is not None:
+                progressCallback(int(cliNode.GetProgress()), cliNode.GetStatusString())
+            return
+
+        # The job finished
+        cliNode.RemoveObserver(tag)
+        self.currentJob = None
+        success = cliNode.GetStatus() == cliNode.Completed
+        if not success and cliNode.GetStatus() != cliNode.Cancelled:
+            logging.error("{0} failed: {1}".format(cliNode.GetName(), cliNode.GetErrorText()
+                                                   if hasattr(cliNode, "GetErrorText") else cliNode.GetStatusString()))
+        # The CLI node is removed once the current event is processed
+        qt.QTimer.singleShot(0, lambda: slicer.mrmlScene.RemoveNode(cliNode))
+        if self.pendingJob is not None:
+            # The result is stale. Run the latest job
+            if finishedCallback is not None:
+                finishedCallback(False)
+            self.__startPendingJob__()
+        elif finishedCallback is not None:
+            finishedCallback(success)
+
 #
 # CIP_InteractiveLobeSegmentationLogic
 #
@@ -910,6 +1033,7 @@ class CIP_InteractiveLobeSegmentationLogic(ScriptedLoadableModuleLogic):
 
     def __init__(self):
         self.name = "Fiducial"
+        self.jobQueue = CLIJobQueue()
 
     def hasImageData(self, volumeNode):
         """This is a dummy logic method that
@@ -984,9 +1108,11 @@ class CIP_InteractiveLobeSegmentationLogic(ScriptedLoadableModuleLogic):
         else:
             return
 
-    def run(self, labelVolume, outputVolume):
-        """
-        Run the actual algorithm
+    def getParameters(self, labelVolume, outputVolume):
+        """ Parameters of the lobe segmentation CLI for the current fiducials in the scene
+        :param labelVolume: partial lung labelmap
+        :param outputVolume: output labelmap
+        :return: dictionary of parameters or False if the fiducials are not valid (a warning is shown)
         """
         listsInScene = slicer.util.getNodes('vtkMRMLMarkupsFiducialNode*')
         leftObliqueFiducials = None
@@ -1023,8 +1149,43 @@ class CIP_InteractiveLobeSegmentationLogic(ScriptedLoadableModuleLogic):
             qt.QMessageBox.warning(slicer.util.mainWindow(),
                                    "Interactive Lobe Segmentation", "Please place fiducials on the right oblique fissure.")
             return False
+        return parameters
 
+    def run(self, labelVolume, outputVolume):
+        """
+        Run the actual algorithm (synchronously. See runAsync)
+        """
+        parameters = self.getParameters(labelVolume, outputVolume)
+        if not parameters:
+            return False
         slicer.cli.run(slicer.modules.segmentlunglobes, None, parameters, wait_for_completion=True)
+        return self.__onSegmentationCompleted__(labelVolume, outputVolume)
+
+    def runAsync(self, labelVolume, outputVolume, finishedCallback=None, progressCallback=None):
+        """
+        Run the algorithm in the background. If there is another segmentation running, it is cancelled and the
+        new one is started when the cancellation finishes. The fiducials are read when the segmentation starts,
+        so when the user requests several segmentations in a row only the latest fiducials are segmented
+        :param labelVolume: partial lung labelmap
+        :param outputVolume: output labelmap
+        :param finishedCallback: function(outputVolume) invoked when the last requested segmentation finishes.
+            outputVolume is None if the segmentation failed or it was cancelled
+        :param progressCallback: function(progress, status) invoked with the progress of the CLI
+        """
+        def onJobFinished(success):
+            result = self.__onSegmentationCompleted__(labelVolume, outputVolume) if success else None
+            # Superseded jobs are not notified, the widget is waiting for the latest one
+            if finishedCallback is not None and (success or not self.jobQueue.isRunning()):
+                finishedCallback(result)
+
+        self.jobQueue.submit(slicer.modules.segmentlunglobes, lambda: self.getParameters(labelVolume, outputVolume),
+                             finishedCallback=onJobFinished, progressCallback=progressCallback)
+
+    def cancel(self):
+        """ Cancel the segmentations that are running in the background (if any) """
+        self.jobQueue.cancel()
+
+    def __onSegmentationCompleted__(self, labelVolume, outputVolume):
         selectionNode = slicer.app.applicationLogic().GetSelectionNode()
         selectionNode.SetReferenceActiveLabelVolumeID(outputVolume.GetID())
         outputVolume.SetName(labelVolume.GetName().replace("_partialLungLabelMap", "_interactiveLobeSegmentation"))
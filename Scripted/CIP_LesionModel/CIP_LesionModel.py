@@ -14,7 +14,6 @@ from CIP.logic import Util
 from CIP.logic import GeometryTopologyData, Point
 from CIP.ui import CaseReportsWidget, MIPViewerWidget
 
-from FeatureWidgetHelperLib import FeatureExtractionLogic
 import FeatureWidgetHelperLib
 import FeatureExtractionLib
 
@@ -69,6 +68,7 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         self.__featureClasses__ = None
         self.__storedColumnNames__ = None
         self.__analyzedSpheres__ = set()
+        self.__pendingSpheres__ = dict()
         self.__showRadiomics__ = False
 
         # Timer for dynamic zooming
@@ -935,31 +935,22 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
             return
 
         try:
-            # Analysis for the volume and the nodule:
-            keyName = "{}_{}".format(volume.GetName(), noduleIndex)
+            # All the regions (nodule and spheres) are analyzed in the same run. With several workers, every
+            # (region, feature category) pair is an independent job
             start = time.time()
+            extractor = FeatureExtractionLib.ParallelFeatureExtractor(slicer.util.array(volume.GetID()),
+                                                                      volume.GetSpacing(), self.featureClasses,
+                                                                      self.logic.numWorkers or None)
+            # Spheres added to the extractor (keyName-(noduleIndex, radius)). A sphere is marked as analyzed just
+            # when its results exist
+            self.__pendingSpheres__ = dict()
+            # Analysis for the volume and the nodule:
             if self.noduleCheckbox.checked:
+                keyName = "{}_{}".format(volume.GetName(), noduleIndex)
                 currentLabelmapArray = slicer.util.array(self.logic.getNthNoduleLabelmapNode(volume, noduleIndex).GetID())
-                logic = FeatureExtractionLogic(volume, currentLabelmapArray,
-                                               self.selectedMainFeaturesKeys.difference(["Parenchymal Volume"]),
-                                               self.selectedFeatureKeys.difference(
-                                                   self.featureClasses["Parenchymal Volume"]))
-
-                print("******** Nodule analysis results...")
-                t1 = start
-
-                t2 = time.time()
-
-                self.analysisResults[keyName] = collections.OrderedDict()
-                self.analysisResultsTiming[keyName] = collections.OrderedDict()
-                logic.run(self.analysisResults[keyName], self.logic.printTiming, self.analysisResultsTiming[keyName])
-
-                # Print analysis results
-                print(self.analysisResults[keyName])
-
-                if self.logic.printTiming:
-                    print("Elapsed time for the nodule analysis (TOTAL={0} seconds:".format(t2 - t1))
-                    print(self.analysisResultsTiming[keyName])
+                extractor.addRegion(keyName, currentLabelmapArray,
+                                    self.selectedMainFeaturesKeys.difference(["Parenchymal Volume"]),
+                                    self.selectedFeatureKeys.difference(self.featureClasses["Parenchymal Volume"]))
 
             # Check in any sphere has been selected for the analysis, because otherwise it's not necessary to calculate the distance map
             anySphereChecked = False
@@ -970,8 +961,6 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
             if self.otherRadiusCheckbox.checked and self.otherRadiusTextbox.text != "":
                 anySphereChecked = True
 
-            # if self.r15Checkbox.checked or self.r20Checkbox.checked or self.r25Checkbox.checked \
-            #         or (self.rOtherCheckbox.checked and self.otherRadiusTextbox.text != ""):
             if anySphereChecked:
                 if "Parenchymal Volume" in self.selectedMainFeaturesKeys:
                     # If the parenchymal volume analysis is required, we need the numpy array represeting the whole
@@ -980,29 +969,19 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
                 else:
                     labelmapWholeVolumeArray = None
 
-                # print("DEBUG: analyzing spheres...")
                 t1 = time.time()
                 self.logic.getCurrentDistanceMap(volume, noduleIndex)
                 if self.logic.printTiming:
                     print("Time to get the current distance map: {0} seconds".format(time.time() - t1))
 
-                for r in self.logic.getPredefinedSpheresDict(self.currentVolume):
-                    if self.spheresButtonGroup.button(r*10).isChecked():
-                        self.runAnalysisSphere(volume, noduleIndex, r, labelmapWholeVolumeArray)
-                        self.__analyzedSpheres__.add((noduleIndex,r))
-                # if self.r15Checkbox.checked:
-                #     self.runAnalysisSphere(15, labelmapWholeVolumeArray)
-                #     self.__analyzedSpheres__.add(15)
-                # if self.r20Checkbox.checked:
-                #     self.runAnalysisSphere(20, labelmapWholeVolumeArray)
-                #     self.__analyzedSpheres__.add(20)
-                # if self.r25Checkbox.checked:
-                #     self.runAnalysisSphere(25, labelmapWholeVolumeArray)
-                #     self.__analyzedSpheres__.add(25)
+                radiuses = [r for r in self.logic.getPredefinedSpheresDict(self.currentVolume)
+                            if self.spheresButtonGroup.button(r*10).isChecked()]
                 if self.otherRadiusCheckbox.checked:
-                    r = int(self.otherRadiusTextbox.text)
-                    self.runAnalysisSphere(volume, noduleIndex, r, labelmapWholeVolumeArray)
-                    self.__analyzedSpheres__.add((noduleIndex,r))
+                    radiuses.append(int(self.otherRadiusTextbox.text))
+                for r in radiuses:
+                    self.addAnalysisSphere(extractor, volume, noduleIndex, r, labelmapWholeVolumeArray)
+
+            self.runAnalysisJobs(extractor, volume)
 
             t = time.time() - start
             if self.logic.printTiming:
@@ -1019,8 +998,9 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         finally:
             self.saveReport(volume, noduleIndex, showConfirmation=False)
 
-    def runAnalysisSphere(self, volume, noduleIndex, radius, parenchymaWholeVolumeArray=None):
-        """ Run the selected features for an sphere of radius r (excluding the nodule itself)
+    def addAnalysisSphere(self, extractor, volume, noduleIndex, radius, parenchymaWholeVolumeArray=None):
+        """ Add to the extractor the selected features for an sphere of radius r (excluding the nodule itself)
+        @param extractor: ParallelFeatureExtractor
         @param radius:
         @param parenchymaWholeVolumeArray: parenchyma volume (only used in parenchyma analysis). Numpy array
         """
@@ -1037,20 +1017,56 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
             for key in self.selectedFeatureKeys:
                 results[key] = 0
             self.analysisResults[keyName] = results
+            self.__analyzedSpheres__.add((noduleIndex, radius))
         else:
-            logic = FeatureExtractionLogic(volume, labelmapArray, self.selectedMainFeaturesKeys,
-                                           self.selectedFeatureKeys, "_r{}_{}".format(radius, noduleIndex), parenchymaWholeVolumeArray)
-            t1 = time.time()
-            self.analysisResults[keyName] = collections.OrderedDict()
-            self.analysisResultsTiming[keyName] = collections.OrderedDict()
-            logic.run(self.analysisResults[keyName], self.logic.printTiming, self.analysisResultsTiming[keyName])
-            t2 = time.time()
-
-            print("********* Results for the sphere of radius {0}:".format(radius))
+            extractor.addRegion(keyName, labelmapArray, self.selectedMainFeaturesKeys, self.selectedFeatureKeys,
+                                parenchymaWholeVolumeArray)
+            self.__pendingSpheres__[keyName] = (noduleIndex, radius)
+
+    def runAnalysisJobs(self, extractor, volume):
+        """ Run all the regions added to the extractor and store the results in analysisResults/analysisResultsTiming.
+        If the process is cancelled, the results of the regions that were already finished are stored before the
+        StopIteration exception is raised again
+        @param extractor: ParallelFeatureExtractor
+        @param volume: intensities volume
+        """
+        progressBar = qt.QProgressDialog(slicer.util.mainWindow())
+        progressBar.minimumDuration = 0
+        progressBar.labelText = 'Calculating for {0}: '.format(volume.GetName())
+        progressBar.show()
+
+        def updateProgress(regionKey, category, numJobsFinished, numJobs):
+            progressBar.labelText = 'Calculating {0}: {1}'.format(regionKey, category)
+            progressBar.setMaximum(numJobs)
+            progressBar.setValue(numJobsFinished)
+            slicer.app.processEvents()
+
+        def checkStopProcess():
+            slicer.app.processEvents()
+            return progressBar.wasCanceled
+
+        try:
+            extractor.run(self.logic.printTiming, updateProgress, checkStopProcess)
+        finally:
+            progressBar.close()
+            progressBar.deleteLater()
+            # Store everything that was finished (all the regions, unless the process was cancelled)
+            self.__storeAnalysisResults__(extractor)
+
+    def __storeAnalysisResults__(self, extractor):
+        """ Store the results of the regions that the extractor finished in analysisResults/analysisResultsTiming
+        @param extractor: ParallelFeatureExtractor
+        """
+        results, timings = extractor.getFinishedResults()
+        for keyName in results:
+            self.analysisResults[keyName] = results[keyName]
+            if keyName in self.__pendingSpheres__:
+                self.__analyzedSpheres__.add(self.__pendingSpheres__.pop(keyName))
+            self.analysisResultsTiming[keyName] = timings[keyName]
+            print("********* Results for {0}:".format(keyName))
             print(self.analysisResults[keyName])
             if self.logic.printTiming:
-                print("*** Elapsed time for the sphere radius {0} analysis (TOTAL={1} seconds:".format(radius, t2 - t1))
-                print (self.analysisResultsTiming[keyName])
+                print(self.analysisResultsTiming[keyName])
 
     # def forceSaveReport(self):
     #     """ If basic report does not exist, it is created "on the fly"
@@ -1608,6 +1624,13 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
         self.marchingCubesFilters = {}     # Dictionary of thresholds for each nodule in a particular volume
 
         self.printTiming = SlicerUtil.IsDevelopment
+        # Number of processes used for the features analysis (setting CIP_LesionModel/AnalysisWorkers). By default
+        # the analysis runs in the Slicer process, because forking the GUI process is not safe in every platform.
+        # Parallelism must be enabled explicitly (0 = one process per cpu). Never used in Windows, where the
+        # worker processes cannot be forked from Slicer
+        self.numWorkers = int(SlicerUtil.settingGetOrSetDefault("CIP_LesionModel", "AnalysisWorkers", 1))
+        if sys.platform == "win32":
+            self.numWorkers = 1
 
     @property
     def __PREFIX_INPUTVOLUME__(self):
@@ -2202,28 +2225,15 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
 
     def getCurrentDistanceMap(self, vtkMRMLScalarVolumeNode, noduleIndex):
         """ Calculate the distance map to the centroid for the current labelmap volume.
-        To that end, we have to calculate first the centroid.
+        The distance map is restricted to the region of the volume that can be reached by the biggest sphere
+        (see NoduleDistanceMap).
         Please note the results could be cached
-        @return:
+        @return: NoduleDistanceMap object
         """
         if (vtkMRMLScalarVolumeNode.GetID(), noduleIndex) not in self.currentDistanceMaps:
             labelmapArray = slicer.util.array(self.getNthNoduleLabelmapNode(vtkMRMLScalarVolumeNode, noduleIndex).GetID())
-            centroid = Util.centroid(labelmapArray)
-            # Calculate the distance map for the specified origin
-            # Get the dimensions of the volume in ZYX coords
-            dims = Util.vtk_numpy_coordinate(vtkMRMLScalarVolumeNode.GetImageData().GetDimensions())
-            # Speed map (all ones because the growth will be constant).
-            # The dimensions are reversed because we want the format in ZYX coordinates
-            input = np.ones(dims, np.int32)
-            sitkImage = sitk.GetImageFromArray(input)
-            sitkImage.SetSpacing(vtkMRMLScalarVolumeNode.GetSpacing())
-            fastMarchingFilter = sitk.FastMarchingImageFilter()
-            fastMarchingFilter.SetStoppingValue(self.MAX_TUMOR_RADIUS)
-            # Reverse the coordinate of the centroid
-            seeds = [Util.numpy_itk_coordinate(centroid)]
-            fastMarchingFilter.SetTrialPoints(seeds)
-            output = fastMarchingFilter.Execute(sitkImage)
-            self.currentDistanceMaps[(vtkMRMLScalarVolumeNode.GetID(), noduleIndex)] = sitk.GetArrayFromImage(output)
+            self.currentDistanceMaps[(vtkMRMLScalarVolumeNode.GetID(), noduleIndex)] = \
+                NoduleDistanceMap(labelmapArray, vtkMRMLScalarVolumeNode.GetSpacing(), self.MAX_TUMOR_RADIUS)
 
         return self.currentDistanceMaps[(vtkMRMLScalarVolumeNode.GetID(), noduleIndex)]
 
@@ -2247,12 +2257,13 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
         newSphereLabelmap = SlicerUtil.cloneVolume(labelmapNodule,
                         "{}_SphereLabelmap_r{}_{}".format(vtkMRMLScalarVolumeNode.GetName(), radius, noduleIndex))
         array = slicer.util.array(newSphereLabelmap.GetID())
-        # Mask with the voxels that are inside the radius of the sphere
-        dm = self.currentDistanceMaps[(vtkMRMLScalarVolumeNode.GetID(), noduleIndex)]
-        array[dm <= radius] = 1
-        # Exclude the nodule
-        labelmapArray = slicer.util.array(labelmapNodule.GetID())
-        array[labelmapArray == 1] = 0
+        # Mask with the voxels that are inside the radius of the sphere, excluding the nodule.
+        # Both the sphere and the nodule are contained in the region of the distance map, so the rest of the
+        # volume does not need to be visited
+        dm = self.getCurrentDistanceMap(vtkMRMLScalarVolumeNode, noduleIndex)
+        region = array[dm.slices]
+        region[dm.noduleMask] = 0
+        region[dm.getShellMask(radius)] = 1
         # Save the result
         self.setNthSphereLabelmapNode(vtkMRMLScalarVolumeNode, noduleIndex, newSphereLabelmap, radius)
         # self.spheresLabelmaps[radius] = array
@@ -2540,6 +2551,64 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
         #     rulerSHNode.SetParentNodeID(parentSHNode.GetID())
         pass
 
+
+class NoduleDistanceMap(object):
+    """ Euclidean distance (in mm) to the centroid of a nodule.
+    The distance is only calculated in the bounding box of the nodule padded with the maximum radius of the spheres
+    (plus one voxel), so that the spheres that surround the nodule can be obtained without processing or allocating
+    arrays for the whole volume.
+    All the arrays are in ZYX (numpy) coordinates and they refer to the cropped region defined by "slices"
+    """
+    def __init__(self, labelmapArray, spacing, maxRadius, labelId=1):
+        """
+        @param labelmapArray: numpy array for the whole labelmap of the nodule
+        @param spacing: spacing of the volume (XYZ format)
+        @param maxRadius: maximum radius of the spheres that will be requested (mm)
+        @param labelId: label of the nodule in the labelmap
+        """
+        coords = np.where(labelmapArray == labelId)
+        # Centroid of the nodule (same as Util.centroid)
+        centroid = np.asarray(np.round(np.mean(coords, axis=1), 0), np.int)
+        spacing = np.array(Util.vtk_numpy_coordinate(spacing), np.float)
+        # Bounding box of the nodule padded with the maximum radius plus one voxel, clipped to the volume
+        padding = np.ceil(maxRadius / spacing).astype(np.int) + 1
+        lower = np.maximum(np.min(coords, axis=1) - padding, 0)
+        upper = np.minimum(np.max(coords, axis=1) + padding + 1, labelmapArray.shape)
+        self.slices = tuple(slice(l, u) for l, u in zip(lower, upper))
+        self.centroid = centroid
+        self.maxRadius = maxRadius
+
+        # Nodule mask in the cropped region
+        self.noduleMask = labelmapArray[self.slices] == labelId
+        # Exact euclidean distance to the centroid
+        z, y, x = np.ogrid[self.slices]
+        self.distances = np.sqrt(((z - centroid[0]) * spacing[0]) ** 2 +
+                                 ((y - centroid[1]) * spacing[1]) ** 2 +
+                                 ((x - centroid[2]) * spacing[2]) ** 2).astype(np.float32)
+
+    def getSphereMask(self, radius):
+        """ Boolean mask (in the cropped region) of the voxels that are inside a sphere of radius "radius"
+        @param radius: radius in mm
+        @return: numpy boolean array
+        """
+        return self.distances <= radius
+
+    def getShellMask(self, radius):
+        """ Boolean mask (in the cropped region) of the voxels that are inside a sphere of radius "radius",
+        excluding the nodule itself
+        @param radius: radius in mm
+        @return: numpy boolean array
+        """
+        return (self.distances <= radius) & ~self.noduleMask
+
+    def getShellMasks(self, radiuses):
+        """ Get the shell masks for a list of radiuses
+        @param radiuses: list of radiuses in mm
+        @return: OrderedDict of radius-mask
+        """
+        return OrderedDict((radius, self.getShellMask(radius)) for radius in radiuses)
+
+
 #############################
 # CIP_LesionModel
 class CIP_LesionModelTest(ScriptedLoadableModuleTest):
@@ -0,0 +1,223 @@
+import numpy
+
+
+class lazyCoefficient(object):
+    """ Decorator for the methods of a CoefficientsCache that calculate a coefficient.
+    The method is invoked just the first time that the coefficient is read. After that, the value is stored in the
+    instance, so that all the features that use the coefficient share the same result
+    """
+    def __init__(self, function):
+        self.function = function
+        self.__name__ = function.__name__
+        self.__doc__ = function.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.function(instance)
+        instance.__dict__[self.__name__] = value
+        return value
+
+
+class CoefficientsCache(object):
+    """ Base class for the intermediate coefficients that are shared by several features of the same ROI.
+    Every coefficient is a lazyCoefficient, so it is only calculated if some of the selected features need it
+    """
+    pass
+
+
+class FirstOrderCoefficients(CoefficientsCache):
+    def __init__(self, parameterValues, bins):
+        """
+        :param parameterValues: array with the intensities of the voxels in the ROI
+        :param bins: bins for histogram
+        """
+        self.parameterValues = parameterValues
+        self.bins = bins
+
+    @lazyCoefficient
+    def minimum(self):
+        return numpy.min(self.parameterValues)
+
+    @lazyCoefficient
+    def maximum(self):
+        return numpy.max(self.parameterValues)
+
+    @lazyCoefficient
+    def mean(self):
+        return numpy.mean(self.parameterValues)
+
+    @lazyCoefficient
+    def sumSquares(self):
+        """ Sum of the squared intensities """
+        return numpy.sum(self.parameterValues ** 2)
+
+    @lazyCoefficient
+    def deviations(self):
+        """ Intensities minus the mean intensity """
+        return self.parameterValues - self.mean
+
+    @lazyCoefficient
+    def squaredDeviations(self):
+        return self.deviations * self.deviations
+
+    @lazyCoefficient
+    def moment2(self):
+        """ Second central moment (variance) """
+        return numpy.mean(self.squaredDeviations)
+
+    @lazyCoefficient
+    def moment3(self):
+        """ Third central moment """
+        return numpy.mean(self.squaredDeviations * self.deviations)
+
+    @lazyCoefficient
+    def moment4(self):
+        """ Fourth central moment """
+        return numpy.mean(self.squaredDeviations * self.squaredDeviations)
+
+    @lazyCoefficient
+    def std(self):
+        return numpy.sqrt(self.moment2)
+
+    @lazyCoefficient
+    def binsLog2(self):
+        """ log2 of the histogram bins (0 for empty bins) """
+        return numpy.where(self.bins != 0, numpy.log2(self.bins), 0)
+
+
+class GLCMCoefficients(CoefficientsCache):
+    def __init__(self, P_glcm, numGrayLevels):
+        """
+        :param P_glcm: GLCM matrices. Shape = (Ng, Ng, distances.size, directions)
+        :param numGrayLevels: number of gray levels (Ng)
+        """
+        self.P_glcm = P_glcm
+        self.Ng = numGrayLevels
+        self.eps = numpy.spacing(1)
+
+    @lazyCoefficient
+    def ivector(self):
+        return numpy.arange(1, self.Ng + 1)
+
+    @lazyCoefficient
+    def jvector(self):
+        return numpy.arange(1, self.Ng + 1)
+
+    @lazyCoefficient
+    def prodMatrix(self):
+        """ shape = (Ng, Ng) """
+        return numpy.multiply.outer(self.ivector, self.jvector)
+
+    @lazyCoefficient
+    def sumMatrix(self):
+        """ shape = (Ng, Ng) """
+        return numpy.add.outer(self.ivector, self.jvector)
+
+    @lazyCoefficient
+    def diffMatrix(self):
+        """ shape = (Ng, Ng) """
+        return numpy.absolute(numpy.subtract.outer(self.ivector, self.jvector))
+
+    @lazyCoefficient
+    def kValuesSum(self):
+        """ shape = (2*Ng-1) """
+        return numpy.arange(2, (self.Ng * 2) + 1)
+
+    @lazyCoefficient
+    def kValuesDiff(self):
+        """ shape = (Ng-1) """
+        return numpy.arange(0, self.Ng)
+
+    @lazyCoefficient
+    def u(self):
+        """ shape = (distances.size, directions) """
+        return self.P_glcm.mean(0).mean(0)
+
+    @lazyCoefficient
+    def px(self):
+        """ Marginal row probabilities. shape = (Ng, distances.size, directions) """
+        return self.P_glcm.sum(1)
+
+    @lazyCoefficient
+    def py(self):
+        """ Marginal column probabilities. shape = (Ng, distances.size, directions) """
+        return self.P_glcm.sum(0)
+
+    @lazyCoefficient
+    def ux(self):
+        """ shape = (distances.size, directions) """
+        return self.px.mean(0)
+
+    @lazyCoefficient
+    def uy(self):
+        """ shape = (distances.size, directions) """
+        return self.py.mean(0)
+
+    @lazyCoefficient
+    def sigx(self):
+        """ shape = (distances.size, directions) """
+        return self.px.std(0)
+
+    @lazyCoefficient
+    def sigy(self):
+        """ shape = (distances.size, directions) """
+        return self.py.std(0)
+
+    @lazyCoefficient
+    def pxAddy(self):
+        """ Sum of the probabilities with i+j == k. shape = (2*Ng-1, distances.size, directions) """
+        # Every row i of the GLCM (gray level i+1) contributes to the consecutive k values i+2...i+1+Ng
+        pxAddy = numpy.zeros((2 * self.Ng - 1,) + self.P_glcm.shape[2:])
+        for i in xrange(self.Ng):
+            pxAddy[i:i + self.Ng] += self.P_glcm[i]
+        return pxAddy
+
+    @lazyCoefficient
+    def pxSuby(self):
+        """ Sum of the probabilities with |i-j| == k. shape = (Ng, distances.size, directions) """
+        # Every row i of the GLCM contributes to the k values 0...Ng-1-i (j >= i) and i...1 (j < i)
+        pxSuby = numpy.zeros((self.Ng,) + self.P_glcm.shape[2:])
+        for i in xrange(self.Ng):
+            pxSuby[0:self.Ng - i] += self.P_glcm[i, i:]
+            pxSuby[1:i + 1] += self.P_glcm[i, :i][::-1]
+        return pxSuby
+
+    @lazyCoefficient
+    def pxy(self):
+        """ Product of the marginal probabilities. shape = (Ng, Ng, distances.size, directions) """
+        return self.px[:, None, :, :] * self.py[None, :, :, :]
+
+    def _log2(self, a):
+        """ log2 of an array, using eps for the values that are 0 """
+        return numpy.where(a != 0, numpy.log2(a), numpy.log2(self.eps))
+
+    @lazyCoefficient
+    def HX(self):
+        """ Entropy of px. shape = (distances.size, directions) """
+        return (-1) * numpy.sum(self.px * self._log2(self.px), 0)
+
+    @lazyCoefficient
+    def HY(self):
+        """ Entropy of py. shape = (distances.size, directions) """
+        return (-1) * numpy.sum(self.py * self._log2(self.py), 0)
+
+    @lazyCoefficient
+    def HXY(self):
+        """ shape = (distances.size, directions) """
+        return (-1) * numpy.sum(numpy.sum(self.P_glcm * self._log2(self.P_glcm), 0), 0)
+
+    @lazyCoefficient
+    def pxyLog2(self):
+        """ log2 of pxy. shape = (Ng, Ng, distances.size, directions) """
+        return self._log2(self.pxy)
+
+    @lazyCoefficient
+    def HXY1(self):
+        """ shape = (distances.size, directions) """
+        return (-1) * numpy.sum(numpy.sum(self.P_glcm * self.pxyLog2, 0), 0)
+
+    @lazyCoefficient
+    def HXY2(self):
+        """ shape = (distances.size, directions) """
+        return (-1) * numpy.sum(numpy.sum(self.pxy * self.pxyLog2, 0), 0)
@@ -0,0 +1,330 @@
+import math
+import operator
+import collections
+import csv
+import logging
+import time
+import numpy as np
+
+import FeatureExtractionLib
+
+
+class FeatureExtractor(object):
+    """ Run the feature analysis (FeatureExtractionLib classes) for a region of interest without any dependency on
+    Slicer or Qt, so that it can be used in headless batch processes.
+    Progress and cancellation are reported with plain callbacks.
+
+    Example (batch of cases in a worker machine, with the CIP_LesionModel folder in the python path):
+        from FeatureExtractionLib import FeatureExtractor
+        FeatureExtractor.runBatch([("case1", "/data/case1.nrrd", "/data/case1_nodule.nrrd")],
+                                  ["First-Order Statistics", "Texture: GLCM"], ["Mean Intensity", "Contrast"],
+                                  "/data/results.csv")
+    """
+    def __init__(self, volumeArray, spacing, labelmapROIArray, featureCategoriesKeys, featureKeys,
+                 labelmapWholeVolumeArray=None, description="", progressCallback=None, cancelCallback=None):
+        """
+        :param volumeArray: numpy array with the intensities of the volume (ZYX)
+        :param spacing: spacing of the volume (XYZ)
+        :param labelmapROIArray: numpy array with the labelmap of the area to study (ex: tumor)
+        :param featureCategoriesKeys: main categories that have some feature that is going to be analyzed
+        :param featureKeys: features that are going to be analyzed
+        :param labelmapWholeVolumeArray: numpy array that represents a labelmap for the whole volume (different
+            from 'labelMapROIArray' that represents just the area of interest that is going to be analyzed)
+        :param description: description of the analysis that will be passed to the progress callback
+        :param progressCallback: function(description, categoryName, numFeaturesCalculated, numFeatures) that
+            will be invoked before each one of the categories is analyzed
+        :param cancelCallback: function that returns True when the process must be cancelled. It will be invoked
+            regularly during the analysis
+        """
+        self.volumeArray = volumeArray
+        self.spacing = spacing
+        self.labelmapROIArray = labelmapROIArray
+        self.featureCategoriesKeys = featureCategoriesKeys
+        self.featureKeys = featureKeys
+        self.labelmapWholeVolumeArray = labelmapWholeVolumeArray
+        self.description = description
+        self.progressCallback = progressCallback
+        self.cancelCallback = cancelCallback
+
+        self.__analysisResultsDict__ = None
+        self.__analysisTimingDict__ = None
+
+    @property
+    def AnalysisResultsDict(self):
+        """ Dictionary with FeatureKey-FeatureValue for all the analysis performed
+        :return:
+        """
+        return self.__analysisResultsDict__
+
+    @property
+    def AnalysisTimingsDict(self):
+        """ Dictionary with FeatureKey-FeatureValue for all the analysis performed
+        :return:
+        """
+        return self.__analysisTimingDict__
+
+    def run(self, resultsStorage, printTiming=False, resultsStorageTiming=None):
+        """ Run all the selected analysis
+        :return:
+            If printTiming==False: Dictionary of Feature-Value with all the features analyzed
+            else: tuple with 2 dictionaries (1 of Feature-Value and another one with Feature-Timing)
+        """
+        t1 = time.time()
+        # extract voxel coordinates (ijk) and values from self.dataNode within the ROI defined by self.labelmapNode
+        self.targetVoxels, self.targetVoxelsCoordinates = self.tumorVoxelsAndCoordinates(self.labelmapROIArray, self.volumeArray)
+        if printTiming:
+            print("Time to calculate tumorVoxelsAndCoordinates: {0} seconds".format(time.time() - t1))
+        self.checkStopProcess()
+
+        # create a padded, rectangular matrix with shape equal to the shape of the tumor
+        t1 = time.time()
+        self.matrix, self.matrixCoordinates = self.paddedTumorMatrixAndCoordinates(self.targetVoxels, self.targetVoxelsCoordinates)
+        if printTiming:
+            print("Time to calculate paddedTumorMatrixAndCoordinates: {0} seconds".format(time.time() - t1))
+        self.checkStopProcess()
+
+        # get Histogram data
+        t1 = time.time()
+        self.bins, self.grayLevels, self.numGrayLevels = self.getHistogramData(self.targetVoxels)
+        if printTiming:
+            print("Time to calculate histogram: {0} seconds".format(time.time() - t1))
+        self.checkStopProcess()
+
+        ########
+        self.__analysisResultsDict__ = resultsStorage
+        if printTiming:
+            self.__analysisTimingDict__ = resultsStorageTiming
+
+        # First Order Statistics
+        if "First-Order Statistics" in self.featureCategoriesKeys:
+            self.updateProgress("First-Order Statistics")
+            self.firstOrderStatistics = FeatureExtractionLib.FirstOrderStatistics(self.targetVoxels, self.bins, self.numGrayLevels, self.featureKeys)
+            t1 = time.time()
+            results = self.firstOrderStatistics.EvaluateFeatures(printTiming, self.checkStopProcess)
+            if printTiming:
+                self.__analysisResultsDict__.update(results[0])
+                self.__analysisTimingDict__.update(results[1])
+                print("Time to calculate First Order Statistics: {0} seconds".format(time.time() - t1))
+            else:
+                self.__analysisResultsDict__.update(results)
+
+        # Shape/Size and Morphological Features)
+        if "Morphology and Shape" in self.featureCategoriesKeys:
+            self.updateProgress("Morphology and Shape Statistics")
+            # extend padding by one row/column for all 6 directions
+            if len(self.matrix) == 0:
+                matrixSA = self.matrix
+                matrixSACoordinates = self.matrixCoordinates
+            else:
+                maxDimsSA = tuple(map(operator.add, self.matrix.shape, ([2,2,2])))
+                matrixSA, matrixSACoordinates = self.padMatrix(self.matrix, self.matrixCoordinates, maxDimsSA, self.targetVoxels)
+            self.morphologyStatistics = FeatureExtractionLib.MorphologyStatistics(self.spacing, matrixSA, matrixSACoordinates, self.targetVoxels, self.featureKeys)
+            t1 = time.time()
+            results = self.morphologyStatistics.EvaluateFeatures(printTiming, self.checkStopProcess)
+            if printTiming:
+                self.__analysisResultsDict__.update(results[0])
+                self.__analysisTimingDict__.update(results[1])
+                print("Time to calculate Morphology and Shape: {0} seconds".format(time.time() - t1))
+            else:
+                self.__analysisResultsDict__.update(results)
+
+        # Texture Features(GLCM)
+        if "Texture: GLCM" in self.featureCategoriesKeys:
+            self.updateProgress("GLCM Texture Features")
+            self.textureFeaturesGLCM = FeatureExtractionLib.TextureGLCM(self.grayLevels, self.numGrayLevels, self.matrix, self.matrixCoordinates, self.targetVoxels, self.featureKeys, self.checkStopProcess)
+            t1 = time.time()
+            results =self.textureFeaturesGLCM.EvaluateFeatures(printTiming, self.checkStopProcess)
+            if printTiming:
+                self.__analysisResultsDict__.update(results[0])
+                self.__analysisTimingDict__.update(results[1])
+                print("Time to calculate Texture: GLCM: {0} seconds".format(time.time() - t1))
+            else:
+                self.__analysisResultsDict__.update(results)
+
+        # Texture Features(GLRL)
+        if "Texture: GLRL" in self.featureCategoriesKeys:
+            self.updateProgress("GLRL Texture Features")
+            self.textureFeaturesGLRL = FeatureExtractionLib.TextureGLRL(self.grayLevels, self.numGrayLevels, self.matrix, self.matrixCoordinates, self.targetVoxels, self.featureKeys)
+            t1 = time.time()
+            results =self.textureFeaturesGLRL.EvaluateFeatures(printTiming, self.checkStopProcess)
+            if printTiming:
+                self.__analysisResultsDict__.update(results[0])
+                self.__analysisTimingDict__.update(results[1])
+                print("Time to calculate Texture: GLRL: {0} seconds".format(time.time() - t1))
+            else:
+                self.__analysisResultsDict__.update(results)
+
+        # Geometrical Measures
+        if "Geometrical Measures" in self.featureCategoriesKeys:
+            self.updateProgress("Geometrical Measures")
+            self.geometricalMeasures = FeatureExtractionLib.GeometricalMeasures(self.spacing, self.matrix, self.matrixCoordinates, self.targetVoxels, self.featureKeys)
+            t1 = time.time()
+            results =self.geometricalMeasures.EvaluateFeatures(printTiming, self.checkStopProcess)
+            if printTiming:
+                self.__analysisResultsDict__.update(results[0])
+                self.__analysisTimingDict__.update(results[1])
+                print("Time to calculate Geometrical Measures: {0} seconds".format(time.time() - t1))
+            else:
+                self.__analysisResultsDict__.update(results)
+
+        # Renyi Dimensions
+        if "Renyi Dimensions" in self.featureCategoriesKeys:
+            self.updateProgress("Renyi Dimensions")
+            # extend padding to dimension lengths equal to next power of 2
+            maxDims = tuple( [int(pow(2, math.ceil(np.log2(np.max(self.matrix.shape)))))] * 3 )
+            matrixPadded, matrixPaddedCoordinates = self.padMatrix(self.matrix, self.matrixCoordinates, maxDims, self.targetVoxels)
+            self.renyiDimensions = FeatureExtractionLib.RenyiDimensions(matrixPadded, matrixPaddedCoordinates, self.featureKeys)
+            t1 = time.time()
+            results =self.renyiDimensions.EvaluateFeatures(printTiming, self.checkStopProcess)
+            if printTiming:
+                self.__analysisResultsDict__.update(results[0])
+                self.__analysisTimingDict__.update(results[1])
+                print("Time to calculate Renyi Dimensions: {0} seconds".format(time.time() - t1))
+            else:
+                self.__analysisResultsDict__.update(results)
+
+        # Parenchymal Volume
+        if "Parenchymal Volume" in self.featureCategoriesKeys:
+            self.updateProgress("Parenchymal Volume")
+            self.parenchymalVolume = FeatureExtractionLib.ParenchymalVolume(self.labelmapWholeVolumeArray, self.labelmapROIArray,
+                                                        self.spacing, self.featureKeys)
+            t1 = time.time()
+            results =self.parenchymalVolume.EvaluateFeatures(printTiming, self.checkStopProcess)
+            if printTiming:
+                self.__analysisResultsDict__.update(results[0])
+                self.__analysisTimingDict__.update(results[1])
+                print("Time to calculate Parenchymal Volume: {0} seconds".format(time.time() - t1))
+            else:
+                self.__analysisResultsDict__.update(results)
+
+        self.updateProgress("Populating Summary Table")
+
+        # filter for user-queried features only
+        self.__analysisResultsDict__ = collections.OrderedDict((k, self.__analysisResultsDict__[k]) for k in self.featureKeys)
+
+        if not printTiming:
+            return self.__analysisResultsDict__
+        else:
+            return self.__analysisResultsDict__, self.__analysisTimingDict__
+
+    def tumorVoxelsAndCoordinates(self, arrayROI, arrayDataNode):
+        coordinates = np.where(arrayROI != 0) # can define specific label values to target or avoid
+        values = arrayDataNode[coordinates].astype('int64')
+        return(values, coordinates)
+
+    def paddedTumorMatrixAndCoordinates(self, targetVoxels, targetVoxelsCoordinates):
+        if len(targetVoxels) == 0:
+            # Nothing to analyze
+            empty = np.array([])
+            return (empty, (empty, empty, empty))
+
+        ijkMinBounds = np.min(targetVoxelsCoordinates, 1)
+        ijkMaxBounds = np.max(targetVoxelsCoordinates, 1)
+        matrix = np.zeros(ijkMaxBounds - ijkMinBounds + 1)
+        matrixCoordinates = tuple(map(operator.sub, targetVoxelsCoordinates, tuple(ijkMinBounds)))
+        matrix[matrixCoordinates] = targetVoxels
+        return (matrix, matrixCoordinates)
+
+    def getHistogramData(self, voxelArray):
+        # with np.histogram(), all but the last bin is half-open, so make one extra bin container
+        binContainers = np.arange(voxelArray.min(), voxelArray.max()+2)
+        bins = np.histogram(voxelArray, bins=binContainers)[0] # frequencies
+        grayLevels = np.unique(voxelArray) # discrete gray levels
+        numGrayLevels = grayLevels.size
+        return (bins, grayLevels, numGrayLevels)
+
+    def padMatrix(self, a, matrixCoordinates, dims, voxelArray):
+        # pads matrix 'a' with zeros and resizes 'a' to a cube with dimensions increased to the next greatest power of 2
+        # numpy version 1.7 has np.pad function
+
+        # center coordinates onto padded matrix    # consider padding with NaN or eps = np.spacing(1)
+        pad = tuple(map(operator.div, tuple(map(operator.sub, dims, a.shape)), ([2,2,2])))
+        matrixCoordinatesPadded = tuple(map(operator.add, matrixCoordinates, pad))
+        matrix2 = np.zeros(dims)
+        matrix2[matrixCoordinatesPadded] = voxelArray
+        return (matrix2, matrixCoordinatesPadded)
+
+    def updateProgress(self, nextFeatureString):
+        """ Notify the progress callback (if any) that a new category is going to be analyzed
+        :param nextFeatureString: name of the category
+        """
+        self.checkStopProcess()
+        if self.progressCallback is not None:
+            self.progressCallback(self.description, nextFeatureString, len(self.__analysisResultsDict__),
+                                  len(self.featureKeys))
+
+    def checkStopProcess(self):
+        """ Raise a StopIteration exception if the cancel callback says that the process must be cancelled
+        """
+        if self.cancelCallback is not None and self.cancelCallback():
+            raise StopIteration("Progress cancelled!!!")
+
+    @staticmethod
+    def readImageArray(filePath):
+        """ Read a volume from a file (any format supported by SimpleITK)
+        :param filePath: full path to the file
+        :return: tuple with a numpy array (ZYX) and the spacing of the volume (XYZ)
+        """
+        import SimpleITK as sitk
+        image = sitk.ReadImage(filePath)
+        return sitk.GetArrayFromImage(image), image.GetSpacing()
+
+    @staticmethod
+    def runCase(volumeFilePath, labelmapFilePath, featureCategoriesKeys, featureKeys, labelmapWholeVolumeFilePath=None,
+                description="", progressCallback=None, cancelCallback=None):
+        """ Analyze a single case from files
+        :param volumeFilePath: path to the intensities volume
+        :param labelmapFilePath: path to the labelmap of the region that is going to be analyzed
+        :param featureCategoriesKeys: main categories that have some feature that is going to be analyzed
+        :param featureKeys: list of features that are going to be analyzed
+        :param labelmapWholeVolumeFilePath: path to the labelmap for the whole volume (only for Parenchymal Volume)
+        :param description: description passed to the progress callback
+        :param progressCallback: see constructor
+        :param cancelCallback: see constructor
+        :return: OrderedDict of FeatureKey-FeatureValue (in the same order as featureKeys)
+        """
+        volumeArray, spacing = FeatureExtractor.readImageArray(volumeFilePath)
+        labelmapArray = FeatureExtractor.readImageArray(labelmapFilePath)[0]
+        labelmapWholeVolumeArray = None
+        if labelmapWholeVolumeFilePath is not None:
+            labelmapWholeVolumeArray = FeatureExtractor.readImageArray(labelmapWholeVolumeFilePath)[0]
+        extractor = FeatureExtractor(volumeArray, spacing, labelmapArray, set(featureCategoriesKeys), set(featureKeys),
+                                     labelmapWholeVolumeArray=labelmapWholeVolumeArray, description=description,
+                                     progressCallback=progressCallback, cancelCallback=cancelCallback)
+        results = extractor.run(collections.OrderedDict())
+        return collections.OrderedDict((k, results[k]) for k in featureKeys)
+
+    @staticmethod
+    def runBatch(cases, featureCategoriesKeys, featureKeys, outputFilePath, progressCallback=None,
+                 cancelCallback=None):
+        """ Analyze a list of cases and write one row per case in a CSV file.
+        Every row is written (and flushed) as soon as the case is finished, so that the results are not lost if the
+        process is interrupted. Cases that fail are logged and skipped
+        :param cases: list of tuples (caseId, volumeFilePath, labelmapFilePath[, labelmapWholeVolumeFilePath])
+        :param featureCategoriesKeys: main categories that have some feature that is going to be analyzed
+        :param featureKeys: list of features that are going to be analyzed (columns of the file)
+        :param outputFilePath: path to the CSV file
+        :param progressCallback: see constructor. The description will be the caseId
+        :param cancelCallback: see constructor
+        :return: list of the caseIds that could not be analyzed
+        """
+        failedCases = []
+        with open(outputFilePath, "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow(["CaseId"] + list(featureKeys))
+            for case in cases:
+                caseId = case[0]
+                try:
+                    results = FeatureExtractor.runCase(case[1], case[2], featureCategoriesKeys, featureKeys,
+                                                       labelmapWholeVolumeFilePath=case[3] if len(case) > 3 else None,
+                                                       description=caseId, progressCallback=progressCallback,
+                                                       cancelCallback=cancelCallback)
+                except StopIteration:
+                    raise
+                except Exception as ex:
+                    logging.error("Case {} could not be analyzed: {}".format(caseId, ex))
+                    failedCases.append(caseId)
+                    continue
+                writer.writerow([caseId] + list(results.values()))
+                f.flush()
+        return failedCases
@@ -1,4 +1,3 @@
-from __main__ import vtk, qt, ctk, slicer
 import string
 import numpy
 import math
@@ -6,6 +5,8 @@ import operator
 import collections
 import time
 
+from CoefficientsCache import FirstOrderCoefficients
+
 class FirstOrderStatistics:
     def __init__(self, parameterValues, bins, grayLevels, allKeys):
         """
@@ -18,26 +19,28 @@ class FirstOrderStatistics:
         self.firstOrderStatisticsTiming = collections.OrderedDict()
         self.firstOrderStatistics["Voxel Count"] = "self.voxelCount(self.parameterValues)"
         self.firstOrderStatistics["Gray Levels"] = "self.grayLevelCount(self.grayLevels)"
-        self.firstOrderStatistics["Energy"] = "self.energyValue(self.parameterValues)"
-        self.firstOrderStatistics["Entropy"] = "self.entropyValue(self.bins)"
-        self.firstOrderStatistics["Minimum Intensity"] = "self.minIntensity(self.parameterValues)"
-        self.firstOrderStatistics["Maximum Intensity"] = "self.maxIntensity(self.parameterValues)"
-        self.firstOrderStatistics["Mean Intensity"] = "self.meanIntensity(self.parameterValues)"
+        self.firstOrderStatistics["Energy"] = "self.energyValue(self.coefficients)"
+        self.firstOrderStatistics["Entropy"] = "self.entropyValue(self.coefficients)"
+        self.firstOrderStatistics["Minimum Intensity"] = "self.minIntensity(self.coefficients)"
+        self.firstOrderStatistics["Maximum Intensity"] = "self.maxIntensity(self.coefficients)"
+        self.firstOrderStatistics["Mean Intensity"] = "self.meanIntensity(self.coefficients)"
         self.firstOrderStatistics["Median Intensity"] = "self.medianIntensity(self.parameterValues)"
-        self.firstOrderStatistics["Range"] = "self.rangeIntensity(self.parameterValues)"
-        self.firstOrderStatistics["Mean Deviation"] = "self.meanDeviation(self.parameterValues)"
-        self.firstOrderStatistics["Root Mean Square"] = "self.rootMeanSquared(self.parameterValues)"
-        self.firstOrderStatistics["Standard Deviation"] = "self.standardDeviation(self.parameterValues)"
+        self.firstOrderStatistics["Range"] = "self.rangeIntensity(self.coefficients)"
+        self.firstOrderStatistics["Mean Deviation"] = "self.meanDeviation(self.coefficients)"
+        self.firstOrderStatistics["Root Mean Square"] = "self.rootMeanSquared(self.coefficients)"
+        self.firstOrderStatistics["Standard Deviation"] = "self.standardDeviation(self.coefficients)"
         self.firstOrderStatistics["Ventilation Heterogeneity"] = "self.ventilationHeterogeneity(self.parameterValues)"
-        self.firstOrderStatistics["Skewness"] = "self.skewnessValue(self.parameterValues)"
-        self.firstOrderStatistics["Kurtosis"] = "self.kurtosisValue(self.parameterValues)"
-        self.firstOrderStatistics["Variance"] = "self.varianceValue(self.parameterValues)"
+        self.firstOrderStatistics["Skewness"] = "self.skewnessValue(self.coefficients)"
+        self.firstOrderStatistics["Kurtosis"] = "self.kurtosisValue(self.coefficients)"
+        self.firstOrderStatistics["Variance"] = "self.varianceValue(self.coefficients)"
         self.firstOrderStatistics["Uniformity"] = "self.uniformityValue(self.bins)"
 
         self.parameterValues = parameterValues
         self.bins = bins
         self.grayLevels = grayLevels
         self.keys = set(allKeys).intersection(self.firstOrderStatistics.keys())
+        # Intermediate values (mean, moments, etc.) shared by the different features
+        self.coefficients = FirstOrderCoefficients(parameterValues, bins)
 
     def voxelCount(self, parameterArray):
         return (parameterArray.size)
@@ -45,35 +48,35 @@ class FirstOrderStatistics:
     def grayLevelCount(self, grayLevels):
         return (grayLevels)
 
-    def energyValue(self, parameterArray):
-        return (numpy.sum(parameterArray ** 2))
+    def energyValue(self, coefficients):
+        return (coefficients.sumSquares)
 
-    def entropyValue(self, bins):
-        return (numpy.sum(bins * numpy.where(bins != 0, numpy.log2(bins), 0)))
+    def entropyValue(self, coefficients):
+        return (numpy.sum(coefficients.bins * coefficients.binsLog2))
 
-    def minIntensity(self, parameterArray):
-        return (numpy.min(parameterArray))
+    def minIntensity(self, coefficients):
+        return (coefficients.minimum)
 
-    def maxIntensity(self, parameterArray):
-        return (numpy.max(parameterArray))
+    def maxIntensity(self, coefficients):
+        return (coefficients.maximum)
 
-    def meanIntensity(self, parameterArray):
-        return (numpy.mean(parameterArray))
+    def meanIntensity(self, coefficients):
+        return (coefficients.mean)
 
     def medianIntensity(self, parameterArray):
         return (numpy.median(parameterArray))
 
-    def rangeIntensity(self, parameterArray):
-        return (numpy.max(parameterArray) - numpy.min(parameterArray))
+    def rangeIntensity(self, coefficients):
+        return (coefficients.maximum - coefficients.minimum)
 
-    def meanDeviation(self, parameterArray):
-        return (numpy.mean(numpy.absolute((numpy.mean(parameterArray) - parameterArray))))
+    def meanDeviation(self, coefficients):
+        return (numpy.mean(numpy.absolute(coefficients.deviations)))
 
-    def rootMeanSquared(self, parameterArray):
-        return (((numpy.sum(parameterArray ** 2)) / (parameterArray.size)) ** (1 / 2.0))
+    def rootMeanSquared(self, coefficients):
+        return ((coefficients.sumSquares / (coefficients.parameterValues.size)) ** (1 / 2.0))
 
-    def standardDeviation(self, parameterArray):
-        return (numpy.std(parameterArray))
+    def standardDeviation(self, coefficients):
+        return (coefficients.std)
 
     def ventilationHeterogeneity(self, parameterArray):
         # Keep just the points that are in the range (-1000, 0]
@@ -85,21 +88,12 @@ class FirstOrderStatistics:
         arr **= (1/3.0)
         return arr.std()
 
-    def _moment(self, a, moment=1, axis=0):
-        # Modified from SciPy module
-        if moment == 1:
-            return numpy.float64(0.0)
-        else:
-            mn = numpy.expand_dims(numpy.mean(a, axis), axis)
-            s = numpy.power((a - mn), moment)
-            return numpy.mean(s, axis)
-
-    def skewnessValue(self, a, axis=0):
+    def skewnessValue(self, coefficients):
         # Modified from SciPy module
-        # Computes the skewness of a dataset
+        # Computes the skewness of a dataset (the central moments are shared with the other features)
 
-        m2 = self._moment(a, 2, axis)
-        m3 = self._moment(a, 3, axis)
+        m2 = numpy.asarray(coefficients.moment2)
+        m3 = numpy.asarray(coefficients.moment3)
 
         # Control Flow: if m2==0 then vals = 0; else vals = m3/m2**1.5
         zero = (m2 == 0)
@@ -109,11 +103,11 @@ class FirstOrderStatistics:
             return vals.item()
         return vals
 
-    def kurtosisValue(self, a, axis=0, fisher=True):
+    def kurtosisValue(self, coefficients, fisher=True):
         # Modified from SciPy module
 
-        m2 = self._moment(a, 2, axis)
-        m4 = self._moment(a, 4, axis)
+        m2 = numpy.asarray(coefficients.moment2)
+        m4 = numpy.asarray(coefficients.moment4)
         zero = (m2 == 0)
 
         # Set Floating-Point Error Handling
@@ -130,8 +124,8 @@ class FirstOrderStatistics:
         else:
             return vals
 
-    def varianceValue(self, parameterArray):
-        return (numpy.std(parameterArray) ** 2)
+    def varianceValue(self, coefficients):
+        return (coefficients.std ** 2)
 
     def uniformityValue(self, bins):
         return (numpy.sum(bins ** 2))
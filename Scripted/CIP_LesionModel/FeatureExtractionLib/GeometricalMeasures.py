@@ -1,4 +1,3 @@
-from __main__ import vtk, qt, ctk, slicer
 import string
 import numpy
 import math
@@ -12,11 +11,11 @@ class GeometricalMeasures:
         self.GeometricalMeasures = collections.OrderedDict()
         self.GeometricalMeasuresTiming = collections.OrderedDict()
         self.GeometricalMeasures[
-            "Extruded Surface Area"] = "self.extrudedSurfaceArea(self.labelNodeSpacing, self.extrudedMatrix, self.extrudedMatrixCoordinates, self.parameterValues)"
+            "Extruded Surface Area"] = "self.extrudedSurfaceArea(self.labelNodeSpacing, self.extrudedHeights)"
         self.GeometricalMeasures[
-            "Extruded Volume"] = "self.extrudedVolume(self.extrudedMatrix, self.extrudedMatrixCoordinates, self.cubicMMPerVoxel)"
+            "Extruded Volume"] = "self.extrudedVolume(self.extrudedHeights, self.cubicMMPerVoxel)"
         self.GeometricalMeasures[
-            "Extruded Surface:Volume Ratio"] = "self.extrudedSurfaceVolumeRatio(self.labelNodeSpacing, self.extrudedMatrix, self.extrudedMatrixCoordinates, self.parameterValues, self.cubicMMPerVoxel)"
+            "Extruded Surface:Volume Ratio"] = "self.extrudedSurfaceVolumeRatio(self.labelNodeSpacing, self.extrudedHeights, self.cubicMMPerVoxel)"
 
         self.labelNodeSpacing = labelNodeSpacing
         self.parameterMatrix = parameterMatrix
@@ -26,11 +25,10 @@ class GeometricalMeasures:
 
         if self.keys:
             self.cubicMMPerVoxel = reduce(lambda x, y: x * y, labelNodeSpacing)
-            self.extrudedMatrix, self.extrudedMatrixCoordinates = self.extrudeMatrix(self.parameterMatrix,
-                                                                                     self.parameterMatrixCoordinates,
-                                                                                     self.parameterValues)
+            self.extrudedHeights = self.extrudeMatrix(self.parameterMatrix, self.parameterMatrixCoordinates,
+                                                      self.parameterValues)
 
-    def extrudedSurfaceArea(self, labelNodeSpacing, extrudedMatrix, extrudedMatrixCoordinates, parameterValues):
+    def extrudedSurfaceArea(self, labelNodeSpacing, extrudedHeights):
         x, y, z = labelNodeSpacing
 
         # surface areas of directional connections
@@ -39,56 +37,43 @@ class GeometricalMeasures:
         xy = x * y
         fourD = (2 * xy + 2 * xz + 2 * yz)
 
-        totalVoxelSurfaceArea4D = (2 * xy + 2 * xz + 2 * yz + 2 * fourD)
-        totalSA = parameterValues.size * totalVoxelSurfaceArea4D
-
-        # in matrixSACoordinates
-        # i: height (z), j: vertical (y), k: horizontal (x), l: 4th or extrusion dimension
-        i, j, k, l = 0, 0, 0, 0
-        extrudedSurfaceArea = 0
-
-        # vectorize
-        for i, j, k, l_slice in zip(*extrudedMatrixCoordinates):
-            for l in xrange(l_slice.start, l_slice.stop):
-                fxy = numpy.array([extrudedMatrix[i + 1, j, k, l], extrudedMatrix[i - 1, j, k, l]]) == 0
-                fyz = numpy.array([extrudedMatrix[i, j + 1, k, l], extrudedMatrix[i, j - 1, k, l]]) == 0
-                fxz = numpy.array([extrudedMatrix[i, j, k + 1, l], extrudedMatrix[i, j, k - 1, l]]) == 0
-                f4d = numpy.array([extrudedMatrix[i, j, k, l + 1], extrudedMatrix[i, j, k, l - 1]]) == 0
-
-                extrudedElementSurface = (numpy.sum(fxz) * xz) + (numpy.sum(fyz) * yz) + (numpy.sum(fxy) * xy) + (
-                numpy.sum(f4d) * fourD)
-                extrudedSurfaceArea += extrudedElementSurface
+        # in extrudedHeights
+        # i: height (z), j: vertical (y), k: horizontal (x). The 4th or extrusion dimension (l) is the value
+        # The extruded element (i, j, k, l) exists for 1 <= l <= extrudedHeights[i, j, k], so:
+        # - in the 4th dimension, every column with height > 0 has exposed faces just at the top and the bottom
+        # - between two neighbor columns with heights h1 and h2 there are |h1 - h2| exposed faces
+        f4d = 2 * numpy.count_nonzero(extrudedHeights)
+        faces = []
+        for axis in xrange(3):
+            faces.append(numpy.sum(numpy.abs(numpy.diff(extrudedHeights, axis=axis))))
+        fxy, fyz, fxz = faces
+
+        extrudedSurfaceArea = (fxz * xz) + (fyz * yz) + (fxy * xy) + (f4d * fourD)
         return (extrudedSurfaceArea)
 
-    def extrudedVolume(self, extrudedMatrix, extrudedMatrixCoordinates, cubicMMPerVoxel):
-        extrudedElementsSize = extrudedMatrix[numpy.where(extrudedMatrix == 1)].size
+    def extrudedVolume(self, extrudedHeights, cubicMMPerVoxel):
+        extrudedElementsSize = numpy.sum(extrudedHeights)
         return (extrudedElementsSize * cubicMMPerVoxel)
 
-    def extrudedSurfaceVolumeRatio(self, labelNodeSpacing, extrudedMatrix, extrudedMatrixCoordinates, parameterValues,
-                                   cubicMMPerVoxel):
-        extrudedSurfaceArea = self.extrudedSurfaceArea(labelNodeSpacing, extrudedMatrix, extrudedMatrixCoordinates,
-                                                       parameterValues)
-        extrudedVolume = self.extrudedVolume(extrudedMatrix, extrudedMatrixCoordinates, cubicMMPerVoxel)
+    def extrudedSurfaceVolumeRatio(self, labelNodeSpacing, extrudedHeights, cubicMMPerVoxel):
+        extrudedSurfaceArea = self.extrudedSurfaceArea(labelNodeSpacing, extrudedHeights)
+        extrudedVolume = self.extrudedVolume(extrudedHeights, cubicMMPerVoxel)
         return (extrudedSurfaceArea / extrudedVolume)
 
     def extrudeMatrix(self, parameterMatrix, parameterMatrixCoordinates, parameterValues):
         # extrude 3D image into a binary 4D array with the intensity or parameter value as the 4th Dimension
         # need to normalize CT images with a shift of 120 Hounsfield units
+        # The 4D array is not built explicitly: every (i, j, k) column of the 4D array is filled from 1 to the
+        # parameter value, so it is fully represented by a 3D matrix of heights
 
         parameterValues = numpy.abs(parameterValues)
 
-        # maximum intensity/parameter value appended as shape of 4th dimension
-        extrudedShape = parameterMatrix.shape + (numpy.max(parameterValues),)
+        # pad shape by 1 unit in all directions
+        extrudedShape = tuple(map(operator.add, parameterMatrix.shape, [2, 2, 2]))
 
-        # pad shape by 1 unit in all 8 directions
-        extrudedShape = tuple(map(operator.add, extrudedShape, [2, 2, 2, 2]))
-
-        extrudedMatrix = numpy.zeros(extrudedShape)
-        extrudedMatrixCoordinates = tuple(map(operator.add, parameterMatrixCoordinates, ([1, 1, 1]))) + (
-        numpy.array([slice(1, value + 1) for value in parameterValues]),)
-        for slice4D in zip(*extrudedMatrixCoordinates):
-            extrudedMatrix[slice4D] = 1
-        return (extrudedMatrix, extrudedMatrixCoordinates)
+        extrudedHeights = numpy.zeros(extrudedShape, dtype=numpy.int64)
+        extrudedHeights[tuple(map(operator.add, parameterMatrixCoordinates, ([1, 1, 1])))] = parameterValues
+        return (extrudedHeights)
 
     def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None):
         # Evaluate dictionary elements corresponding to user-selected keys
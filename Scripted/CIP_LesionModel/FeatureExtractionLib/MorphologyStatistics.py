@@ -1,4 +1,3 @@
-from __main__ import vtk, qt, ctk, slicer
 import string
 import numpy
 import math
@@ -50,24 +49,29 @@ class MorphologyStatistics:
         xz = x * z
         yz = y * z
         xy = x * y
-        voxelTotalSA = (2 * xy + 2 * xz + 2 * yz)
-        totalSA = matrixSAValues.size * voxelTotalSA
 
         # in matrixSACoordinates
         # i corresponds to height (z)
         # j corresponds to vertical (y)
         # k corresponds to horizontal (x)
 
-        i, j, k = 0, 0, 0
-        surfaceArea = 0
-        for voxel in xrange(0, matrixSAValues.size):
-            i, j, k = matrixSACoordinates[0][voxel], matrixSACoordinates[1][voxel], matrixSACoordinates[2][voxel]
-            fxy = (numpy.array([a[i + 1, j, k], a[i - 1, j, k]]) == 0)  # evaluate to 1 if true, 0 if false
-            fyz = (numpy.array([a[i, j + 1, k], a[i, j - 1, k]]) == 0)  # evaluate to 1 if true, 0 if false
-            fxz = (numpy.array([a[i, j, k + 1], a[i, j, k - 1]]) == 0)  # evaluate to 1 if true, 0 if false
-            surface = (numpy.sum(fxz) * xz) + (numpy.sum(fyz) * yz) + (numpy.sum(fxy) * xy)
-            surfaceArea += surface
-        return (surfaceArea)
+        # Count the faces of the ROI voxels that have an empty neighbor (0) in each direction, comparing
+        # the ROI mask with the empty mask shifted one voxel (a is padded, so all the neighbors are in the matrix)
+        roi = numpy.zeros(a.shape, dtype=bool)
+        roi[matrixSACoordinates] = True
+        empty = (a == 0)
+        faces = []
+        for axis in xrange(3):
+            lower = [slice(None)] * 3
+            upper = [slice(None)] * 3
+            lower[axis] = slice(None, -1)
+            upper[axis] = slice(1, None)
+            lower = tuple(lower)
+            upper = tuple(upper)
+            faces.append(numpy.count_nonzero(roi[lower] & empty[upper]) +
+                         numpy.count_nonzero(roi[upper] & empty[lower]))
+        fxy, fyz, fxz = faces
+        return ((fxz * xz) + (fyz * yz) + (fxy * xy))
 
     def surfaceVolumeRatio(self, surfaceArea, volumeMM3):
         return (surfaceArea / volumeMM3)
@@ -88,20 +92,57 @@ class MorphologyStatistics:
         maxBounds = numpy.array(
             [numpy.max(matrixSACoordinates[0]), numpy.max(matrixSACoordinates[1]), numpy.max(matrixSACoordinates[2])])
 
-        a = numpy.array(zip(*matrixSACoordinates))
+        a = numpy.column_stack(matrixSACoordinates)
         edgeVoxelsMinCoords = numpy.vstack(
             [a[a[:, 0] == minBounds[0]], a[a[:, 1] == minBounds[1]], a[a[:, 2] == minBounds[2]]]) * [z, y, x]
         edgeVoxelsMaxCoords = numpy.vstack(
             [(a[a[:, 0] == maxBounds[0]] + 1), (a[a[:, 1] == maxBounds[1]] + 1), (a[a[:, 2] == maxBounds[2]] + 1)]) * [
                                   z, y, x]
 
-        maxDiameter = 1
-        for voxel1 in edgeVoxelsMaxCoords:
-            for voxel2 in edgeVoxelsMinCoords:
-                voxelDistance = numpy.sqrt(numpy.sum((voxel2 - voxel1) ** 2))
-                if voxelDistance > maxDiameter:
-                    maxDiameter = voxelDistance
-        return (maxDiameter)
+        # The farthest point of a set from any other point is always a vertex of its convex hull, so only the
+        # hull vertices of both sets of edge voxels need to be compared
+        edgeVoxelsMinCoords = self.convexHullVertices(edgeVoxelsMinCoords)
+        edgeVoxelsMaxCoords = self.convexHullVertices(edgeVoxelsMaxCoords)
+        maxDiameter = self.maximumDistance(edgeVoxelsMaxCoords, edgeVoxelsMinCoords)
+        return (max(maxDiameter, 1))
+
+    def maximumDistance(self, points1, points2, blockSize=1000000):
+        """ Maximum euclidean distance between any point of a set and any point of another set.
+        The distances are computed in blocks of rows, so that the memory used is bounded
+        :param points1: Nx3 array
+        :param points2: Mx3 array
+        :param blockSize: approximate number of distances computed at once
+        :return: maximum distance
+        """
+        points1 = numpy.asarray(points1, dtype=numpy.float64)
+        points2 = numpy.asarray(points2, dtype=numpy.float64)
+        rowsPerBlock = max(1, blockSize // max(1, len(points2)))
+        maxSquaredDistance = 0
+        for first in xrange(0, len(points1), rowsPerBlock):
+            diff = points1[first:first + rowsPerBlock, numpy.newaxis, :] - points2[numpy.newaxis, :, :]
+            maxSquaredDistance = max(maxSquaredDistance, (diff ** 2).sum(axis=2).max())
+        return numpy.sqrt(maxSquaredDistance)
+
+    def convexHullVertices(self, points):
+        """ Vertices of the convex hull of a set of 3D points
+        :param points: Nx3 array
+        :return: array with the points that are vertices of the convex hull (all the points if the hull cannot be
+            calculated or scipy is not available)
+        """
+        points = numpy.ascontiguousarray(points, dtype=numpy.float64)
+        points = numpy.unique(points.view([('', points.dtype)] * 3)).view(points.dtype).reshape(-1, 3)
+        if len(points) <= 4:
+            return points
+        try:
+            # scipy is optional. Without it, all the points are compared
+            from scipy.spatial import ConvexHull
+        except ImportError:
+            return points
+        try:
+            # Joggle the input (QJ) so that coplanar or collinear sets of points (ex: a single slice) also have a hull
+            return points[ConvexHull(points, qhull_options="QJ").vertices]
+        except Exception:
+            return points
 
     def sphericalDisproportion(self, surfaceArea, volumeMM3):
         R = ((0.75 * (volumeMM3)) / (math.pi) ** (1 / 3.0))
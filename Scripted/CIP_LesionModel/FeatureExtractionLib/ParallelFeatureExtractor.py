@@ -0,0 +1,249 @@
+import collections
+import multiprocessing
+import multiprocessing.sharedctypes
+import numpy as np
+
+from FeatureExtractor import FeatureExtractor
+
+# Arrays shared with the worker processes (name-(buffer, dtype, shape)). Set by _initWorker
+_sharedArrays = None
+
+
+def _initWorker(sharedArrays):
+    """ Initializer of the worker processes. The shared buffers are passed here (instead of in every job) so that
+    the arrays are inherited/mapped by the workers and never pickled
+    :param sharedArrays: dictionary of name-(buffer, dtype, shape)
+    """
+    global _sharedArrays
+    _sharedArrays = sharedArrays
+
+
+def _getSharedArray(name):
+    """ Numpy view of a shared buffer (no copy)
+    :param name: name of the array
+    :return: numpy array or None if name is None
+    """
+    if name is None:
+        return None
+    buf, dtype, shape = _sharedArrays[name]
+    return np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _runJob(job, progressCallback=None, cancelCallback=None):
+    """ Analyze some categories of a single region (in a worker process or in the current one)
+    :param job: tuple (regionKey, categories, featureKeys, labelmapName, labelmapWholeVolumeName, spacing,
+        printTiming)
+    :param progressCallback: FeatureExtractor progress callback (only when the job runs in the current process)
+    :param cancelCallback: FeatureExtractor cancel callback (only when the job runs in the current process)
+    :return: tuple (regionKey, categories, results, timings)
+    """
+    regionKey, categories, featureKeys, labelmapName, labelmapWholeVolumeName, spacing, printTiming = job
+    extractor = FeatureExtractor(_getSharedArray("volume"), spacing, _getSharedArray(labelmapName), set(categories),
+                                 set(featureKeys), labelmapWholeVolumeArray=_getSharedArray(labelmapWholeVolumeName),
+                                 description=regionKey, progressCallback=progressCallback,
+                                 cancelCallback=cancelCallback)
+    timings = collections.OrderedDict()
+    results = extractor.run(collections.OrderedDict(), printTiming, timings)
+    if printTiming:
+        results = results[0]
+    return regionKey, categories, results, timings
+
+
+class ParallelFeatureExtractor(object):
+    """ Run the feature analysis for several regions of the same volume (ex: nodule and surrounding spheres) in a
+    pool of local processes.
+    In the pool, every (region, feature category) pair is an independent job. The volume and the labelmaps are
+    copied once to shared memory buffers, so the arrays are not pickled for every job.
+    With a single worker, every region is a single job that runs in the current process (the voxels of the region
+    are extracted just once), and the callbacks are checked inside the feature loops.
+
+    Example:
+        extractor = ParallelFeatureExtractor(volumeArray, spacing, featureClasses)
+        extractor.addRegion("nodule", noduleArray, ["First-Order Statistics", "Texture: GLCM"], ["Energy", "Contrast"])
+        extractor.addRegion("r15", sphereArray, ["First-Order Statistics"], ["Energy"])
+        results = extractor.run()
+    """
+    def __init__(self, volumeArray, spacing, featureClasses, numWorkers=None):
+        """
+        :param volumeArray: numpy array with the intensities of the volume (ZYX)
+        :param spacing: spacing of the volume (XYZ)
+        :param featureClasses: dictionary of FeatureCategory-list of FeatureKeys (used to split the features
+            between the jobs)
+        :param numWorkers: number of processes. When None, the number of cpus will be used. When 1, all the jobs
+            are run in the current process
+        """
+        self.volumeArray = volumeArray
+        self.spacing = tuple(spacing)
+        self.featureClasses = featureClasses
+        self.numWorkers = numWorkers if numWorkers is not None else multiprocessing.cpu_count()
+        self.regions = collections.OrderedDict()
+        # Results of the last run (also available when it was cancelled)
+        self.__partialResults__ = dict()
+        self.__partialTimings__ = dict()
+        self.__pendingJobs__ = dict()
+        self.__arrays__ = collections.OrderedDict()
+        self.__arrays__["volume"] = volumeArray
+
+    def addRegion(self, regionKey, labelmapROIArray, featureCategoriesKeys, featureKeys,
+                  labelmapWholeVolumeArray=None):
+        """ Add a region of interest that will be analyzed
+        :param regionKey: key of the region in the results dictionary
+        :param labelmapROIArray: numpy array with the labelmap of the area to study
+        :param featureCategoriesKeys: main categories that have some feature that is going to be analyzed
+        :param featureKeys: features that are going to be analyzed
+        :param labelmapWholeVolumeArray: numpy array that represents a labelmap for the whole volume (only used
+            for the Parenchymal Volume analysis)
+        """
+        labelmapName = "labelmap_{}".format(len(self.regions))
+        self.__arrays__[labelmapName] = labelmapROIArray
+        labelmapWholeVolumeName = None
+        if labelmapWholeVolumeArray is not None:
+            # The same array is usually shared by all the regions
+            for name, array in self.__arrays__.iteritems():
+                if array is labelmapWholeVolumeArray:
+                    labelmapWholeVolumeName = name
+                    break
+            else:
+                labelmapWholeVolumeName = "labelmapWholeVolume_{}".format(len(self.regions))
+                self.__arrays__[labelmapWholeVolumeName] = labelmapWholeVolumeArray
+        self.regions[regionKey] = (labelmapName, labelmapWholeVolumeName, list(featureCategoriesKeys), list(featureKeys))
+
+    def getJobs(self, printTiming=False, splitCategories=True):
+        """ Split the analysis in independent jobs
+        :param printTiming: calculate timing for every feature
+        :param splitCategories: when True, there will be a job for every (region, category) pair. Otherwise, there
+            will be a job for every region with all its categories
+        :return: list of jobs that can be passed to _runJob
+        """
+        jobs = []
+        for regionKey, (labelmapName, labelmapWholeVolumeName, categories, featureKeys) in self.regions.iteritems():
+            regionCategories = []
+            regionKeys = set()
+            for category in categories:
+                categoryKeys = set(self.featureClasses[category]).intersection(featureKeys)
+                if len(categoryKeys) == 0:
+                    continue
+                if splitCategories:
+                    jobs.append((regionKey, [category], list(categoryKeys), labelmapName, labelmapWholeVolumeName,
+                                 self.spacing, printTiming))
+                else:
+                    regionCategories.append(category)
+                    regionKeys.update(categoryKeys)
+            if len(regionCategories) > 0:
+                jobs.append((regionKey, regionCategories, list(regionKeys), labelmapName, labelmapWholeVolumeName,
+                             self.spacing, printTiming))
+        return jobs
+
+    def run(self, printTiming=False, progressCallback=None, cancelCallback=None):
+        """ Run all the jobs and gather the results
+        :param printTiming: calculate timing for every feature
+        :param progressCallback: function(regionKey, category, numJobsFinished, numJobs) invoked every time a
+            job is finished (and before every category when the jobs run in the current process)
+        :param cancelCallback: function that returns True when the process must be cancelled. A StopIteration
+            exception will be raised in that case (the regions that were finished are still available in
+            getFinishedResults). The jobs are started in the same order as the regions were added
+        :return: If printTiming==False: dictionary of RegionKey-(OrderedDict of Feature-Value)
+            else: tuple with 2 dictionaries (1 of RegionKey-Feature-Value and another one with RegionKey-Feature-Timing)
+        """
+        inProcess = self.numWorkers <= 1
+        jobs = self.getJobs(printTiming, splitCategories=not inProcess)
+        inProcess = inProcess or len(jobs) <= 1
+        self.__partialResults__ = partialResults = dict()
+        self.__partialTimings__ = partialTimings = dict()
+        self.__pendingJobs__ = dict((regionKey, 0) for regionKey in self.regions)
+        for job in jobs:
+            self.__pendingJobs__[job[0]] += 1
+        if inProcess:
+            _initWorker(dict((name, self.__toBuffer__(array, shared=False)) for name, array in self.__arrays__.iteritems()))
+            try:
+                for i in xrange(len(jobs)):
+                    if cancelCallback is not None and cancelCallback():
+                        raise StopIteration("Progress cancelled!!!")
+                    jobProgressCallback = None
+                    if progressCallback is not None:
+                        def jobProgressCallback(regionKey, category, numFeaturesCalculated, numFeatures,
+                                                numJobsFinished=i):
+                            # Report every category of the region that is going to be analyzed
+                            progressCallback(regionKey, category, numJobsFinished, len(jobs))
+                    jobResult = _runJob(jobs[i], jobProgressCallback, cancelCallback)
+                    self.__storeJobResult__(jobResult, partialResults, partialTimings, progressCallback, i + 1,
+                                            len(jobs))
+            finally:
+                # Do not keep references to the arrays in the current process
+                _initWorker(None)
+        else:
+            sharedArrays = dict((name, self.__toBuffer__(array)) for name, array in self.__arrays__.iteritems())
+            pool = multiprocessing.Pool(min(self.numWorkers, len(jobs)), _initWorker, (sharedArrays,))
+            try:
+                jobResults = pool.imap_unordered(_runJob, jobs)
+                numJobsFinished = 0
+                while numJobsFinished < len(jobs):
+                    # Wait for the results in short intervals so that the caller can keep processing events and
+                    # cancel the process
+                    try:
+                        jobResult = jobResults.next(timeout=0.2)
+                    except multiprocessing.TimeoutError:
+                        jobResult = None
+                    if jobResult is not None:
+                        numJobsFinished += 1
+                        self.__storeJobResult__(jobResult, partialResults, partialTimings, progressCallback,
+                                                numJobsFinished, len(jobs))
+                    if cancelCallback is not None and cancelCallback():
+                        raise StopIteration("Progress cancelled!!!")
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        results, timings = self.getFinishedResults()
+        if not printTiming:
+            return results
+        return results, timings
+
+    def getFinishedResults(self):
+        """ Results of the regions whose jobs were all finished in the last run (all of them, unless the run was
+        cancelled)
+        :return: tuple with 2 dictionaries (RegionKey-(OrderedDict of Feature-Value) and
+            RegionKey-(OrderedDict of Feature-Timing)). The features are in the same order as they were requested
+        """
+        results = dict()
+        timings = dict()
+        partialResults = self.__partialResults__
+        partialTimings = self.__partialTimings__
+        for regionKey, (_, _, _, featureKeys) in self.regions.iteritems():
+            if self.__pendingJobs__.get(regionKey, 1) > 0:
+                continue
+            results[regionKey] = collections.OrderedDict()
+            timings[regionKey] = collections.OrderedDict()
+            regionResults = partialResults.get(regionKey, {})
+            regionTimings = partialTimings.get(regionKey, {})
+            for key in featureKeys:
+                if key in regionResults:
+                    results[regionKey][key] = regionResults[key]
+                if key in regionTimings:
+                    timings[regionKey][key] = regionTimings[key]
+        return results, timings
+
+    def __storeJobResult__(self, jobResult, partialResults, partialTimings, progressCallback, numJobsFinished,
+                           numJobs):
+        regionKey, categories, results, timings = jobResult
+        self.__pendingJobs__[regionKey] -= 1
+        partialResults.setdefault(regionKey, dict()).update(results)
+        partialTimings.setdefault(regionKey, dict()).update(timings)
+        if progressCallback is not None:
+            progressCallback(regionKey, ", ".join(categories), numJobsFinished, numJobs)
+
+    def __toBuffer__(self, array, shared=True):
+        """ Copy a numpy array to a shared memory buffer
+        :param array: numpy array
+        :param shared: when False, the array is used directly (no worker processes)
+        :return: tuple (buffer, dtype, shape)
+        """
+        array = np.ascontiguousarray(array)
+        if not shared:
+            return array, array.dtype, array.shape
+        buf = multiprocessing.sharedctypes.RawArray('b', max(array.nbytes, 1))
+        np.frombuffer(buf, dtype=array.dtype, count=array.size).reshape(array.shape)[...] = array
+        return buf, array.dtype.str, array.shape
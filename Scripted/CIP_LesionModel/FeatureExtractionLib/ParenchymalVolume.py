@@ -1,4 +1,3 @@
-from __main__ import vtk, qt, ctk, slicer
 import numpy as np
 from collections import OrderedDict
 
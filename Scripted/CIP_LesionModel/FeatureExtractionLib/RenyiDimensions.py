@@ -1,4 +1,3 @@
-from __main__ import vtk, qt, ctk, slicer
 import string
 import numpy
 import math
@@ -53,50 +52,65 @@ class RenyiDimensions:
             return self.renyiDimensions, self.renyiDimensionTiming
         
             
-    def renyiDimension(self, c, matrixCoordinatesPadded, q=0): 
+    def boxMasses(self, c):
+        """ Sum of the values of c in the boxes of every scale.
+        The boxes of a scale are obtained reshaping the matrix of the previous (finer) scale in (n, 2, n, 2, n, 2)
+        blocks, so that every scale is reduced with a single numpy sum
+        :param c: 3D cubic matrix with shape equal to a power of two (2**p)
+        :return: list with p+1 arrays, where the element g is a matrix with shape (2**g, 2**g, 2**g) that contains
+            the masses of the boxes of size 2**(p-g) (element p is c itself)
+        """
+        p = int(numpy.log2(c.shape[0]))
+        masses = [None] * (p + 1)
+        masses[p] = c
+        for g in xrange(p-1, -1, -1):
+            n = 2**g
+            masses[g] = masses[g+1].reshape(n, 2, n, 2, n, 2).sum(axis=(1, 3, 5))
+            if self.checkStopProcessFunction is not None:
+                self.checkStopProcessFunction()
+        return masses
+
+    def renyiDimension(self, c, matrixCoordinatesPadded, q=0):
         # computes renyi dimensions for q = 0,1,2 (box-count(default, q=0), information(q=1), and correlation dimensions(q=2))
         # for a padded 3D input array or matrix, c, and the coordinates of values in c, matrixCoordinatesPadded.
-        # c must be padded to a cube with shape equal to next greatest power of two 
-        # i.e. a 3D array with shape: (3,13,9) is padded to shape: (16,16,16)    
-         
+        # c must be padded to a cube with shape equal to next greatest power of two
+        # i.e. a 3D array with shape: (3,13,9) is padded to shape: (16,16,16)
+
         # exception for numpy.sum(c) = 0?
         c = c/float(numpy.sum(c))
         maxDim = c.shape[0]
         p = int(numpy.log2(maxDim))
         n = numpy.zeros(p+1)
         eps = numpy.spacing(1)
-        
+
         # Initialize N(s) value at the finest/voxel-level scale
         if (q==1):
             n[p] = numpy.sum(c[matrixCoordinatesPadded] * numpy.log(1/(c[matrixCoordinatesPadded] + eps)))
         else:
             n[p] = numpy.sum(c[matrixCoordinatesPadded]**q)
-                    
+
+        if (q == 0):
+            # Box counting: number of boxes that contain any voxel different from 0
+            masses = self.boxMasses((c != 0).astype(numpy.float64))
+        else:
+            masses = self.boxMasses(c)
+
         for g in xrange(p-1, -1, -1):
-            siz = 2**(p-g)
-            siz2 = round(siz/2)
-            for i in xrange(0, maxDim-siz+1, siz):
-                for j in xrange(0, maxDim-siz+1, siz):
-                    for k in xrange(0, maxDim-siz+1, siz):
-                        box = numpy.array([ c[i,j,k], c[i+siz2,j,k], c[i,j+siz2,k], c[i+siz2,j+siz2,k], c[i,j,k+siz2], c[i+siz2,j,k+siz2], c[i,j+siz2,k+siz2], c[i+siz2,j+siz2,k+siz2] ])
-                        c[i,j,k] =    numpy.any(box != 0) if (q==0) else numpy.sum(box)**q
-                    if self.checkStopProcessFunction is not None:
-                        self.checkStopProcessFunction()
-                        #print (i, j, k, '                ', c[i,j,k])
-            pi = c[0:(maxDim-siz+1):siz, 0:(maxDim-siz+1):siz, 0:(maxDim-siz+1):siz]                            
-            if (q == 1):             
+            pi = masses[g]
+            if (q == 0):
+                n[g] = numpy.count_nonzero(pi)
+            elif (q == 1):
                 n[g] = numpy.sum(pi * numpy.log(1/(pi+eps)))
             else:
-                n[g] = numpy.sum(pi) 
-            #print ('p, g, siz, siz2', p, g, siz, siz2, '         n[g]: ', n[g])
-        
+                n[g] = numpy.sum(pi**q)
+
         r = numpy.log(2.0**(numpy.arange(p+1))) # log(1/scale)
-        scaleMatrix = numpy.array([r, numpy.ones(p+1)])             
+        scaleMatrix = numpy.array([r, numpy.ones(p+1)])
         #print ('n(s): ', n)
         #print ('log (1/s): ', r)
-        
-        if (q != 1):     
+
+        if (q != 1):
             n = (1/float(1-q)) * numpy.log(n)
         renyiDimension = numpy.linalg.lstsq(scaleMatrix.T, n)[0][0]
-        
+
         return (renyiDimension)
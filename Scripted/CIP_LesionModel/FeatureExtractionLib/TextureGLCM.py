@@ -1,4 +1,3 @@
-from __main__ import vtk, qt, ctk, slicer
 import string
 import numpy
 import math
@@ -6,6 +5,8 @@ import operator
 import collections
 import time
 
+from CoefficientsCache import GLCMCoefficients
+
 
 # from decimal import *
 
@@ -15,32 +16,32 @@ class TextureGLCM:
         self.textureFeaturesGLCM = collections.OrderedDict()
         self.textureFeaturesGLCMTiming = collections.OrderedDict()
 
-        self.textureFeaturesGLCM["Autocorrelation"] = "self.autocorrelationGLCM(self.P_glcm, self.prodMatrix)"
+        self.textureFeaturesGLCM["Autocorrelation"] = "self.autocorrelationGLCM(self.P_glcm, self.coefficients.prodMatrix)"
         self.textureFeaturesGLCM[
-            "Cluster Prominence"] = "self.clusterProminenceGLCM(self.P_glcm, self.sumMatrix, self.ux, self.uy)"
+            "Cluster Prominence"] = "self.clusterProminenceGLCM(self.P_glcm, self.coefficients.sumMatrix, self.coefficients.ux, self.coefficients.uy)"
         self.textureFeaturesGLCM[
-            "Cluster Shade"] = "self.clusterShadeGLCM(self.P_glcm, self.sumMatrix, self.ux, self.uy)"
+            "Cluster Shade"] = "self.clusterShadeGLCM(self.P_glcm, self.coefficients.sumMatrix, self.coefficients.ux, self.coefficients.uy)"
         self.textureFeaturesGLCM[
-            "Cluster Tendency"] = "self.clusterTendencyGLCM(self.P_glcm, self.sumMatrix, self.ux, self.uy)"
-        self.textureFeaturesGLCM["Contrast"] = "self.contrastGLCM(self.P_glcm, self.diffMatrix)"
+            "Cluster Tendency"] = "self.clusterTendencyGLCM(self.P_glcm, self.coefficients.sumMatrix, self.coefficients.ux, self.coefficients.uy)"
+        self.textureFeaturesGLCM["Contrast"] = "self.contrastGLCM(self.P_glcm, self.coefficients.diffMatrix)"
         self.textureFeaturesGLCM[
-            "Correlation"] = "self.correlationGLCM(self.P_glcm, self.prodMatrix, self.ux, self.uy, self.sigx, self.sigy)"
-        self.textureFeaturesGLCM["Difference Entropy"] = "self.differenceEntropyGLCM(self.pxSuby, self.eps)"
-        self.textureFeaturesGLCM["Dissimilarity"] = "self.dissimilarityGLCM(self.P_glcm, self.diffMatrix)"
+            "Correlation"] = "self.correlationGLCM(self.P_glcm, self.coefficients.prodMatrix, self.coefficients.ux, self.coefficients.uy, self.coefficients.sigx, self.coefficients.sigy)"
+        self.textureFeaturesGLCM["Difference Entropy"] = "self.differenceEntropyGLCM(self.coefficients.pxSuby, self.coefficients.eps)"
+        self.textureFeaturesGLCM["Dissimilarity"] = "self.dissimilarityGLCM(self.P_glcm, self.coefficients.diffMatrix)"
         self.textureFeaturesGLCM["Energy (GLCM)"] = "self.energyGLCM(self.P_glcm)"
-        self.textureFeaturesGLCM["Entropy(GLCM)"] = "self.entropyGLCM(self.P_glcm, self.pxy, self.eps)"
-        self.textureFeaturesGLCM["Homogeneity 1"] = "self.homogeneity1GLCM(self.P_glcm, self.diffMatrix)"
-        self.textureFeaturesGLCM["Homogeneity 2"] = "self.homogeneity2GLCM(self.P_glcm, self.diffMatrix)"
-        self.textureFeaturesGLCM["IMC1"] = "self.imc1GLCM(self.HXY, self.HXY1, self.HX, self.HY)"
+        self.textureFeaturesGLCM["Entropy(GLCM)"] = "self.entropyGLCM(self.P_glcm, self.coefficients.pxyLog2)"
+        self.textureFeaturesGLCM["Homogeneity 1"] = "self.homogeneity1GLCM(self.P_glcm, self.coefficients.diffMatrix)"
+        self.textureFeaturesGLCM["Homogeneity 2"] = "self.homogeneity2GLCM(self.P_glcm, self.coefficients.diffMatrix)"
+        self.textureFeaturesGLCM["IMC1"] = "self.imc1GLCM(self.coefficients.HXY, self.coefficients.HXY1, self.coefficients.HX, self.coefficients.HY)"
         # self.textureFeaturesGLCM["IMC2"] = "sum(imc2)/len(imc2)" #"self.imc2GLCM(self,)"  # produces a calculation error
-        self.textureFeaturesGLCM["IDMN"] = "self.idmnGLCM(self.P_glcm, self.diffMatrix, self.Ng)"
-        self.textureFeaturesGLCM["IDN"] = "self.idnGLCM(self.P_glcm, self.diffMatrix, self.Ng)"
-        self.textureFeaturesGLCM["Inverse Variance"] = "self.inverseVarianceGLCM(self.P_glcm, self.diffMatrix, self.Ng)"
+        self.textureFeaturesGLCM["IDMN"] = "self.idmnGLCM(self.P_glcm, self.coefficients.diffMatrix, self.Ng)"
+        self.textureFeaturesGLCM["IDN"] = "self.idnGLCM(self.P_glcm, self.coefficients.diffMatrix, self.Ng)"
+        self.textureFeaturesGLCM["Inverse Variance"] = "self.inverseVarianceGLCM(self.P_glcm, self.coefficients.diffMatrix, self.Ng)"
         self.textureFeaturesGLCM["Maximum Probability"] = "self.maximumProbabilityGLCM(self.P_glcm)"
-        self.textureFeaturesGLCM["Sum Average"] = "self.sumAverageGLCM(self.pxAddy, self.kValuesSum)"
-        self.textureFeaturesGLCM["Sum Entropy"] = "self.sumEntropyGLCM(self.pxAddy, self.eps)"
-        self.textureFeaturesGLCM["Sum Variance"] = "self.sumVarianceGLCM(self.pxAddy, self.kValuesSum)"
-        self.textureFeaturesGLCM["Variance (GLCM)"] = "self.varianceGLCM(self.P_glcm, self.ivector, self.u)"
+        self.textureFeaturesGLCM["Sum Average"] = "self.sumAverageGLCM(self.coefficients.pxAddy, self.coefficients.kValuesSum)"
+        self.textureFeaturesGLCM["Sum Entropy"] = "self.sumEntropyGLCM(self.coefficients.pxAddy, self.coefficients.eps)"
+        self.textureFeaturesGLCM["Sum Variance"] = "self.sumVarianceGLCM(self.coefficients.pxAddy, self.coefficients.kValuesSum)"
+        self.textureFeaturesGLCM["Variance (GLCM)"] = "self.varianceGLCM(self.P_glcm, self.coefficients.ivector, self.coefficients.u)"
 
         self.grayLevels = grayLevels
         self.parameterMatrix = parameterMatrix
@@ -52,10 +53,8 @@ class TextureGLCM:
         self.checkStopProcessFunction = checkStopProcessFunction
 
     def CalculateCoefficients(self, printTiming=False):
-        """ Calculate generic coefficients that will be reused in different markers
-        IMPORTANT!! This method is VERY inefficient when the nodule is big (because
-        of the function calculate_glcm at least). If these
-        statistics are required it would probably need some optimizations
+        """ Calculate the GLCM matrices. The generic coefficients that will be reused in different markers
+        (marginals, entropies, etc.) are calculated on demand by a GLCMCoefficients cache
         :return:
         """
         # generate container for GLCM Matrices, self.P_glcm
@@ -73,61 +72,8 @@ class TextureGLCM:
         # Pt = numpy.transpose(P, (1, 0, 2, 3))
         # P = P + Pt
 
-        ##Calculate GLCM Coefficients
-        self.ivector = numpy.arange(1, self.Ng + 1)  # shape = (self.Ng, distances.size, directions)
-        self.jvector = numpy.arange(1, self.Ng + 1)  # shape = (self.Ng, distances.size, directions)
-        self.eps = numpy.spacing(1)
-
-        self.prodMatrix = numpy.multiply.outer(self.ivector, self.jvector)  # shape = (self.Ng, self.Ng)
-        self.sumMatrix = numpy.add.outer(self.ivector, self.jvector)  # shape = (self.Ng, self.Ng)
-        self.diffMatrix = numpy.absolute(numpy.subtract.outer(self.ivector, self.jvector))  # shape = (self.Ng, self.Ng)
-        self.kValuesSum = numpy.arange(2, (self.Ng * 2) + 1)  # shape = (2*self.Ng-1)
-        self.kValuesDiff = numpy.arange(0, self.Ng)  # shape = (self.Ng-1)
-
-        # shape = (distances.size, directions)
-        self.u = self.P_glcm.mean(0).mean(0)
-        # marginal row probabilities #shape = (self.Ng, distances.size, directions)
-        self.px = self.P_glcm.sum(1)
-        # marginal column probabilities #shape = (self.Ng, distances.size, directions)
-        self.py = self.P_glcm.sum(0)
-
-        # shape = (distances.size, directions)
-        self.ux = self.px.mean(0)
-        # shape = (distances.size, directions)
-        self.uy = self.py.mean(0)
-
-        # shape = (distances.size, directions)
-        self.sigx = self.px.std(0)
-        # shape = (distances.size, directions)
-        self.sigy = self.py.std(0)
-
-        # shape = (2*self.Ng-1, distances.size, directions)
-        self.pxAddy = numpy.array([numpy.sum(self.P_glcm[self.sumMatrix == k], 0) for k in self.kValuesSum])
-        # shape = (self.Ng, distances.size, directions)
-        self.pxSuby = numpy.array([numpy.sum(self.P_glcm[self.diffMatrix == k], 0) for k in self.kValuesDiff])
-
-        # entropy of self.px #shape = (distances.size, directions)
-        self.HX = (-1) * numpy.sum((self.px * numpy.where(self.px != 0, numpy.log2(self.px), numpy.log2(self.eps))), 0)
-        # entropy of py #shape = (distances.size, directions)
-        self.HY = (-1) * numpy.sum((self.py * numpy.where(self.py != 0, numpy.log2(self.py), numpy.log2(self.eps))), 0)
-        # shape = (distances.size, directions)
-        self.HXY = (-1) * numpy.sum(
-            numpy.sum((self.P_glcm * numpy.where(self.P_glcm != 0, numpy.log2(self.P_glcm), numpy.log2(self.eps))), 0),
-            0)
-
-        self.pxy = numpy.zeros(self.P_glcm.shape)  # shape = (self.Ng, self.Ng, distances.size, directions)
-        for a in xrange(directions):
-            for g in xrange(distances.size):
-                self.pxy[:, :, g, a] = numpy.multiply.outer(self.px[:, g, a], self.py[:, g, a])
-
-        self.HXY1 = (-1) * numpy.sum(
-            numpy.sum((self.P_glcm * numpy.where(self.pxy != 0, numpy.log2(self.pxy), numpy.log2(self.eps))), 0),
-            0)  # shape = (distances.size, directions)
-        self.HXY2 = (-1) * numpy.sum(
-            numpy.sum((self.pxy * numpy.where(self.pxy != 0, numpy.log2(self.pxy), numpy.log2(self.eps))), 0),
-            0)  # shape = (distances.size, directions)
-        if printTiming:
-            print("- Time to calculate total glmc coefficients: {0} secs".format(time.time() - t1))
+        ##GLCM Coefficients
+        self.coefficients = GLCMCoefficients(self.P_glcm, self.Ng)
 
     def autocorrelationGLCM(self, P_glcm, prodMatrix, meanFlag=True):
         ac = numpy.sum(numpy.sum(P_glcm * prodMatrix[:, :, None, None], 0), 0)
@@ -206,8 +152,8 @@ class TextureGLCM:
         else:
             return ene
 
-    def entropyGLCM(self, P_glcm, pxy, eps, meanFlag=True):
-        ent = -1 * numpy.sum(numpy.sum((P_glcm * numpy.where(pxy != 0, numpy.log2(pxy), numpy.log2(eps))), 0), 0)
+    def entropyGLCM(self, P_glcm, pxyLog2, meanFlag=True):
+        ent = -1 * numpy.sum(numpy.sum((P_glcm * pxyLog2), 0), 0)
         if meanFlag:
             return (ent.mean())
         else:
@@ -228,7 +174,7 @@ class TextureGLCM:
             return homo2
 
     def imc1GLCM(self, HXY, HXY1, HX, HY, meanFlag=True):
-        imc1 = (self.HXY - self.HXY1) / numpy.max(([self.HX, self.HY]), 0)
+        imc1 = (HXY - HXY1) / numpy.max(([HX, HY]), 0)
         if meanFlag:
             return (imc1.mean())
         else:
@@ -305,22 +251,14 @@ class TextureGLCM:
             return vari
 
     def calculate_glcm(self, grayLevels, matrix, matrixCoordinates, distances, directions, numGrayLevels, out):
-        # VERY INEFFICIENT!!
         # 26 GLCM matrices for each image for every direction from the voxel
         # (26 for each neighboring voxel from a reference voxel centered in a 3x3 cube)
         # for GLCM matrices P(i,j;gamma, a), gamma = 1, a = 1...13
-
-        angles_idx = 0
-        distances_idx = 0
-        r = 0
-        c = 0
-        h = 0
-        rows = matrix.shape[2]
-        cols = matrix.shape[1]
-        height = matrix.shape[0]
-        row = 0
-        col = 0
-        height = 0
+        # For every direction, the reference voxels and their neighbors are obtained as two shifted views of the
+        # padded matrix, so that all the co-occurrences are counted at once with a bincount over the flattened
+        # (i, j) gray level index pairs. Both voxels must be inside the ROI (intratumor only)
+        if matrix.ndim != 3 or len(matrixCoordinates[0]) == 0:
+            return out
 
         angles = numpy.array([(1, 0, 0),
                               (-1, 0, 0),
@@ -349,37 +287,34 @@ class TextureGLCM:
                               (1, -1, -1),
                               (-1, -1, -1)])
 
-        indices = zip(*matrixCoordinates)
-
-
-        for iteration in range(len(indices)):
-        #for h, c, r in indices:
-            h, c, r = indices[iteration]
-            for angles_idx in xrange(directions):
-                angle = angles[angles_idx]
-
-                for distances_idx in xrange(distances.size):
-                    distance = distances[distances_idx]
-
-                    i = matrix[h, c, r]
-                    i_idx = numpy.nonzero(grayLevels == i)
-
-                    row = r + angle[2]
-                    col = c + angle[1]
-                    height = h + angle[0]
-
-                    # Can introduce Parameter Option for reference voxel(i) and neighbor voxel(j):
-                    # Intratumor only: i and j both must be in tumor ROI
-                    # Tumor+Surrounding: i must be in tumor ROI but J does not have to be
-                    if row >= 0 and row < rows and col >= 0 and col < cols:
-                        if tuple((height, col, row)) in indices:
-                            j = matrix[height, col, row]
-                            j_idx = numpy.nonzero(grayLevels == j)
-                            # if i >= grayLevels.min and i <= grayLevels.max and j >= grayLevels.min and j <= grayLevels.max:
-                            out[i_idx, j_idx, distances_idx, angles_idx] += 1
+        # ROI mask (voxels with intensity 0 may be part of the ROI too, so the coordinates are used)
+        mask = numpy.zeros(matrix.shape, dtype=bool)
+        mask[matrixCoordinates] = True
+        # Index of the gray level of every voxel (grayLevels is sorted because it comes from numpy.unique)
+        grayLevelIndexes = numpy.searchsorted(grayLevels, matrix).clip(0, numGrayLevels - 1)
+
+        for angles_idx in xrange(directions):
+            for distances_idx in xrange(distances.size):
+                offset = angles[angles_idx] * distances[distances_idx]
+                # Slices of the reference voxels (i) and the neighbor voxels (j) for this offset
+                iSlices = []
+                jSlices = []
+                for dim in xrange(3):
+                    size = matrix.shape[dim]
+                    o = offset[dim]
+                    if abs(o) >= size:
+                        break
+                    iSlices.append(slice(max(0, -o), size - max(0, o)))
+                    jSlices.append(slice(max(0, o), size - max(0, -o)))
+                else:
+                    iSlices = tuple(iSlices)
+                    jSlices = tuple(jSlices)
+                    valid = mask[iSlices] & mask[jSlices]
+                    pairs = grayLevelIndexes[iSlices][valid] * numGrayLevels + grayLevelIndexes[jSlices][valid]
+                    out[:, :, distances_idx, angles_idx] += numpy.bincount(
+                        pairs, minlength=numGrayLevels * numGrayLevels).reshape(numGrayLevels, numGrayLevels)
             # Check if the user has cancelled the process
-            if iteration % 10 == 0:
-                self.checkStopProcessFunction()
+            self.checkStopProcessFunction()
 
         return (out)
 
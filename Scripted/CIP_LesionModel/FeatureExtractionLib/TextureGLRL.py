@@ -1,4 +1,3 @@
-from __main__ import vtk, qt, ctk, slicer
 import string
 import numpy
 import math
@@ -168,135 +167,83 @@ class TextureGLRL:
             return lrhgle
 
     def calculate_glrl(self, grayLevels, numGrayLevels, matrix, matrixCoordinates, angles, P_out):
-        padVal = 0  # use eps or NaN to pad matrix
-        matrixDiagonals = list()
-
-        # TODO: try using itertools list merging with lists of GLRL diagonal    
-        # i.e.: self.heterogeneityFeatureWidgets = list(itertools.chain.from_iterable(self.featureWidgets.values()))
-
-        # For a single direction or diagonal (aDiags, bDiags...lDiags, mDiags):   
-        # Generate a 1D array for each valid offset of the diagonal, a, in the range specified by lowBound and highBound  
-        # Convert each 1D array to a python list ( matrix.diagonal(a,,).tolist() ) 
-        # Join lists using reduce(lamda x,y: x+y, ...) to represent all 1D arrays for the direction/diagonal       
-        # Use filter(lambda x: numpy.nonzero(x)[0].size>1, ....) to filter 1D arrays of size < 2 or value == 0 or padValue
-
-        # Should change from nonzero() to filter for the padValue specifically (NaN, eps, etc)
-
-        # (1,0,0), #(-1,0,0),
-        aDiags = reduce(lambda x, y: x + y, [a.tolist() for a in numpy.transpose(matrix, (1, 2, 0))])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, aDiags))
-
-        # (0,1,0), #(0,-1,0),
-        bDiags = reduce(lambda x, y: x + y, [a.tolist() for a in numpy.transpose(matrix, (0, 2, 1))])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, bDiags))
-
-        # (0,0,1), #(0,0,-1), 
-        cDiags = reduce(lambda x, y: x + y, [a.tolist() for a in numpy.transpose(matrix, (0, 1, 2))])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, cDiags))
-
-        # (1,1,0),#(-1,-1,0),
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[1]
-
-        dDiags = reduce(lambda x, y: x + y, [matrix.diagonal(a, 0, 1).tolist() for a in xrange(lowBound, highBound)])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, dDiags))
-
-        # (1,0,1), #(-1,0-1),
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[2]
-
-        eDiags = reduce(lambda x, y: x + y, [matrix.diagonal(a, 0, 2).tolist() for a in xrange(lowBound, highBound)])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, eDiags))
-
-        # (0,1,1), #(0,-1,-1),
-        lowBound = -matrix.shape[1] + 1
-        highBound = matrix.shape[2]
-
-        fDiags = reduce(lambda x, y: x + y, [matrix.diagonal(a, 1, 2).tolist() for a in xrange(lowBound, highBound)])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, fDiags))
-
-        # (1,-1,0), #(-1,1,0),    
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[1]
-
-        gDiags = reduce(lambda x, y: x + y,
-                        [matrix[:, ::-1, :].diagonal(a, 0, 1).tolist() for a in xrange(lowBound, highBound)])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, gDiags))
-
-        # (-1,0,1), #(1,0,-1),
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[2]
-
-        hDiags = reduce(lambda x, y: x + y,
-                        [matrix[:, :, ::-1].diagonal(a, 0, 2).tolist() for a in xrange(lowBound, highBound)])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, hDiags))
-
-        # (0,1,-1), #(0,-1,1),
-        lowBound = -matrix.shape[1] + 1
-        highBound = matrix.shape[2]
-
-        iDiags = reduce(lambda x, y: x + y,
-                        [matrix[:, :, ::-1].diagonal(a, 1, 2).tolist() for a in xrange(lowBound, highBound)])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, iDiags))
-
-        # (1,1,1), #(-1,-1,-1)
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[1]
-
-        jDiags = [numpy.diagonal(h, x, 0, 1).tolist() for h in
-                  [matrix.diagonal(a, 0, 1) for a in xrange(lowBound, highBound)] for x in
-                  xrange(-h.shape[0] + 1, h.shape[1])]
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, jDiags))
-
-        # (-1,1,-1), #(1,-1,1),
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[1]
-
-        kDiags = [numpy.diagonal(h, x, 0, 1).tolist() for h in
-                  [matrix[:, ::-1, :].diagonal(a, 0, 1) for a in xrange(lowBound, highBound)] for x in
-                  xrange(-h.shape[0] + 1, h.shape[1])]
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, kDiags))
-
-        # (1,1,-1), #(-1,-1,1),
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[1]
-
-        lDiags = [numpy.diagonal(h, x, 0, 1).tolist() for h in
-                  [matrix[:, :, ::-1].diagonal(a, 0, 1) for a in xrange(lowBound, highBound)] for x in
-                  xrange(-h.shape[0] + 1, h.shape[1])]
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, lDiags))
-
-        # (-1,1,1), #(1,-1,-1),
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[1]
-    
-        mDiags = [numpy.diagonal(h, x, 0, 1).tolist() for h in
-                  [matrix[:, ::-1, ::-1].diagonal(a, 0, 1) for a in xrange(lowBound, highBound)] for x in
-                  xrange(-h.shape[0] + 1, h.shape[1])]
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, mDiags))
-
-        # [n for n in mDiags if numpy.nonzero(n)[0].size>1] instead of filter(lambda x: numpy.nonzero(x)[0].size>1, mDiags)?
-
-        # Run-Length Encoding (rle) for the 13 list of diagonals (1 list per 3D direction/angle)
-        for angle in xrange(0, len(matrixDiagonals)):
-            P = P_out[:, :, angle]
-            for diagonal in matrixDiagonals[angle]:
-                diagonal = numpy.array(diagonal, dtype='int')
-                pos, = numpy.where(
-                    numpy.diff(diagonal) != 0)  # can use instead of using map operator._ on np.where tuples
-                pos = numpy.concatenate(([0], pos + 1, [len(diagonal)]))
-
-                # a or pos[:-1] = run start #b or pos[1:] = run stop #diagonal[a] is matrix value       
-                # adjust condition for pos[:-1] != padVal = 0 to != padVal = eps or NaN or whatever pad value
-                rle = zip([n for n in diagonal[pos[:-1]] if n != padVal], pos[1:] - pos[:-1])
-                rle = [[numpy.where(grayLevels == x)[0][0], y - 1] for x, y in
-                       rle]  # rle = map(lambda (x,y): [voxelToIndexDict[x],y-1], rle)
-
-                # Increment GLRL matrix counter at coordinates defined by the run-length encoding               
-                P[zip(*rle)] += 1
+        # Run-Length Encoding for the 13 3D directions/angles:
+        # (1,0,0), (0,1,0), (0,0,1), (1,1,0), (1,0,1), (0,1,1), (1,-1,0), (1,0,-1), (0,1,-1),
+        # (1,1,1), (1,-1,1), (1,1,-1), (1,-1,-1)
+        # (the opposite directions produce the same runs)
+        # For each direction, all the lines of the matrix are gathered in a 2D array (one row per line) and the
+        # runs are found with array diffs, so there is no Python loop over diagonals or runs
+        if matrix.ndim != 3:
+            return P_out
+
+        directions = numpy.array([(1, 0, 0),
+                                  (0, 1, 0),
+                                  (0, 0, 1),
+                                  (1, 1, 0),
+                                  (1, 0, 1),
+                                  (0, 1, 1),
+                                  (1, -1, 0),
+                                  (1, 0, -1),
+                                  (0, 1, -1),
+                                  (1, 1, 1),
+                                  (1, -1, 1),
+                                  (1, 1, -1),
+                                  (1, -1, -1)])
+
+        Nr = P_out.shape[1]
+        # Gray level index of every voxel. Voxels with value 0 are considered padding (padVal), so they
+        # break the runs and they are not counted (-1)
+        padVal = 0
+        levels = numpy.where(matrix != padVal, numpy.searchsorted(grayLevels, matrix), -1)
+
+        for angle in xrange(min(angles, len(directions))):
+            direction = directions[angle]
+            # Flip the axes with a negative direction so that all the lines go "forward"
+            flippedLevels = levels[tuple(slice(None, None, -1) if d < 0 else slice(None) for d in direction)]
+            lines = self._directionLines(flippedLevels, numpy.abs(direction))
+            if lines.size == 0:
+                continue
+
+            # Filter the lines that have less than 2 non padding voxels
+            lines = lines[numpy.count_nonzero(lines >= 0, axis=1) > 1]
+            if lines.size == 0:
+                continue
+
+            # A run starts where the value is different from the previous one and ends where it is different
+            # from the next one. Both arrays are ordered by line and by position in the line, so they match 1:1
+            changes = lines[:, 1:] != lines[:, :-1]
+            edge = numpy.ones((lines.shape[0], 1), dtype=bool)
+            valid = lines >= 0
+            starts = numpy.flatnonzero(numpy.hstack((edge, changes)) & valid)
+            ends = numpy.flatnonzero(numpy.hstack((changes, edge)) & valid)
+            runGrayLevels = lines.ravel()[starts]
+            runLengths = ends - starts
+
+            # Increment GLRL matrix counter at coordinates defined by the run-length encoding
+            P_out[:, :, angle] += numpy.bincount(runGrayLevels * Nr + runLengths,
+                                                 minlength=numGrayLevels * Nr).reshape(numGrayLevels, Nr)
 
         return (P_out)
 
+    def _directionLines(self, levels, direction):
+        """ Gather all the lines of a 3D matrix that follow a direction with non negative components
+        :param levels: 3D int array (negative values are considered out of the ROI)
+        :param direction: 3-tuple with 0/1 values
+        :return: 2D array with one line per row (all of them padded with -1 to the length of the longest one)
+        """
+        shape = numpy.array(levels.shape)
+        active = numpy.flatnonzero(direction)
+        length = shape[active].min()
+        # First voxel of each line: it is in the first position for any of the axes that the direction moves along
+        grid = numpy.indices(levels.shape).reshape(3, -1)
+        starts = grid[:, (grid[active] == 0).any(axis=0)]
+        # Coordinates of all the positions of the lines (shape: 3 x numLines x length)
+        steps = numpy.arange(length)
+        coords = starts[:, :, None] + direction[:, None, None] * steps[None, None, :]
+        inside = (coords < shape[:, None, None]).all(axis=0)
+        coords = numpy.minimum(coords, (shape - 1)[:, None, None])
+        return numpy.where(inside, levels[tuple(coords)], -1)
+
     def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None):
         # Remove all the keys that must not be evaluated
         for key in set(self.textureFeaturesGLRL.keys()).difference(self.keys):
@@ -5,3 +5,5 @@ from GeometricalMeasures import*
 from TextureGLCM import*
 from TextureGLRL import*
 from ParenchymalVolume import *
+from FeatureExtractor import *
+from ParallelFeatureExtractor import ParallelFeatureExtractor
@@ -977,20 +977,11 @@ class CIP_PAARatioLogic(ScriptedLoadableModuleLogic):
         ijk = self.RAStoIJK(volume, [0, 0, rasBounds[5]])
         slice = int(ijk[2] * self.SLICEFACTOR)       # Empiric estimation
 
-        # Get the default coords, converting from IJK to RAS
-        aorta1 = list(self.defaultAorta1)
-        aorta1[2] = slice
-        aorta1 = self.IJKtoRAS(volume, aorta1)
-        aorta2 = list(self.defaultAorta2)
-        aorta2[2] = slice
-        aorta2 = self.IJKtoRAS(volume, aorta2)
-
-        pa1 = list(self.defaultPA1)
-        pa1[2] = slice
-        pa1 = self.IJKtoRAS(volume, pa1)
-        pa2 = list(self.defaultPA2)
-        pa2[2] = slice
-        pa2 = self.IJKtoRAS(volume, pa2)
+        # Get the default coords, converting from IJK to RAS (all of them at once)
+        ijkCoords = [[coords[0], coords[1], slice] for coords in
+                     (self.defaultAorta1, self.defaultAorta2, self.defaultPA1, self.defaultPA2)]
+        # Homogeneous coordinates (the rulers expect 4 positions)
+        aorta1, aorta2, pa1, pa2 = [coords + [1] for coords in Util.ijk_to_ras_array(volume, ijkCoords).tolist()]
 
         return aorta1, aorta2, pa1, pa2
 
@@ -1009,21 +1000,15 @@ class CIP_PAARatioLogic(ScriptedLoadableModuleLogic):
 
     def RAStoIJK(self, volumeNode, rasCoords):
         """ Transform a list of RAS coords in IJK for a volume
-        :return: list of IJK coordinates
+        :return: list of IJK coordinates (homogeneous)
         """
-        rastoijk=vtk.vtkMatrix4x4()
-        volumeNode.GetRASToIJKMatrix(rastoijk)
-        rasCoords.append(1)
-        return list(rastoijk.MultiplyPoint(rasCoords))
+        return Util.ras_to_ijk(volumeNode, rasCoords, convert_to_int=False) + [1]
 
     def IJKtoRAS(self, volumeNode, ijkCoords):
         """ Transform a list of IJK coords in RAS for a volume
-        :return: list of RAS coordinates
+        :return: list of RAS coordinates (homogeneous)
         """
-        ijktoras=vtk.vtkMatrix4x4()
-        volumeNode.GetIJKToRASMatrix(ijktoras)
-        ijkCoords.append(1)
-        return list(ijktoras.MultiplyPoint(ijkCoords))
+        return Util.ijk_to_ras(volumeNode, ijkCoords) + [1]
 
 
 class CIP_PAARatioTest(ScriptedLoadableModuleTest):
@@ -628,59 +628,94 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
         datalabel_arr = vtk.util.numpy_support.vtk_to_numpy(labelNode.GetImageData().GetPointData().GetScalars())
         data_arr = vtk.util.numpy_support.vtk_to_numpy(CTNode.GetImageData().GetPointData().GetScalars())
 
+        # Compute the HU histogram of every label in a single pass over the volume. All the statistics for each
+        # region are derived from the sum of the histograms of its labels
+        maxLabel = max(value[1] for value in self.regionValues)
+        huValues, labelHistograms = self.labelHistograms(data_arr, datalabel_arr, maxLabel)
+
         for value, tag in zip(self.regionValues, rTags):
-            data = data_arr[(datalabel_arr >= value[0]) & (datalabel_arr <= value[1])]
-
-            if data.any():
-                mean_data = numpy.mean(data)
-                std_data = numpy.std(data)
-                self.labelStats['LAA%-950', tag] = 100.0 * (data < -950).sum() / float(data.size)
-                self.labelStats['LAA%-925', tag] = 100.0 * (data < -925).sum() / float(data.size)
-                self.labelStats['LAA%-910', tag] = 100.0 * (data < -910).sum() / float(data.size)
-                self.labelStats['LAA%-856', tag] = 100.0 * (data < -856).sum() / float(data.size)
-                self.labelStats['HAA%-700', tag] = 100.0 * (data > -700).sum() / float(data.size)
-                self.labelStats['HAA%-600', tag] = 100.0 * (data > -600).sum() / float(data.size)
-                self.labelStats['HAA%-500', tag] = 100.0 * (data > -500).sum() / float(data.size)
-                self.labelStats['HAA%-250', tag] = 100.0 * (data > -250).sum() / float(data.size)
-                # self.labelStats[cycle,'Perc10',tag]=self.percentile(data,.1)
-                # self.labelStats[cycle,'Perc15',tag]=self.percentile(data,.15)
-                self.labelStats['Perc10',tag]=numpy.percentile(data,10)
-                self.labelStats['Perc15',tag]=numpy.percentile(data,15)
+            histogram = labelHistograms[value[0]:value[1] + 1].sum(axis=0)
+            nonEmpty = histogram > 0
+            hu = huValues[nonEmpty]
+            counts = histogram[nonEmpty]
+
+            # Equivalent to "data.any()" (there is at least one voxel with a value different from 0)
+            if (hu != 0).any():
+                size = float(counts.sum())
+                mean_data = numpy.sum(hu * counts) / size
+                std_data = numpy.sqrt(numpy.sum(counts * (hu - mean_data) ** 2) / size)
+                self.labelStats['LAA%-950', tag] = 100.0 * counts[hu < -950].sum() / size
+                self.labelStats['LAA%-925', tag] = 100.0 * counts[hu < -925].sum() / size
+                self.labelStats['LAA%-910', tag] = 100.0 * counts[hu < -910].sum() / size
+                self.labelStats['LAA%-856', tag] = 100.0 * counts[hu < -856].sum() / size
+                self.labelStats['HAA%-700', tag] = 100.0 * counts[hu > -700].sum() / size
+                self.labelStats['HAA%-600', tag] = 100.0 * counts[hu > -600].sum() / size
+                self.labelStats['HAA%-500', tag] = 100.0 * counts[hu > -500].sum() / size
+                self.labelStats['HAA%-250', tag] = 100.0 * counts[hu > -250].sum() / size
+                self.labelStats['Perc10', tag] = self.histogramPercentile(hu, counts, 10)
+                self.labelStats['Perc15', tag] = self.histogramPercentile(hu, counts, 15)
                 self.labelStats['Mean', tag] = mean_data
                 self.labelStats['Std', tag] = std_data
-                self.labelStats['Kurtosis', tag] = self.kurt(data, mean_data, std_data)
-                self.labelStats['Skewness', tag] = self.skew(data, mean_data, std_data)
-                self.labelStats['Ventilation Heterogeneity', tag] =  self.vh(data)
-                self.labelStats['Mass',tag] = self.mass(data,cubicMMPerVoxel)
-                self.labelStats['Volume', tag] = data.size * cubicMMPerVoxel * litersPerCubicMM;
-
-                # Compute histograms
-                data = data[data < -350]
-                binContainers = numpy.arange(data.min(), data.max() + 2)
-                histogram, bins = numpy.histogram(data, bins=binContainers, density=False)
-                self.regionHists[tag] = histogram
-                self.regionBins[tag] = bins
+                self.labelStats['Kurtosis', tag] = self.kurt(hu, counts, mean_data, std_data)
+                self.labelStats['Skewness', tag] = self.skew(hu, counts, mean_data, std_data)
+                self.labelStats['Ventilation Heterogeneity', tag] = self.vh(hu, counts)
+                self.labelStats['Mass', tag] = self.mass(hu, counts, cubicMMPerVoxel)
+                self.labelStats['Volume', tag] = size * cubicMMPerVoxel * litersPerCubicMM
+
+                # Histograms for the chart (values < -350 HU, 1 HU bins)
+                below = hu[hu < -350]
+                if below.size > 0:
+                    inRange = (huValues >= below.min()) & (huValues <= below.max())
+                    self.regionHists[tag] = histogram[inRange]
+                    self.regionBins[tag] = numpy.arange(below.min(), below.max() + 2)
+                else:
+                    self.regionHists[tag] = numpy.array([], numpy.int64)
+                    self.regionBins[tag] = numpy.array([], numpy.int64)
 
                 self.regionTags.append(tag)
 
                 self.valuesDictionary[tag] = value
 
-                ## Read files and populate array
-
-                # add an entry to the LabelStats list
-                # self.labelStats["Labels"].append(i)
-                # self.labelStats[i,"Index"] = i
-                # self.labelStats[i,"Count"] = stat1.GetVoxelCount()
-                # self.labelStats[i,"Volume mm^3"] = self.labelStats[i,"Count"] * cubicMMPerVoxel
-                # self.labelStats[i,"Volume cc"] = self.labelStats[i,"Volume mm^3"] * ccPerCubicMM
-                # self.labelStats[i,"Min"] = stat1.GetMin()[0]
-                # self.labelStats[i,"Max"] = stat1.GetMax()[0]
-                # self.labelStats[i,"Mean"] = stat1.GetMean()[0]
-                # self.labelStats[i,"StdDev"] = stat1.GetStandardDeviation()[0]
-
-                # this.InvokeEvent(vtkParenchymaAnalysisLogic::LabelStatsInnerLoop, (void*)"1")
-
-                # this.InvokeEvent(vtkParenchymaAnalysisLogic::EndLabelStats, (void*)"end label stats")
+    def labelHistograms(self, data_arr, datalabel_arr, maxLabel):
+        """ Histogram of the HU values (1 HU bins) for every label in the range [1, maxLabel], computed in a
+        single pass with a bincount over label * numBins + HU.
+        Non integer intensities are rounded to the closest HU value.
+        @param data_arr: numpy array with the CT values
+        @param datalabel_arr: numpy array with the labels (same shape as data_arr)
+        @param maxLabel: maximum label value
+        @return: tuple with a numpy array with the HU value of each bin, and a (maxLabel + 1) x numBins numpy array
+        where the row N is the histogram for the label N
+        """
+        import numpy
+        mask = (datalabel_arr >= 1) & (datalabel_arr <= maxLabel)
+        labels = datalabel_arr[mask].astype(numpy.int64)
+        data = data_arr[mask]
+        if data.dtype.kind == 'f':
+            data = numpy.rint(data)
+        data = data.astype(numpy.int64)
+        if data.size == 0:
+            return numpy.array([], numpy.int64), numpy.zeros((maxLabel + 1, 0), numpy.int64)
+
+        minHU = data.min()
+        numBins = data.max() - minHU + 1
+        histograms = numpy.bincount(labels * numBins + (data - minHU), minlength=(maxLabel + 1) * numBins)
+        return numpy.arange(minHU, minHU + numBins), histograms.reshape(maxLabel + 1, numBins)
+
+    def histogramPercentile(self, hu, counts, percent):
+        """ Percentile of the data represented by a histogram (same as numpy.percentile with linear interpolation)
+        @param hu: sorted HU values of the non-empty bins
+        @param counts: number of voxels for each value
+        @param percent: percentile (0-100)
+        @return: percentile value
+        """
+        import numpy
+        cumulative = numpy.cumsum(counts)
+        k = (cumulative[-1] - 1) * percent / 100.0
+        f = numpy.floor(k)
+        c = numpy.ceil(k)
+        # Values of the sorted data in the positions f and c
+        lower, upper = hu[numpy.searchsorted(cumulative, [f, c], side='right')]
+        return lower + (upper - lower) * (k - f)
 
     def percentile(N, percent, key=lambda x: x):
         """
@@ -705,54 +740,53 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
         d1 = key(N[int(c)]) * (k - f)
         return d0 + d1
 
-    def vh(self, data):
+    def vh(self, hu, counts):
         import numpy
-        arr = data[((data > -1000) & (data <= 0))]
-        # Convert to float to apply the formula
-        #arr = arr.astype(numpy.float)
+        inRange = (hu > -1000) & (hu <= 0)
+        arr = hu[inRange]
+        weights = counts[inRange]
+        if weights.sum() == 0:
+            return numpy.nan
         # Apply formula
         arr = -arr / (arr + 1000.0)
         arr **= (1/3.0)
-        return arr.std()
+        mean = numpy.sum(arr * weights) / float(weights.sum())
+        return numpy.sqrt(numpy.sum(weights * (arr - mean) ** 2) / float(weights.sum()))
 
-    def kurt(self, obs, meanVal, stdDev):
+    def kurt(self, hu, counts, meanVal, stdDev):
         import numpy as np
-        n = float(len(obs))
+        n = float(counts.sum())
         if stdDev < 0.0000001:
             kurt = 1
             return kurt
 
-        kurt = (n + 1) * n / ((n - 1) * (n - 2) * (n - 3)) * np.sum((obs - meanVal) ** 4) / stdDev ** 4 - 3 * (
-                                                                                                              n - 1) ** 2 / (
-                                                                                                          (n - 2) * (
-                                                                                                          n - 3))
-        # num = np.sqrt((1. / len(obs)) * np.sum((obs - meanVal) ** 4))
-        # denom = stdDev ** 4  # avoid losing precision with np.sqrt call
+        kurt = (n + 1) * n / ((n - 1) * (n - 2) * (n - 3)) * np.sum(counts * (hu - meanVal) ** 4) / stdDev ** 4 - \
+               3 * (n - 1) ** 2 / ((n - 2) * (n - 3))
         return kurt
 
-    def skew(self, obs, meanVal, stdDev):
+    def skew(self, hu, counts, meanVal, stdDev):
         import numpy as np
         if stdDev < 0.00001:
             skew = 1
             return skew
 
-        n = float(len(obs))
-        num = 1 / n * np.sum((obs - meanVal) ** 3)
+        n = float(counts.sum())
+        num = 1 / n * np.sum(counts * (hu - meanVal) ** 3)
         denom = stdDev ** 3  # avoid losing precision with np.sqrt call
         return num / denom
 
-    def mass(self,data,cubicMMPerVoxel):
+    def mass(self, hu, counts, cubicMMPerVoxel):
         # This quantity is computed in a piecewise linear form
         # according to the prescription presented in ref. [1].
         # Mass is computed in grams. First compute the
         # contribution in HU interval from -98 and below.
         import numpy as np
         pheno_val = 0.0
-        HU_tmp = data[data < -98].clip(-1000)
-        if HU_tmp.shape[0] > 0:
+        sel = hu < -98
+        if sel.any():
             m = (1.21e-3 - 0.93) / (-1000 + 98)
             b = 1.21e-3 + 1000 * m
-            pheno_val += np.sum((m * HU_tmp + b) *  cubicMMPerVoxel * 0.001)
+            pheno_val += np.sum(counts[sel] * (m * hu[sel].clip(-1000) + b) * cubicMMPerVoxel * 0.001)
 
         # Now compute the mass contribution in the interval
         # [-98, 18] HU. Note the in the original paper, the
@@ -760,21 +794,21 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
         # extend in slightly here so there are no gaps in
         # coverage. The values we report in the interval
         # [14, 23] should be viewed as approximate.
-        HU_tmp = data[np.logical_and(data >= -98,data <= 18)]
-        if HU_tmp.shape[0] > 0:
+        sel = np.logical_and(hu >= -98, hu <= 18)
+        if sel.any():
             pheno_val += \
-                np.sum((1.018 + 0.893 * HU_tmp / 1000.0) * cubicMMPerVoxel * 0.001)
+                np.sum(counts[sel] * (1.018 + 0.893 * hu[sel] / 1000.0) * cubicMMPerVoxel * 0.001)
 
         # Compute the mass contribution in the interval
         # (18, 100]
-        HU_tmp = data[np.logical_and(data> 18,data <= 100)]
-        if HU_tmp.shape[0] > 0:
-            pheno_val += np.sum((1.003 + 1.169 * HU_tmp / 1000.0) * cubicMMPerVoxel * 0.001)
+        sel = np.logical_and(hu > 18, hu <= 100)
+        if sel.any():
+            pheno_val += np.sum(counts[sel] * (1.003 + 1.169 * hu[sel] / 1000.0) * cubicMMPerVoxel * 0.001)
 
         # Compute the mass contribution in the interval > 100
-        HU_tmp = data[data > 100]
-        if HU_tmp.shape[0] > 0:
-            pheno_val += np.sum((1.017 + 0.592 * HU_tmp / 1000.0) * cubicMMPerVoxel * 0.001)
+        sel = hu > 100
+        if sel.any():
+            pheno_val += np.sum(counts[sel] * (1.017 + 0.592 * hu[sel] / 1000.0) * cubicMMPerVoxel * 0.001)
 
         return pheno_val
 
@@ -783,14 +817,16 @@ class CIP_ParenchymaAnalysisLogic(ScriptedLoadableModuleLogic):
             qt.QMessageBox.warning(slicer.util.mainWindow(), "Data not existing", "No statistics calculated")
             return
 
+        rows = []
         for tag in self.regionTags:
             e = {}
             e['Volume Name'] = CTNode.GetName()
             e['Region'] = tag
             for k in self.keys:
                 e[k] = self.labelStats[k, tag]
+            rows.append(e)
 
-            repWidget.insertRow(**e)
+        repWidget.insertRows(rows)
 
         if not self.__preventDialogs__:
             qt.QMessageBox.information(slicer.util.mainWindow(), 'Data saved', 'The data were saved successfully')
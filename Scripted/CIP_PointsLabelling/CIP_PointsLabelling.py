@@ -1,8 +1,10 @@
 import os
+import glob
 import logging
-from shutil import copyfile
+import threading
 import time
 from collections import OrderedDict
+import numpy as np
 
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
@@ -392,6 +394,15 @@ class CIP_PointsLabellingLogic(ScriptedLoadableModuleLogic):
         self.currentTypesList = None
         self.savedVolumes = {}
         self.currentGeometryTopologyData = None
+        # Xml of the points that have already been written (see GeometryTopologyData.write_xml)
+        self.savedPointsXmlCache = {}
+        # Last file where the fiducials were saved
+        self.lastSavedFilePath = None
+        # Maximum number of backup copies kept for every results file (setting CIP_PointsLabelling/MaxBackupFiles).
+        # 0 = keep all of them
+        self.maxBackupFiles = int(SlicerUtil.settingGetOrSetDefault("CIP_PointsLabelling", "MaxBackupFiles", 10))
+        if self.maxBackupFiles <= 0:
+            self.maxBackupFiles = None
 
     @property
     def _xmlFileExtensionKey_(self):
@@ -435,6 +446,15 @@ class CIP_PointsLabellingLogic(ScriptedLoadableModuleLogic):
         """
         raise NotImplementedError("This method should be implemented by a child class")
 
+    def getMarkupDescription(self, typesList):
+        """
+        Get the description that will be stored in the fiducial for the corresponding types-subtypes combination.
+        The description will be parsed when saving the fiducials (see getPointMetadataFromFiducialDescription)
+        :param typesList: list of types-subtypes. It can be a region-type-artifact or any other combination
+        :return: description string for this fiducial
+        """
+        raise NotImplementedError("This method should be implemented by a child class")
+
 
     def getTypesListFromXmlPoint(self, geometryTopologyDataPoint):
         """
@@ -446,28 +466,59 @@ class CIP_PointsLabellingLogic(ScriptedLoadableModuleLogic):
 
 
     def loadFiducialsXml(self, volumeNode, fileName):
-        """ Load from disk a list of fiducials for a particular volume node
+        """ Load from disk a list of fiducials for a particular volume node.
+        The file can be a xml or a npz GeometryTopologyData file (see GeometryTopologyData.from_file).
+        All the coordinates are transformed at once, and all the fiducials of the same fiducials list are added in
+        a single modification of the node, so that the scene is not refreshed for every point
         :param volumeNode: Volume (scalar node)
         :param fileName: full path of the file to load the fiducials where
         """
-        with open(fileName, "r") as f:
-            xml = f.read()
-
-        self.currentGeometryTopologyData = gtd.GeometryTopologyData.from_xml(xml)
-        for point in self.currentGeometryTopologyData.points:
-            # Activate the current fiducials list based on the type list
-            typesList = self.getTypesListFromXmlPoint(point)
-            fidListNode = self.setActiveFiducialsListNode(volumeNode, typesList)
-            # Check if the coordinate system is RAS (and make the corresponding transform otherwise)
-            if self.currentGeometryTopologyData.coordinate_system == self.currentGeometryTopologyData.LPS:
-                coord = Util.lps_to_ras(point.coordinate)
-            elif self.currentGeometryTopologyData.coordinate_system == self.currentGeometryTopologyData.IJK:
-                coord = Util.ijk_to_ras(volumeNode, point.coordinate)
-            else:
-                # Try default mode (RAS)
-                coord = point.coordinate
-            # Add the fiducial
-            fidListNode.AddFiducial(coord[0], coord[1], coord[2], self.getMarkupLabel(typesList))
+        self.currentGeometryTopologyData = gtd.GeometryTopologyData.from_file(fileName)
+        # The points read from the file are saved "as is" (see saveCurrentFiducials)
+        self.savedPointsXmlCache = {}
+        self.lastSavedFilePath = None
+        points = self.currentGeometryTopologyData.points
+        if len(points) == 0:
+            return
+
+        # Check if the coordinate system is RAS (and make the corresponding transform otherwise)
+        if self.currentGeometryTopologyData.coordinate_system == self.currentGeometryTopologyData.LPS:
+            sourceSystem = Util.LPS
+        elif self.currentGeometryTopologyData.coordinate_system == self.currentGeometryTopologyData.IJK:
+            sourceSystem = Util.IJK
+        else:
+            # Try default mode (RAS)
+            sourceSystem = Util.RAS
+        rasCoords = Util.transform_coordinates_array(volumeNode, [point.coordinate for point in points],
+                                                     sourceSystem, Util.RAS)
+
+        # Group the points by types list (in the same order they were read)
+        groups = OrderedDict()
+        for i in xrange(len(points)):
+            typesList = tuple(self.getTypesListFromXmlPoint(points[i]))
+            if not groups.has_key(typesList):
+                groups[typesList] = []
+            groups[typesList].append(i)
+
+        slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+        try:
+            for typesList, indexes in groups.iteritems():
+                # Activate the current fiducials list based on the type list
+                fidListNode = self.setActiveFiducialsListNode(volumeNode, typesList)
+                label = self.getMarkupLabel(typesList)
+                description = self.getMarkupDescription(typesList)
+                # The markup events are not invoked while the node is being modified, so the label and the
+                # description must be set here for every fiducial
+                wasModifying = fidListNode.StartModify()
+                try:
+                    for i in indexes:
+                        coord = rasCoords[i]
+                        n = fidListNode.AddFiducial(coord[0], coord[1], coord[2], label)
+                        fidListNode.SetNthMarkupDescription(n, description)
+                finally:
+                    fidListNode.EndModify(wasModifying)
+        finally:
+            slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
 
     def getPointMetadataFromFiducialDescription(self, description):
         """
@@ -482,20 +533,30 @@ class CIP_PointsLabellingLogic(ScriptedLoadableModuleLogic):
     def saveCurrentFiducials(self, localFilePath, caseNavigatorWidget=None, callbackFunction=None, saveInRemoteRepo=False):
         """ Save all the fiducials for the current volume.
         The name of the file will be VolumeName_parenchymaTraining.xml"
+        The points that were already saved are reused (including their xml representation), so that only the new
+        points are serialized. If nothing changed since the last time the file was saved, the file is not written again
         :param filePath: destination file (local)
         :param caseNavigatorWidget: case navigator widget (optional)
         :param callbackFunction: function to invoke when the file has been uploaded to the server (optional)
         """
         volume = slicer.mrmlScene.GetNodeByID(self.currentVolumeId)
         #fileName = volume.GetName() + Util.file_conventions_extensions[self._xmlFileExtensionKey_]
-        # If there is already a xml file in the results directory, make a copy.
         #localFilePath = os.path.join(directory, fileName)
-        if os.path.isfile(localFilePath):
-            # Make a copy of the file for history purposes
-            copyfile(localFilePath, localFilePath + "." + time.strftime("%Y%m%d.%H%M%S"))
 
         # Iterate over all the fiducials list nodes
         pos = [0,0,0]
+        rasCoords = []
+        descriptions = []
+        for fidListNode in slicer.util.getNodes("{0}_fiducials_*".format(volume.GetName())).itervalues():
+            # Get all the markups
+            for i in range(fidListNode.GetNumberOfMarkups()):
+                fidListNode.GetNthFiducialPosition(i, pos)
+                rasCoords.append(list(pos))
+                # Get the type from the description (region will always be 0)
+                descriptions.append(fidListNode.GetNthMarkupDescription(i))
+        # Switch all the coordinates from RAS to LPS
+        lpsCoords = Util.ras_to_lps_array(np.array(rasCoords, dtype=np.float64).reshape(-1, 3)).tolist()
+
         geometryTopologyData = gtd.GeometryTopologyData()
         geometryTopologyData.coordinate_system = geometryTopologyData.LPS
         # Get the transformation matrix LPS-->IJK
@@ -516,30 +577,46 @@ class CIP_PointsLabellingLogic(ScriptedLoadableModuleLogic):
         # Get a timestamp that will be used for all the points
         timestamp = gtd.GeometryTopologyData.get_timestamp()
 
-        for fidListNode in slicer.util.getNodes("{0}_fiducials_*".format(volume.GetName())).itervalues():
-            # Get all the markups
-            for i in range(fidListNode.GetNumberOfMarkups()):
-                fidListNode.GetNthFiducialPosition(i, pos)
-                # Get the type from the description (region will always be 0)
-                desc = fidListNode.GetNthMarkupDescription(i)
-                # Switch coordinates from RAS to LPS
-                lps_coords = Util.ras_to_lps(list(pos))
-                pointMetadata = self.getPointMetadataFromFiducialDescription(desc)
-                p = gtd.Point(pointMetadata[0], pointMetadata[1], pointMetadata[2], lps_coords, description=pointMetadata[3])
-                key = p.get_hash()
-                if hashTable.has_key(key):
-                    # Add previously existing point
-                    geometryTopologyData.add_point(hashTable[key], fill_auto_fields=False)
-                else:
-                    # Add a new point with a precalculated timestamp
-                    geometryTopologyData.add_point(p, fill_auto_fields=True)
-                    p.timestamp = timestamp
-
-        # Get the xml content file
-        xml = geometryTopologyData.to_xml()
-        # Save the file
-        with open(localFilePath, 'w') as f:
-            f.write(xml)
+        numNewPoints = 0
+        for i in xrange(len(lpsCoords)):
+            pointMetadata = self.getPointMetadataFromFiducialDescription(descriptions[i])
+            p = gtd.Point(pointMetadata[0], pointMetadata[1], pointMetadata[2], lpsCoords[i],
+                          description=pointMetadata[3])
+            key = p.get_hash()
+            if hashTable.has_key(key):
+                # Add previously existing point
+                geometryTopologyData.add_point(hashTable[key], fill_auto_fields=False)
+            else:
+                # Add a new point with a precalculated timestamp
+                geometryTopologyData.add_point(p, fill_auto_fields=True)
+                p.timestamp = timestamp
+                numNewPoints += 1
+
+        unchanged = numNewPoints == 0 and self.currentGeometryTopologyData is not None \
+                    and len(geometryTopologyData.points) == len(self.currentGeometryTopologyData.points) \
+                    and localFilePath == self.lastSavedFilePath and os.path.isfile(localFilePath)
+        if unchanged:
+            logging.info("No changes in the fiducials since the last save. File {} not modified".format(localFilePath))
+        else:
+            # Save the file in a temporary path first, so that the previous file is not lost if the saving fails.
+            # The extension is kept because it sets the format of the file. Just the new points are serialized
+            root, ext = os.path.splitext(localFilePath)
+            tempFilePath = root + ".saving" + ext
+            try:
+                geometryTopologyData.to_file(tempFilePath, xml_cache=self.savedPointsXmlCache)
+            except:
+                if os.path.isfile(tempFilePath):
+                    os.remove(tempFilePath)
+                raise
+            if os.path.isfile(localFilePath):
+                # Keep the previous file for history purposes
+                self.__backupFile__(localFilePath)
+            os.rename(tempFilePath, localFilePath)
+            # Remove the points that are not in the file anymore from the cache
+            self.savedPointsXmlCache = dict((point, self.savedPointsXmlCache[point])
+                                            for point in geometryTopologyData.points
+                                            if self.savedPointsXmlCache.has_key(point))
+            self.lastSavedFilePath = localFilePath
 
         # Use the new object as the current GeometryTopologyData
         self.currentGeometryTopologyData = geometryTopologyData
@@ -551,6 +628,36 @@ class CIP_PointsLabellingLogic(ScriptedLoadableModuleLogic):
         # Mark the current volume as saved
         self.savedVolumes[volume.GetName()] = True
 
+    def __backupFile__(self, filePath):
+        """ Keep a copy of a results file for history purposes (FilePath.YYYYmmdd.HHMMSS).
+        The file is renamed instead of copied, because it is going to be replaced anyway. The oldest copies
+        (when there are more than maxBackupFiles) are removed in a background thread
+        :param filePath: file path
+        """
+        backupFilePath = filePath + "." + time.strftime("%Y%m%d.%H%M%S")
+        if os.path.isfile(backupFilePath):
+            # Saved twice in the same second
+            os.remove(backupFilePath)
+        os.rename(filePath, backupFilePath)
+        if self.maxBackupFiles is not None:
+            thread = threading.Thread(target=self.__removeOldBackupFiles__, args=(filePath, self.maxBackupFiles))
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def __removeOldBackupFiles__(filePath, maxBackupFiles):
+        """ Remove the oldest backup copies of a file, so that at most maxBackupFiles copies are kept
+        :param filePath: original file path
+        :param maxBackupFiles: number of copies to keep
+        """
+        # The timestamp suffix has a fixed length, so the alphabetical order is the chronological order
+        backupFiles = sorted(glob.glob(filePath + ".????????.??????"))
+        for backupFilePath in backupFiles[:max(0, len(backupFiles) - maxBackupFiles)]:
+            try:
+                os.remove(backupFilePath)
+            except OSError as ex:
+                logging.warning("Backup file {} could not be removed: {}".format(backupFilePath, ex))
+
 
     def removeLastFiducial(self):
         """ Remove the last markup that was added to the scene. It will remove all the markups if the user wants
@@ -576,6 +683,8 @@ class CIP_PointsLabellingLogic(ScriptedLoadableModuleLogic):
             slicer.mrmlScene.RemoveNode(node)
         slicer.mrmlScene.RemoveNode(volume)
         self.currentGeometryTopologyData = None
+        self.savedPointsXmlCache = {}
+        self.lastSavedFilePath = None
 
 
 
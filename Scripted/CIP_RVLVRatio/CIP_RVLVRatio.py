@@ -944,20 +944,11 @@ class CIP_RVLVRatioLogic(ScriptedLoadableModuleLogic):
         ijk = self.RAStoIJK(volume, [0, 0, rasBounds[5]])
         slice = int(ijk[2] * self.SLICEFACTOR)       # Empiric estimation
 
-        # Get the default coords, converting from IJK to RAS
-        rv1 = list(self.defaultRV1)
-        rv1[2] = slice
-        rv1 = self.IJKtoRAS(volume, rv1)
-        rv2 = list(self.defaultRV2)
-        rv2[2] = slice
-        rv2 = self.IJKtoRAS(volume, rv2)
-
-        lv1 = list(self.defaultLV1)
-        lv1[2] = slice
-        lv1 = self.IJKtoRAS(volume, lv1)
-        lv2 = list(self.defaultLV2)
-        lv2[2] = slice
-        lv2 = self.IJKtoRAS(volume, lv2)
+        # Get the default coords, converting from IJK to RAS (all of them at once)
+        ijkCoords = [[coords[0], coords[1], slice] for coords in
+                     (self.defaultRV1, self.defaultRV2, self.defaultLV1, self.defaultLV2)]
+        # Homogeneous coordinates (the rulers expect 4 positions)
+        rv1, rv2, lv1, lv2 = [coords + [1] for coords in Util.ijk_to_ras_array(volume, ijkCoords).tolist()]
 
         return rv1, rv2, lv1, lv2
 
@@ -976,21 +967,15 @@ class CIP_RVLVRatioLogic(ScriptedLoadableModuleLogic):
 
     def RAStoIJK(self, volumeNode, rasCoords):
         """ Transform a list of RAS coords in IJK for a volume
-        :return: list of IJK coordinates
+        :return: list of IJK coordinates (homogeneous)
         """
-        rastoijk=vtk.vtkMatrix4x4()
-        volumeNode.GetRASToIJKMatrix(rastoijk)
-        rasCoords.append(1)
-        return list(rastoijk.MultiplyPoint(rasCoords))
+        return Util.ras_to_ijk(volumeNode, rasCoords, convert_to_int=False) + [1]
 
     def IJKtoRAS(self, volumeNode, ijkCoords):
         """ Transform a list of IJK coords in RAS for a volume
-        :return: list of RAS coordinates
+        :return: list of RAS coordinates (homogeneous)
         """
-        ijktoras=vtk.vtkMatrix4x4()
-        volumeNode.GetIJKToRASMatrix(ijktoras)
-        ijkCoords.append(1)
-        return list(ijktoras.MultiplyPoint(ijkCoords))
+        return Util.ijk_to_ras(volumeNode, ijkCoords) + [1]
 
 
 class CIP_RVLVRatioTest(ScriptedLoadableModuleTest):
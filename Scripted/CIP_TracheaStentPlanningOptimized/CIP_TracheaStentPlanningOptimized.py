@@ -11,6 +11,7 @@ import math
 import itertools
 
 import scipy.optimize as scipy_opt
+from scipy.spatial import cKDTree
 import vtk.util.numpy_support as nc
 from CIP.logic.SlicerUtil import SlicerUtil
 
@@ -640,6 +641,32 @@ class CIP_TracheaStentPlanningOptimizedWidget(ScriptedLoadableModuleWidget):
 
 
 
+#
+# TracheaSurfaceLocator
+#
+class TracheaSurfaceLocator(object):
+    """ Nearest point queries over the points of the trachea surface.
+    The search tree is built just once for a surface, and the closest surface points of a whole set of points
+    (ex: all the points of a cylinder) are found in a single call, so the objective functions of the optimization
+    do not need to build a vtkPointLocator every time that they are evaluated.
+    """
+    def __init__(self, tracheaFilter):
+        """
+        :param tracheaFilter: filter with the trachea surface (see buildTracheaButterflySubdivisionFilter)
+        """
+        self.polyData = tracheaFilter.GetOutput()
+        self.points = nc.vtk_to_numpy(self.polyData.GetPoints().GetData()).astype(np.float64)
+        self.tree = cKDTree(self.points)
+
+    def closestPoints(self, points):
+        """ Closest surface point to each one of the given points
+        :param points: numpy array (N x 3)
+        :return: numpy array (N x 3)
+        """
+        _, ids = self.tree.query(np.asarray(points, dtype=np.float64))
+        return self.points[ids]
+
+
 # CIP_TracheaStentPlanningOptimizedLogic
 #
 class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
@@ -1197,7 +1224,9 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         c1 = centroids[0]
         c2 = centroids[1]
         c3 = centroids[2]
-        arguments = c1, c2, c3, trachea
+        # The nearest point search structure of the trachea is built just once for all the evaluations of the
+        # objective function
+        arguments = c1, c2, c3, TracheaSurfaceLocator(trachea)
         self.currentCentroids=c1,c2,c3
         self.progressBar.close()
         #self.progressBar = None
@@ -1363,23 +1392,34 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         :param n: normal vector of the polygon
         :return: area
         """
-        aa = poly.GetLines()
-        aa.InitTraversal()
-        total = np.zeros(3, )
         if poly.GetNumberOfPoints() == 0:
             return 1000
-        for i in range(aa.GetNumberOfCells()):
-            p_idx = vtk.vtkIdList()
-            aa.GetNextCell(p_idx)
-            p1_idx = p_idx.GetId(0)
-            p2_idx = p_idx.GetId(1)
-            p1 = np.array(poly.GetPoints().GetPoint(p1_idx))
-            p2 = np.array(poly.GetPoints().GetPoint(p2_idx))
-            total = total + np.cross(p1, p2)
+        points = nc.vtk_to_numpy(poly.GetPoints().GetData()).astype(np.float64)
+        lines = self.__linesEndpoints__(poly.GetLines())
+        total = np.cross(points[lines[:, 0]], points[lines[:, 1]]).sum(axis=0)
         result = np.dot(total, n / np.linalg.norm(n))
         Result = abs(result / 2)
         return Result
 
+    def __linesEndpoints__(self, cells):
+        """
+        gets the ids of the first and last points of every cell in a cell array
+        :param cells: vtkCellArray (ex: lines of the intersection of a plane and the trachea)
+        :return: numpy array (number of cells x 2)
+        """
+        data = nc.vtk_to_numpy(cells.GetData())
+        numCells = cells.GetNumberOfCells()
+        if len(data) == 3 * numCells and (numCells == 0 or (data[0::3] == 2).all()):
+            # All the cells are segments ([2, id0, id1] in the array)
+            return data.reshape(numCells, 3)[:, 1:3]
+        endpoints = np.zeros((numCells, 2), np.int64)
+        idList = vtk.vtkIdList()
+        cells.InitTraversal()
+        for i in xrange(numCells):
+            cells.GetNextCell(idList)
+            endpoints[i] = idList.GetId(0), idList.GetId(1)
+        return endpoints
+
     def centroide(self, intersection):
         """
         calculates the centroid of the intersection
@@ -1552,19 +1592,11 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
     def homologous(self, traq, p_cil):
         """
         calculates the points of the trachea that correspond to the given points of the cylinder
-        :param traq: trachuea
+        :param traq: TracheaSurfaceLocator of the trachea
         :param p_cil: cylinder points
-        :return: trachea points
+        :return: trachea points (numpy array)
         """
-        loc = vtk.vtkPointLocator()
-        loc.SetDataSet(traq.GetOutput())
-        loc.BuildLocator()
-        vector = vtk.vtkPoints()
-        for i in range(len(p_cil)):
-            d = loc.FindClosestPoint(p_cil[i])
-            res = traq.GetOutput().GetPoints().GetPoint(d)
-            vector.InsertNextPoint(res)
-        return vector
+        return traq.closestPoints(p_cil)
 
     def functional(self, cil1, cil2, cil3, hom1, hom2, hom3):
         """
@@ -1577,19 +1609,9 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         :param hom3: right bronchi points
         :return: distances
         """
-        suma = 0
-        for i in range(len(cil1)):
-            punto = hom1.GetPoint(i)
-            cilind = cil1[i]
-            suma = suma + (np.sqrt(np.sum((punto[0:2] - cilind[0:2]) ** 2)))
-        for i in range(len(cil2)):
-            punto = hom2.GetPoint(i)
-            cilind = cil2[i]
-            suma = suma + (np.sqrt(np.sum((punto[0:2] - cilind[0:2]) ** 2)))
-        for i in range(len(cil3)):
-            punto = hom3.GetPoint(i)
-            cilind = cil3[i]
-            suma = suma + (np.sqrt(np.sum((punto[0:2] - cilind[0:2]) ** 2)))
+        cilind = np.concatenate((cil1, cil2, cil3))
+        punto = np.concatenate((hom1, hom2, hom3))
+        suma = np.sqrt(np.sum((punto[:, 0:2] - cilind[:, 0:2]) ** 2, axis=1)).sum()
         return suma
 
     def minimum(self, parameters, centroid1, centroid2, centroid3, traq):
@@ -1597,6 +1619,7 @@ class CIP_TracheaStentPlanningOptimizedLogic(ScriptedLoadableModuleLogic):
         calculates the medium square error of the distances between cylinder and trachea
         :param parameters: initial parameters (points and radius)
         :param centroids: centroids
+        :param traq: TracheaSurfaceLocator of the trachea
         :return: error
         """
         pm2 = [0, 0, 0]
@@ -1,6 +1,7 @@
 import os, string
 import unittest
 import vtk, qt, ctk, slicer
+from vtk.util import numpy_support
 import numpy as np
 
 from slicer.ScriptedLoadableModule import *
@@ -199,20 +200,26 @@ class VolumeProbeWidget(ScriptedLoadableModuleWidget):
         self.layout.addStretch(1)
 
     def reportROIStats(self, pixelArray):
+        """ Show the statistics of the pixels in the ROI
+        :param pixelArray: numpy array (or list) with the values of the pixels
+        """
         min = 0
         max = 0
         mean = 0
         med = 0
-        self.histogramArray.SetNumberOfTuples(0)
-        if len(pixelArray):
-            pixels = np.array(pixelArray)
+        standardDeviation = 0
+        pixels = np.asarray(pixelArray, dtype=np.float64)
+        if len(pixels):
             min = pixels.min()
             max = pixels.max()
             mean = pixels.mean()
             standardDeviation = pixels.std()
-            med = self.median(pixelArray)
-            for i in range(len(pixelArray)):
-                self.histogramArray.InsertNextTuple1(pixels[i])
+            med = self.median(pixels)
+        # Copy all the values to the histogram array at once
+        self.histogramArray.SetNumberOfTuples(len(pixels))
+        if len(pixels):
+            numpy_support.vtk_to_numpy(self.histogramArray)[:] = pixels
+        self.histogramArray.Modified()
 
         self.minField.setValue(min)
         self.maxField.setValue(max)
@@ -228,21 +235,23 @@ class VolumeProbeWidget(ScriptedLoadableModuleWidget):
         """Return the median (middle value) of numeric data.
         When the number of data points is odd, return the middle data point.
         When the number of data points is even, the median is interpolated by
-        taking the average of the two middle values:
+        taking the average of the two middle values.
+        The data are not sorted (numpy.partition just places the middle values)
         >>> median([1, 3, 5])
         3
         >>> median([1, 3, 5, 7])
         4.0
         """
-        data = sorted(data)
+        data = np.asarray(data)
         n = len(data)
         if n == 0:
             return 0
+        i = n // 2
         if n % 2 == 1:
-            return data[n // 2]
+            return np.partition(data, i)[i]
         else:
-            i = n // 2
-            return (data[i - 1] + data[i]) / 2
+            data = np.partition(data, (i - 1, i))
+            return (data[i - 1] + data[i]) / 2.0
 
     def onDrawROIToggled(self):
         if self.drawROICheck.checked:
@@ -513,6 +522,10 @@ class ROIManager(ViewWatcher):
         self.maxValueFG = 0
         self.probeWidget = None
         self.drawOverlay = 0
+        # Circular masks already calculated (radius-mask)
+        self.__roiMasks__ = {}
+        # Parameters of the last ROI that was analyzed (image, image MTime, center pixel, radius)
+        self.__lastROI__ = None
 
         # utility Qt instances for use in methods
         self.gray = qt.QColor()
@@ -633,7 +646,8 @@ class ROIManager(ViewWatcher):
 
     def computeROIStats(self, xy, radius):
         """compute stats for an image inside ROI
-        at xy with radius"""
+        at xy with radius.
+        The stats are not computed again if the ROI is still in the same pixel of the same image"""
 
         # Get vtkImages for F/B/L layers
         bgVTKImage = self.layerLogics['B'].GetReslice().GetOutput()
@@ -643,20 +657,41 @@ class ROIManager(ViewWatcher):
             bgVTKImage = self.layerLogics['L'].GetReslice().GetOutput()
 
         x, y = xy
-        radius2 = radius * radius
+        roi = (bgVTKImage, bgVTKImage.GetMTime() if bgVTKImage else None, x, y, radius)
+        if roi == self.__lastROI__:
+            return
+        self.__lastROI__ = roi
         roiPixels = []
 
-        if bgVTKImage:
+        if bgVTKImage and bgVTKImage.GetPointData().GetScalars():
             dims = bgVTKImage.GetDimensions()
-            for i in range(dims[0]):
-                for j in range(dims[1]):
-                    dist2 = (i - x) * (i - x) + (j - y) * (j - y)
-                    if dist2 < radius2:
-                        value = bgVTKImage.GetScalarComponentAsDouble(i, j, 0, 0);
-                        roiPixels.append(value)
+            # Numpy view of the first component of the image (rows=j, columns=i)
+            scalars = bgVTKImage.GetPointData().GetScalars()
+            image = numpy_support.vtk_to_numpy(scalars).reshape(dims[2], dims[1], dims[0], -1)[0, :, :, 0]
+            mask = self.__getROIMask__(radius)
+            r = mask.shape[0] // 2
+            # Square that contains the ROI (clipped to the image)
+            i0, i1 = max(x - r, 0), min(x + r + 1, dims[0])
+            j0, j1 = max(y - r, 0), min(y + r + 1, dims[1])
+            if i0 < i1 and j0 < j1:
+                roiMask = mask[j0 - y + r:j1 - y + r, i0 - x + r:i1 - x + r]
+                roiPixels = image[j0:j1, i0:i1][roiMask]
 
         self.probeWidget.reportROIStats(roiPixels)
 
+    def __getROIMask__(self, radius):
+        """ Circular mask of the pixels whose distance to the center is smaller than radius
+        :param radius: radius in pixels
+        :return: square boolean numpy array with an odd size. The center of the ROI is the central pixel
+        """
+        mask = self.__roiMasks__.get(radius)
+        if mask is None:
+            r = int(np.ceil(radius))
+            offsets = np.arange(-r, r + 1)
+            mask = (offsets[:, np.newaxis] ** 2 + offsets[np.newaxis, :] ** 2) < radius * radius
+            self.__roiMasks__[radius] = mask
+        return mask
+
     def overlayPixmap(self, xy):
         """fill a pixmap with an image that has a reveal pattern
         at xy with the fg drawn over the bg"""